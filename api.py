@@ -4,7 +4,8 @@ import os
 import random
 import smtplib
 import ssl
-from datetime import datetime, timezone
+import threading
+from datetime import datetime, timedelta, timezone
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
@@ -18,11 +19,16 @@ from dotenv import load_dotenv
 from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 
-from postcard_creator import helper
+from postcard_creator import helper, token_refresh, transport
+from postcard_creator.account_pool import Account, AccountLease, AccountPool, get_account_pool
+from postcard_creator.account_cache import get_account_cache
+from postcard_creator.account_state import get_account_state
+from postcard_creator.request_policy import get_request_policy
 from postcard_creator.enc_token_provider import EncTokenProvider
-from postcard_creator.postcard_creator import Sender, Recipient, Postcard, PostcardCreator, \
-    PostcardCreatorTokenInvalidException
-from postcard_creator.token import NoopToken
+from postcard_creator.postcard_creator import Sender, Recipient, Postcard
+from postcard_creator.postcard_creator_swissid_async import AsyncPostcardCreatorSwissId
+from postcard_creator.quota_probe import probe_accounts
+from postcard_creator.quota_scheduler import QuotaScheduler
 
 load_dotenv()
 app = FastAPI()
@@ -33,10 +39,47 @@ class NoAccountAvailableException(Exception):
     pass
 
 
-class PostcardFlow:
+class NoPostcardAvailableException(Exception):
+    pass
+
+
+class QueueClaims:
+    """
+    Queue items which are being sent, shared by all flows of the process so no item is sent twice
+    """
+
     def __init__(self):
+        self._lock = threading.Lock()
+        self._claimed = set()
+
+    def claim(self, candidates):
+        """
+        Claim a random unclaimed item of candidates, None if all are taken
+        """
+        with self._lock:
+            free = [item for item in candidates if str(item) not in self._claimed]
+            if not free:
+                return None
+            item = random.choice(free)
+            self._claimed.add(str(item))
+            return item
+
+    def release(self, item):
+        with self._lock:
+            self._claimed.discard(str(item))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._claimed)
+
+
+claims = QueueClaims()
+done_list_lock = threading.Lock()
+
+
+class PostcardFlow:
+    def __init__(self, pool: AccountPool | None = None):
         self.mock_send = os.getenv("POSTCARD_MOCK", 'False').lower() in ('true', '1', 't')
-        self.selected_account: PostcardCreator | None = None
         self.data_folder = Path(os.getenv("DATA_DIR"))
         self.image_folder = Path(os.getenv("POSTCARD_DIR"))
         self.accounts_folder = Path(os.getenv("ACCOUNTS_DIR"))
@@ -44,25 +87,39 @@ class PostcardFlow:
         self.done_file = self.data_folder.joinpath('done.json')
         self.archive_folder = self.image_folder.joinpath('archive')
 
-        self.token_mngt = EncTokenProvider(self.accounts_folder)
-
-    # Function to check available credits
-    def check_credits(self, credentials) -> PostcardCreator | None:
-        for credential in credentials:
+        # XXX: accounts are leased from the pool, flows keep no token state so they can run concurrently
+        self.pool = pool or get_account_pool()
+
+    # Function to check available credits, all accounts are probed concurrently
+    async def check_credits(self, credentials) -> AccountLease | None:
+        """
+        Lease the first account with quota which is not in use
+        """
+        results = await probe_accounts(credentials, pool=self.pool)
+        last_probe.update(probe_report(results))
+
+        candidates = [result for result in results if result.available]
+        if not candidates and self.mock_send:
+            # nothing is uploaded, any account with a valid token will do
+            candidates = [result for result in reversed(results) if result.ok]
+
+        for result in candidates:
+            lease = self.pool.try_lease(result.ref)
+            if lease is not None:
+                return lease
+
+        # all of them are sending for concurrent flows, take the first one that is done and still has quota
+        refs = [result.ref for result in candidates]
+        while refs:
+            lease = await self.pool.lease_any_async(refs)
+            refs.remove(lease.account.ref)
             try:
-                self.token_mngt.decrypt_token(credential)
-                self.token_mngt.maybe_refresh_token()
-
-                w: PostcardCreator = self.token_mngt.postcard_creator
-                quota = w.get_quota()
-
-                if quota['available']:
-                    return w
-            except PostcardCreatorTokenInvalidException as e:
+                client = await lease.account.prepare_async()
+                if self.mock_send or (await client.get_quota())['available']:
+                    return lease
+            except Exception as e:
                 pass
-
-        if self.mock_send:
-            return PostcardCreator(NoopToken("1234"))
+            lease.release()
 
         return None
 
@@ -122,8 +179,34 @@ class PostcardFlow:
 
     # Save done list to disk
     def save_done_list(self, done_list):
-        with open(self.done_file, 'w') as file:
+        tmp = self.done_file.with_name(f'.{self.done_file.name}.tmp')
+        with open(tmp, 'w') as file:
             json.dump(done_list, file)
+        os.replace(tmp, self.done_file)
+
+    def mark_done(self, item):
+        # read-modify-write, concurrent sends must not drop each other's entries
+        with done_list_lock:
+            done_list = self.load_done_list()
+            done_list.append(str(item))
+            self.save_done_list(done_list)
+
+    async def claim_item(self):
+        """
+        Claim a queued postcard which is neither done nor being sent by another flow
+        """
+        queue = await asyncio.to_thread(self.load_queue)
+        done_list = set(await asyncio.to_thread(self.load_done_list))
+        candidates = [item for item in queue if str(item) not in done_list]
+        while True:
+            item = claims.claim(candidates)
+            if item is None:
+                return None
+            # archived by a flow which finished after we listed the queue
+            if await asyncio.to_thread(helper.filename_cover(item).is_file):
+                return item
+            claims.release(item)
+            candidates.remove(item)
 
     # Send email with pictures
     def send_email(self, smtp_server, port, login, password, from_addr, to_addr, subject, body: str, attachments,
@@ -164,7 +247,8 @@ class PostcardFlow:
         for picture in files:
             os.rename(picture, os.path.join(self.archive_folder, os.path.basename(picture)))
 
-    def send_postcard(self, sender: Sender, recipient: Recipient, cover_file, message_image_file):
+    async def send_postcard(self, sender: Sender, recipient: Recipient, cover_file, message_image_file,
+                            w: AsyncPostcardCreatorSwissId):
         card = Postcard(
             recipient=recipient,
             sender=sender,
@@ -172,8 +256,8 @@ class PostcardFlow:
             message_image_stream=open(message_image_file, 'rb')
         )
 
-        w = self.selected_account
-        success = w.send_free_card(postcard=card, mock_send=self.mock_send, image_export=True)
+        # XXX: images are rendered in the default executor, the event loop keeps serving requests
+        success = await w.send_free_card(postcard=card, mock_send=self.mock_send, image_export=True)
         return success
 
     @staticmethod
@@ -193,73 +277,103 @@ class PostcardFlow:
 
         return recipient
 
-    def run_flow(self):
-
+    async def run_flow(self, accounts=None):
+        """
+        Send one postcard with the first account which has quota. Returns {account: order}.
+        """
         # Step 1: Check credentials for available credits
-        enc_tokens = self.token_mngt.list_tokens()
-        credential = self.check_credits(enc_tokens)
-        if not credential:
+        enc_tokens = self.pool.refs() if accounts is None else accounts
+        lease = await self.check_credits(enc_tokens)
+        if not lease:
             print("No available credits")
             raise NoAccountAvailableException("No available credits")
 
-        self.selected_account: PostcardCreator = credential
-
-        # Step 3: Load queue from disk
-        queue = self.load_queue()
-
-        # Step 4: Load done list
-        done_list = self.load_done_list()
-
-        # Step 5-9: Process queue
-        item = random.choice(queue)
-        if item not in done_list:
-            # Load pictures (Assuming item is a filename for simplicity)
-            cover_file = helper.filename_cover(item)
-            message_image_file = helper.filename_text(item)
-
-            sender = self.build_sender()
-            recipient = self.build_recipient()
-
-            # Send email
-            success = self.send_postcard(sender, recipient, cover_file, message_image_file)
-
-            order_id = None
-            if isinstance(success, dict) and "orderId" in success:
-                order_id = success["orderId"]
-
-            mail_text = self.make_mail_text(sender, recipient, order_id=order_id)
+        with lease as account:
+            # Step 3-4: Claim a postcard of the queue which is not done yet
+            item = await self.claim_item()
+            if item is None:
+                raise NoPostcardAvailableException("No postcards queued")
 
             try:
-                self.send_email(os.getenv("SMTP_SERVER"),
-                                int(os.getenv("SMTP_PORT")),
-                                os.getenv("SMTP_LOGIN"),
-                                os.getenv("SMTP_PASSWORD"),
-
-                                os.getenv("MAIL_FROM_ADDR"),
-                                os.getenv("MAIL_TO_ADDR"),
-                                'Postcard <3',
-                                mail_text,
-                                attachments=[
-                                    cover_file,
-                                    message_image_file,
-                                ])
-            except Exception as e:
-                print(f"Failed to send email for {item}: {e}")
-
-            # Archive pictures
-            self.archive_pictures(item, success)
+                return {account.ref: await self.send_item(item, account)}
+            finally:
+                claims.release(item)
+
+    async def dispatch(self, accounts=None, concurrency=None):
+        """
+        Send one postcard with every account which has quota, at most concurrency at a time
+        (POSTCARD_DISPATCH_CONCURRENCY). Returns {account: order or exception} of the accounts that sent or failed.
+        """
+        concurrency = concurrency or int(os.getenv("POSTCARD_DISPATCH_CONCURRENCY", 4))
+        results = await probe_accounts(accounts, pool=self.pool)
+        last_probe.update(probe_report(results))
+        available = [result for result in results if result.available]
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(result):
+            async with semaphore:
+                # in use by a concurrent flow, which sends with it
+                lease = self.pool.try_lease(result.ref)
+                if lease is None:
+                    return None
+                with lease as account:
+                    # XXX: claim when the send starts, waiting sends don't hold back items from other flows
+                    item = await self.claim_item()
+                    if item is None:
+                        return None
+                    try:
+                        return await self.send_item(item, account)
+                    finally:
+                        claims.release(item)
+
+        sent = await asyncio.gather(*[send(result) for result in available], return_exceptions=True)
+        return {result.ref: status for result, status in zip(available, sent) if status is not None}
+
+    async def send_item(self, item, account: Account):
+        # Load pictures (Assuming item is a filename for simplicity)
+        cover_file = helper.filename_cover(item)
+        message_image_file = helper.filename_text(item)
+
+        w = await account.prepare_async()
+        sender = await self.build_sender(w)
+        recipient = self.build_recipient()
+
+        # Step 5: Send postcard and email
+        success = await self.send_postcard(sender, recipient, cover_file, message_image_file, w)
+
+        order_id = None
+        if isinstance(success, dict) and "orderId" in success:
+            order_id = success["orderId"]
+
+        mail_text = self.make_mail_text(sender, recipient, order_id=order_id)
 
-            # Update done list and queue
-            done_list.append(str(item))
-            queue.remove(item)
+        try:
+            await asyncio.to_thread(self.send_email,
+                                    os.getenv("SMTP_SERVER"),
+                                    int(os.getenv("SMTP_PORT")),
+                                    os.getenv("SMTP_LOGIN"),
+                                    os.getenv("SMTP_PASSWORD"),
+
+                                    os.getenv("MAIL_FROM_ADDR"),
+                                    os.getenv("MAIL_TO_ADDR"),
+                                    'Postcard <3',
+                                    mail_text,
+                                    attachments=[
+                                        cover_file,
+                                        message_image_file,
+                                    ])
+        except Exception as e:
+            print(f"Failed to send email for {item}: {e}")
 
-        # Save updated done list and queue
-        self.save_done_list(done_list)
+        # Step 6: Archive pictures and update done list, before the claim is released
+        await asyncio.to_thread(self.archive_pictures, item, success)
+        await asyncio.to_thread(self.mark_done, item)
+        return success
 
-    def build_sender(self):
+    async def build_sender(self, w: AsyncPostcardCreatorSwissId):
         # TODO: Fetch from swisspost instance
-        w = self.token_mngt.postcard_creator
-        post_profile = w.get_user_info()
+        post_profile = await w.get_user_info()
         return Sender(
             prename=post_profile["firstName"],
             lastname=post_profile["name"],
@@ -290,63 +404,159 @@ Empfänger:
 # In-memory cache
 cache: Dict[int, datetime] = {}
 pc = PostcardFlow()
+scheduler = QuotaScheduler(clock=lambda: datetime.now(local_tz))
+
+MIN_DELAY = 60  # seconds until an account without quota is probed again
+RETRY_DELAY = float(os.getenv("POSTCARD_RETRY_DELAY", 15 * 60))  # after failed probes or sends
 
 last_submission = None
 last_run = None
+last_probe: Dict[str, dict] = {}
 
 
-# Background task to check dates in cache
-async def check_dates():
-    global cache, last_run, last_submission
-
-    while True:
-        now = datetime.now(local_tz)  # Make it offset-aware in UTC
-        for account_id, date in list(cache.items()):
-            if date < now:
-                try:
-                    pc.run_flow()
-                    last_submission = datetime.now(local_tz)
-                except Exception as e:
-                    pass
-
-                cache = make_cache()
+def probe_report(results):
+    return {result.account.name: result.to_json() for result in results}
 
-        last_run = now
-        await asyncio.sleep(60)  # Check every minute
 
+# Background task sending a postcard as soon as the quota of an account frees up
+async def check_dates():
+    global last_run, last_submission
 
-def make_cache():
-    enc_tokens = pc.token_mngt.list_tokens()
-    mapping = {}
-    for enc_token in enc_tokens:
+    while True:
+        await scheduler.wait()
+        # every account which is due sends, in parallel
+        accounts = scheduler.due()
+        last_run = datetime.now(local_tz)
+        sent = {}
+        try:
+            sent = await pc.dispatch(accounts)
+            if any(not isinstance(status, Exception) for status in sent.values()):
+                last_submission = datetime.now(local_tz)
+        except Exception as e:
+            print(f"Dispatching failed: {e!r}")
+        finally:
+            # XXX: only the used accounts changed, the others keep their schedule. Accounts with quota left
+            # which couldn't send, e.g. with an empty queue, are not retried right away
+            failed = [account for account in accounts
+                      if account not in sent or isinstance(sent[account], Exception)]
+            if len(failed) < len(accounts):
+                await reschedule([account for account in accounts if account not in failed])
+            if failed:
+                await reschedule(failed, not_before=datetime.now(local_tz) + timedelta(seconds=RETRY_DELAY))
+
+
+async def reschedule(accounts, not_before=None):
+    """
+    make_cache for the background task, which must not end on an error: the accounts are retried later instead
+    """
+    global cache
+    try:
+        cache = await make_cache(accounts, not_before)
+    except Exception as e:
+        print(f"Rescheduling {len(accounts)} accounts failed, retry in {RETRY_DELAY}s: {e!r}")
+        retry = datetime.now(local_tz) + timedelta(seconds=RETRY_DELAY)
+        for account in accounts:
+            scheduler.update(account, retry)
+        cache = scheduler.as_dict()
+
+
+# Background task refreshing tokens before they expire, so sending never waits for the token endpoint
+async def prerefresh_tokens(interval, window):
+    # XXX: the accounts of the pool pick up the refreshed tokens when they are next leased
+    token_mngt = EncTokenProvider(pc.accounts_folder)
+    while True:
+        await asyncio.sleep(interval)
         try:
-            pc.token_mngt.decrypt_token(enc_token)
-            pc.token_mngt.maybe_refresh_token()
-
-            w: PostcardCreator = pc.token_mngt.postcard_creator
-            quota = w.get_quota()
-            if 'next' in quota and quota['next']:
-                next_date = parser.isoparse(quota['next'])
-                next_date = next_date.astimezone(local_tz)
-            else:
-                next_date = datetime.now(local_tz)
-            mapping[enc_token] = next_date
+            await token_mngt.refresh_expiring_async(window)
         except Exception as e:
-            pass
+            print(f"Pre-refreshing tokens failed: {e!r}")
+
+
+async def make_cache(accounts=None, not_before=None):
+    """
+    Probe accounts (default all) and schedule them at the time their next free postcard is available,
+    accounts with quota left not before not_before
+    """
+    results = await probe_accounts(accounts, pool=pc.pool)
+    last_probe.update(probe_report(results))
+
+    now = datetime.now(local_tz)
+    for result in results:
+        if not result.ok:
+            # e.g. an expired refresh token, look again later instead of dropping the account
+            next_date = now + timedelta(seconds=RETRY_DELAY)
+        elif result.quota.get('next'):
+            try:
+                next_date = parser.isoparse(result.quota['next']).astimezone(local_tz)
+            except (ValueError, OverflowError, TypeError) as e:
+                print(f"Unexpected quota of {result.account.name}: {e}")
+                next_date = now + timedelta(seconds=RETRY_DELAY)
+        else:
+            next_date = now
+        if not result.available:
+            next_date = max(next_date, now + timedelta(seconds=MIN_DELAY))
+        elif not_before is not None:
+            next_date = max(next_date, not_before)
+        scheduler.update(result.ref, next_date)
+
+    return scheduler.as_dict()
+
+
+def load_snapshot():
+    """
+    Schedule the accounts from their last saved state, without going to the network
+    """
+    state = get_account_state()
+    now = datetime.now(local_tz)
+    for ref in pc.pool.refs():
+        record = state.get(pc.pool.get(ref).name)
+        if not record.get('quota'):
+            continue
+        try:
+            next_date = parser.isoparse(record['next']).astimezone(local_tz) if record.get('next') else now
+        except (ValueError, OverflowError, TypeError) as e:
+            # e.g. edited by hand, the reconcile task corrects it
+            print(f"Ignoring saved next of {pc.pool.get(ref).name}: {e}")
+            next_date = now
+        scheduler.update(ref, next_date)
+
+    return scheduler.as_dict()
 
-    return mapping
+
+# Background task replacing the snapshot by what the Post API says
+async def reconcile():
+    global cache
+    cache = await make_cache()
 
 
 @app.on_event("startup")
 async def startup_event():
-    global run_task, cache
-    # Populate the cache with some initial data
-    cache = make_cache()
+    global run_task, prerefresh_task, reconcile_task, cache
+    if os.getenv("POSTCARD_HTTP_WARM_UP", 'False').lower() in ('true', '1', 't'):
+        # open pooled connections to the api host while we read the accounts
+        asyncio.get_running_loop().run_in_executor(None, transport.warm_up)
+
+    # Serve from the saved state right away, the accounts are probed in the background
+    cache = load_snapshot()
+    reconcile_task = asyncio.create_task(reconcile())
 
     # Start the background task
     if os.getenv("RUN_QUEUE", 'False').lower() in ('true', '1', 't'):
         run_task = asyncio.create_task(check_dates())
 
+    prerefresh_interval = float(os.getenv("POSTCARD_TOKEN_PREREFRESH_INTERVAL",
+                                          token_refresh.DEFAULT_PREREFRESH_INTERVAL))
+    if prerefresh_interval > 0:
+        prerefresh_window = float(os.getenv("POSTCARD_TOKEN_PREREFRESH_WINDOW",
+                                            token_refresh.DEFAULT_PREREFRESH_WINDOW))
+        prerefresh_task = asyncio.create_task(prerefresh_tokens(prerefresh_interval, prerefresh_window))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await pc.pool.aclose()
+    await transport.get_transport().aclose()
+
 
 @app.exception_handler(NoAccountAvailableException)
 async def no_account_available_exception_handler(request, exc: NoAccountAvailableException):
@@ -356,17 +566,29 @@ async def no_account_available_exception_handler(request, exc: NoAccountAvailabl
     )
 
 
+@app.exception_handler(NoPostcardAvailableException)
+async def no_postcard_available_exception_handler(request, exc: NoPostcardAvailableException):
+    return JSONResponse(
+        status_code=400,
+        content={"detail": str(exc)},
+    )
+
+
 @app.get("/api/status")
 def get_status():
-    return {"last_check": last_run, "last_submission": last_submission, "cache": cache}
+    return {"last_check": last_run, "last_submission": last_submission, "cache": cache, "probe": last_probe,
+            "account_cache": get_account_cache().stats(), "http": get_request_policy().state(),
+            "accounts": get_account_state().status()}
 
 
 @app.post("/api/send-postcard")
-def read_root():
-    global last_run, last_submission
+async def read_root():
+    global last_run, last_submission, cache
     last_run = datetime.now(local_tz)
-    pc.run_flow()
+    sent = await pc.run_flow()
     last_submission = datetime.now(local_tz)
+    # only the used account changed
+    cache = await make_cache([account for account in sent if account in scheduler])
 
     result = {
         "status": "OK"
@@ -374,6 +596,22 @@ def read_root():
     return result
 
 
+@app.post("/api/dispatch")
+async def dispatch():
+    global last_run, last_submission, cache
+    last_run = datetime.now(local_tz)
+    sent = await pc.dispatch()
+    if sent:
+        last_submission = datetime.now(local_tz)
+        cache = await make_cache([account for account in sent if account in scheduler])
+
+    return {
+        "status": "OK",
+        "sent": {pc.pool.get(account).name: status if not isinstance(status, Exception) else repr(status)
+                 for account, status in sent.items()},
+    }
+
+
 @app.get("/api/health")
 def health():
     return "OK"
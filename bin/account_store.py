@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Manage the account store (POSTCARD_ACCOUNT_STORE), keys are taken from ENC_KEY.
+
+    python bin/account_store.py import [--dir ACCOUNTS_DIR] [--overwrite]
+    python bin/account_store.py rotate
+    python bin/account_store.py list
+
+import identifies every token with the Post API (refreshing expired ones) and stores it under the account's
+e-mail address, tokens which can't be identified are skipped.
+
+To rotate the key prepend a new one, ENC_KEY=new,old, run rotate and then drop the old key.
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from postcard_creator.account_store import get_account_store
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['import', 'rotate', 'list'])
+    parser.add_argument('--dir', type=Path, default=os.getenv('ACCOUNTS_DIR'),
+                        help='directory with *-token.json.enc files (default: $ACCOUNTS_DIR)')
+    parser.add_argument('--overwrite', action='store_true', help='replace accounts which are already in the store')
+    args = parser.parse_args()
+
+    store = get_account_store()
+    if store is None:
+        parser.error('POSTCARD_ACCOUNT_STORE required')
+
+    if args.command == 'import':
+        if args.dir is None:
+            parser.error('--dir or ACCOUNTS_DIR required')
+        imported = store.import_files(args.dir, overwrite=args.overwrite)
+        print(f'imported {len(imported)} accounts into {store.path}')
+        for account_id in imported:
+            print(f'  {account_id}')
+    elif args.command == 'rotate':
+        print(f're-encrypted {store.rotate()} accounts')
+    else:
+        for account_id, account in sorted(store.load_all().items()):
+            print(f"{account_id}\t{account['name'] or ''}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+    sys.exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Load benchmark of the Post API client against the local fake server (postcard_creator/testing/fake_post_api.py).
+
+    python bin/bench_client.py client --op quota|user|upload [--async] [--concurrency N] [--requests N]
+    python bin/bench_client.py flow [--concurrency N] [--requests N] [--accounts N]
+
+Common options: --latency-ms MS (server side, per request), --error-rate R, --json.
+"client" drives PostcardCreatorSwissId (or AsyncPostcardCreatorSwissId) directly, "flow" runs
+PostcardFlow.run_flow of api.py against a throw-away queue and account directory.
+Reports throughput and latency percentiles.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _jpeg(width, height, color):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'jpeg', quality=85)
+    return buffer.getvalue()
+
+
+def _postcard(cover, text):
+    from postcard_creator.postcard_creator import Postcard, Recipient, Sender
+
+    person = dict(prename='Erika', lastname='Muster', street='Gasse 2', zip_code=3000, place='Bern')
+    return Postcard(sender=Sender(**person), recipient=Recipient(**person),
+                    picture_stream=io.BytesIO(cover), message_image_stream=io.BytesIO(text))
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def bench_client(args):
+    from postcard_creator.postcard_creator_swissid import PostcardCreatorSwissId
+    from postcard_creator.postcard_creator_swissid_async import AsyncPostcardCreatorSwissId
+    from postcard_creator.token import NoopToken
+
+    # upload-ready sizes, forwarded unchanged, we measure http and not rendering
+    cover, text = _jpeg(1819, 1311, 'teal'), _jpeg(720, 744, 'white')
+
+    def token(i):
+        return NoopToken(f'access-bench{i % args.accounts}')
+
+    def operation(client):
+        if args.op == 'quota':
+            return client.get_quota()
+        if args.op == 'user':
+            return client.get_user_info()
+        return client.send_free_card(_postcard(cover, text))
+
+    if not args.use_async:
+        def run(i):
+            start = time.perf_counter()
+            operation(PostcardCreatorSwissId(token(i)))
+            return time.perf_counter() - start
+
+        return _run_threads(run, args)
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def run(i):
+            async with semaphore:
+                start = time.perf_counter()
+                async with AsyncPostcardCreatorSwissId(token(i)) as client:
+                    await operation(client)
+                return time.perf_counter() - start
+
+        return await asyncio.gather(*[run(i) for i in range(args.requests)], return_exceptions=True)
+
+    return _split(asyncio.run(run_all()))
+
+
+def bench_flow(args):
+    from cryptography.fernet import Fernet
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        data_dir, postcard_dir, accounts_dir = tmp.joinpath('data'), tmp.joinpath('postcards'), tmp.joinpath('accounts')
+        for directory in (data_dir, postcard_dir, accounts_dir):
+            directory.mkdir()
+
+        key = Fernet.generate_key()
+        for i in range(args.accounts):
+            # named like EncTokenProvider stores them after a refresh, see FakePostApi /user/current
+            token = {'fetched_at': int(time.time()), 'expires_in': 3600, 'type': 'Bearer', 'token': None,
+                     'refresh_token': f'refresh-bench{i}', 'implementation': 'swissid'}
+            accounts_dir.joinpath(f'bench{i}_Fake-token.json.enc').write_bytes(
+                Fernet(key).encrypt(json.dumps(token).encode()))
+
+        cover, text = _jpeg(1819, 1311, 'teal'), _jpeg(720, 744, 'white')
+        for i in range(args.requests):
+            postcard_dir.joinpath(f'card{i:06d}_cover.jpeg').write_bytes(cover)
+            postcard_dir.joinpath(f'card{i:06d}_text.jpeg').write_bytes(text)
+
+        os.environ.update({'DATA_DIR': str(data_dir), 'POSTCARD_DIR': str(postcard_dir),
+                           'ACCOUNTS_DIR': str(accounts_dir), 'ENC_KEY': key.decode(), 'POSTCARD_MOCK': 'false',
+                           'RUN_QUEUE': 'false', 'RECIPIENT_PRENAME': 'Erika', 'RECIPIENT_LASTNAME': 'Muster',
+                           'RECIPIENT_STREET': 'Gasse 2', 'RECIPIENT_PLACE': 'Bern', 'RECIPIENT_ZIP_CODE': '3000'})
+        sys.path.insert(0, str(ROOT))
+        import api
+
+        async def run_all():
+            flows = [api.PostcardFlow() for _ in range(args.concurrency)]
+            remaining = iter(range(args.requests))
+            durations = []
+
+            async def worker(flow):
+                for _ in remaining:
+                    start = time.perf_counter()
+                    try:
+                        await flow.run_flow()
+                        durations.append(time.perf_counter() - start)
+                    except Exception as e:
+                        durations.append(e)
+
+            # XXX: run_flow prints a line for every mail it can't send, there is no smtp server here
+            with contextlib.redirect_stdout(io.StringIO()):
+                await asyncio.gather(*[worker(flow) for flow in flows])
+            return durations
+
+        return _split(asyncio.run(run_all()))
+
+
+def _run_threads(run, args):
+    def safe_run(i):
+        try:
+            return run(i)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        return _split(list(executor.map(safe_run, range(args.requests))))
+
+
+def _split(results):
+    durations = [r for r in results if not isinstance(r, BaseException)]
+    errors = [r for r in results if isinstance(r, BaseException)]
+    return durations, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', choices=['client', 'flow'])
+    parser.add_argument('--op', choices=['quota', 'user', 'upload'], default='quota')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='use AsyncPostcardCreatorSwissId')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--accounts', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--cache', action='store_true', help='keep the quota/user info cache enabled')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    from postcard_creator.testing.fake_post_api import FakePostApi
+    from postcard_creator import account_cache
+
+    if not args.cache:
+        account_cache.set_account_cache(account_cache.AccountCache({account_cache.QUOTA: 0,
+                                                                    account_cache.USER_INFO: 0}))
+
+    with FakePostApi(latency=args.latency_ms / 1000, error_rate=args.error_rate, free_cards=None, seed=1) as api:
+        os.environ['POSTCARD_API_BASE'] = api.url
+        start = time.perf_counter()
+        durations, errors = bench_client(args) if args.mode == 'client' else bench_flow(args)
+        elapsed = time.perf_counter() - start
+
+    report = {
+        'mode': args.mode,
+        'op': args.op if args.mode == 'client' else 'run_flow',
+        'async': args.use_async or args.mode == 'flow',
+        'concurrency': args.concurrency,
+        'requests': args.requests,
+        'errors': len(errors),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(durations) / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {f'p{p}': round(_percentile(durations, p) * 1000, 1) for p in (50, 90, 99)},
+        'server_requests': dict(api.requests),
+    }
+    report['latency_ms']['max'] = round(max(durations, default=0) * 1000, 1)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{report['mode']} {report['op']} async={report['async']} concurrency={args.concurrency} "
+              f"latency={args.latency_ms:g}ms error-rate={args.error_rate:g}")
+        print(f"{len(durations)} ok, {len(errors)} failed in {elapsed:.2f}s, {report['throughput']} ops/s")
+        print('latency ms: ' + '  '.join(f'{k} {v}' for k, v in report['latency_ms'].items()))
+        for name, count in sorted(api.requests.items()):
+            print(f'  {count:6d}  {name}')
+        if errors:
+            print(f'first error: {errors[0]!r}')
+    return 1 if errors and not args.error_rate else 0
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Benchmark full vs. reduced-resolution (draft) decoding of large phone photos in rotate_and_scale_image.
+
+Every measurement runs in a fresh interpreter so peak RSS is not polluted by earlier runs.
+
+    python bin/bench_decode.py [--corpus DIR] [--repeat N]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+CORPUS = {
+    '12MP': (4000, 3000),
+    '24MP': (6000, 4000),
+    '48MP': (8000, 6000),
+}
+MODES = ['full', 'draft']
+
+
+def make_corpus(directory: Path):
+    from PIL import Image, ImageFilter
+
+    directory.mkdir(parents=True, exist_ok=True)
+    files = {}
+    for name, (width, height) in CORPUS.items():
+        path = directory.joinpath(f'{name}.jpg')
+        if not path.is_file():
+            # noise with some structure, compresses roughly like a real photo
+            noise = Image.effect_noise((width // 4, height // 4), 64).filter(ImageFilter.GaussianBlur(2))
+            image = Image.merge('RGB', [noise, noise.rotate(180), noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)])
+            image.resize((width, height), Image.Resampling.BILINEAR).save(path, 'jpeg', quality=92)
+        files[name] = path
+    return files
+
+
+def run_worker(path, mode):
+    from postcard_creator import postcard_img_util
+
+    with open(path, 'rb') as f:
+        source = f.read()
+
+    start = time.perf_counter()
+    postcard_img_util._rotate_and_scale(source,
+                                        image_target_width=1819,
+                                        image_target_height=1311,
+                                        image_quality_factor=1,
+                                        image_rotate=True,
+                                        enforce_size=True,
+                                        fallback_color_fill=False,
+                                        img_format='jpeg',
+                                        draft_decode=mode == 'draft')
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({'seconds': elapsed, 'peak_rss': peak_rss()}))
+
+
+def peak_rss():
+    # ru_maxrss survives execve on linux and would include the parent's high-water mark, VmHWM does not
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(path, mode, repeat):
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, __file__, '--worker', str(path), mode],
+                             check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(out))
+    return min(r['seconds'] for r in runs), max(r['peak_rss'] for r in runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', type=Path, default=Path(tempfile.gettempdir()).joinpath('postcard_bench_corpus'))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--worker', nargs=2, metavar=('FILE', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return run_worker(*args.worker)
+
+    files = make_corpus(args.corpus)
+    print(f'{"image":<6} {"mode":<6} {"wall [s]":>9} {"peak RSS [MiB]":>15}')
+    for name, path in files.items():
+        for mode in MODES:
+            seconds, peak_rss = measure(path, mode, args.repeat)
+            print(f'{name:<6} {mode:<6} {seconds:>9.3f} {peak_rss / 2 ** 20:>15.1f}')
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+    main()
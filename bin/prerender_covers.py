@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Render all missing or outdated covers in POSTCARD_DIR so the queue is ready to send.
+
+    python bin/prerender_covers.py [--dir POSTCARD_DIR] [--workers N] [--memory-limit-mb MB] [--force]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from postcard_creator.postcard_img_util import prerender_covers
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', type=Path, default=os.getenv('POSTCARD_DIR'),
+                        help='directory with source images (default: $POSTCARD_DIR)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: cpu count)')
+    parser.add_argument('--memory-limit-mb', type=int, default=None, help='address space limit per worker')
+    parser.add_argument('--max-tasks-per-child', type=int, default=8, help='recycle workers after N renders')
+    parser.add_argument('--force', action='store_true', help='render covers even if they are up to date')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.dir is None:
+        parser.error('--dir or POSTCARD_DIR required')
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(name)s (%(levelname)s): %(message)s')
+
+    start = time.perf_counter()
+    results = prerender_covers(args.dir,
+                               workers=args.workers,
+                               max_tasks_per_child=args.max_tasks_per_child,
+                               memory_limit_bytes=args.memory_limit_mb * 2 ** 20 if args.memory_limit_mb else None,
+                               force=args.force)
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    for result in sorted(results, key=lambda r: str(r['file'])):
+        if result['error']:
+            failed += 1
+            print(f"FAIL  {result['file']}: {result['error']}")
+        else:
+            settings = result['settings'] or {}
+            print(f"{result['seconds']:6.2f}s  {result['cover']}  "
+                  f"q={settings.get('quality')} {settings.get('subsampling')} {settings.get('bytes', '')}")
+
+    print(f'{len(results) - failed} covers rendered, {failed} failed, {elapsed:.2f}s total')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+    sys.exit(main())
@@ -5,9 +5,10 @@ import streamlit as st
 
 from postcard_creator import helper
 from postcard_creator.helper import list_complete_postcards
+from postcard_creator.thumbnails import get_thumbnail_store, SIZE_SMALL
 
 POSTCARD_DIR = Path(os.getenv("POSTCARD_DIR"))
-ALLOWED_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif']
+ALLOWED_EXTENSIONS = helper.SOURCE_EXTENSIONS
 
 
 def select_postcard():
@@ -16,8 +17,13 @@ def select_postcard():
     uploaded_file = st.file_uploader("Choose a file", type=ALLOWED_EXTENSIONS)
     if uploaded_file is not None:
         file_path = POSTCARD_DIR.joinpath(uploaded_file.name)
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getvalue())
+        data = uploaded_file.getvalue()
+        # uploader keeps its value across reruns, do not touch (and invalidate) the file again unless the content
+        # changed. The size alone misses a new photo of the same name and size.
+        if not file_path.is_file() or file_path.read_bytes() != data:
+            with open(file_path, "wb") as f:
+                f.write(data)
+            get_thumbnail_store().generate(file_path)
         st.success("Uploaded successfully!")
 
     st.header("Current Statistics")
@@ -42,45 +48,34 @@ def select_postcard():
         st.write("No postcards available.")
         return
 
+    thumbnails = get_thumbnail_store()
+
     # Display each postcard horizontally
     for postcard in postcards:
         # Create a row for each postcard
         with st.container():
             cols = st.columns([2, 2, 1])  # Adjust ratio based on your preference for spacing
 
-            cols[0].image(str(postcard), use_column_width=True)
+            cols[0].image(str(thumbnails.thumbnail(postcard, SIZE_SMALL)), use_column_width=True)
 
             # Check for message image
             image_message = helper.filename_text(postcard)
             if image_message.is_file():
-                cols[1].image(str(image_message), use_column_width=True)
+                cols[1].image(str(thumbnails.thumbnail(image_message, SIZE_SMALL)), use_column_width=True)
 
             # Button to select the postcard
             if cols[2].button(f"Bearbeiten", key=postcard.name):
                 st.session_state.selected_postcard = postcard
                 st.switch_page("pages/02_edit_postcard.py")
 
+            # Full resolution only on demand
+            if cols[2].checkbox("Original", key=f"original_{postcard.name}"):
+                st.image(str(postcard), use_column_width=True)
+
 
 def list_postcards():
     """List all image postcards in the postcards directory."""
-    # List all image files, primarily focusing on common formats
-    postcards = []
-    exclusions = [
-        helper.is_text,
-        helper.is_cover,
-        helper.is_stamp,
-    ]
-
-    for file in POSTCARD_DIR.iterdir():
-        if file.suffix.lower() not in ALLOWED_EXTENSIONS:
-            continue
-
-        if helper.is_generated_image(file):
-            continue
-
-        postcards.append(file)
-
-    return postcards
+    return helper.list_source_images(POSTCARD_DIR)
 
 
 select_postcard()
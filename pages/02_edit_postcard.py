@@ -12,6 +12,7 @@ from streamlit_drawable_canvas import st_canvas
 
 from postcard_creator import helper
 from postcard_creator import postcard_img_util
+from postcard_creator.thumbnails import get_thumbnail_store, SIZE_MEDIUM
 
 # logging.getLogger('postcard_creator.postcard_creator').setLevel(logging.DEBUG)
 load_dotenv()
@@ -125,9 +126,10 @@ initial_drawing = helper.maybe_load_data(data_path)
 st.header("Vorderseite")
 
 image_cover = postcard_img_util.make_cover_image(selected_postcard)
-image_cover_path.write_bytes(image_cover)
+if not image_cover_path.is_file() or image_cover_path.read_bytes() != image_cover:
+    image_cover_path.write_bytes(image_cover)
 
-st.image(str(image_cover_path))
+st.image(str(get_thumbnail_store().thumbnail(image_cover_path, SIZE_MEDIUM)))
 
 canvas_result = ask_chatgpt()
 
@@ -149,4 +151,5 @@ if canvas_result:
         st.success("Drawing data saved.")
         img = Image.fromarray(canvas_result.image_data.astype('uint8'), 'RGBA')
         img.convert("RGB").save(image_message_path, format="jpeg")
+        get_thumbnail_store().generate(image_message_path)
         st.success("Canvas saved as JPEG.")
@@ -1,8 +1,10 @@
 import os
+from datetime import datetime
 from pathlib import Path
 
 import streamlit as st
 
+from postcard_creator.account_state import get_account_state
 from postcard_creator.enc_token_provider import EncTokenProvider
 
 ACCOUNTS_DIR = Path(os.getenv("ACCOUNTS_DIR"))
@@ -21,19 +23,38 @@ def get_token_manager() -> EncTokenProvider:
 st.header('Saved Tokens')
 
 token_mngt = get_token_manager()
-tokens = token_mngt.list_tokens()
-token_names = [None] + [token.name for token in tokens]
+tokens = {token_mngt.account_name(token): token for token in token_mngt.list_tokens()}
+token_names = [None] + list(tokens)
 
-selected_token = st.selectbox('Select a token to refresh', token_names)
+selected_token = st.selectbox('Select a token to refresh', token_names,
+                              format_func=lambda name: '' if name is None else token_mngt.display_name(tokens[name]))
 
 if selected_token:
-    token_file = ACCOUNTS_DIR.joinpath(selected_token)
-    token_mngt.decrypt_token(token_file)
-    token_mngt.maybe_refresh_token()
-
-    w = token_mngt.postcard_creator
-    st.write(w.get_quota())
-    st.write(w.get_user_info())
+    state = get_account_state()
+    state.load()
+    snapshot = state.get(selected_token)
+
+    # XXX: the saved state is shown right away, the Post API is only asked for accounts without one or on demand
+    if not snapshot or st.button('Refresh from Post API'):
+        token_mngt.decrypt_token(tokens[selected_token])
+        try:
+            token_mngt.maybe_refresh_token()
+            w = token_mngt.postcard_creator
+            state.update(selected_token, user_info=w.get_user_info(),
+                         refreshed_at=token_mngt.token_data.get('fetched_at'))
+            state.record_probe(selected_token, quota=w.get_quota())
+        except Exception as e:
+            state.record_probe(selected_token, error=e)
+            st.error(f'Refresh failed: {e}')
+        state.save()
+        snapshot = state.get(selected_token)
+
+    if snapshot.get('probed_at'):
+        st.caption(f"as of {datetime.fromtimestamp(snapshot['probed_at']):%Y-%m-%d %H:%M:%S}")
+    if snapshot.get('error'):
+        st.warning(snapshot['error'])
+    st.write(snapshot.get('quota'))
+    st.write(snapshot.get('user_info'))
 
 st.title('Login App')
 
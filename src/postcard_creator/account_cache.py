@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+QUOTA = 'quota'
+USER_INFO = 'user_info'
+
+DEFAULT_TTLS = {
+    QUOTA: 60,
+    USER_INFO: 60 * 60,
+}
+
+
+def account_key(token):
+    """
+    Identity of the account behind a token, the access token itself changes with every refresh
+    """
+    return getattr(token, 'account_id', None) or token.token
+
+
+class AccountCache(object):
+    """
+    Per-account TTL cache for /user/quota and /user/current responses
+    """
+
+    def __init__(self, ttls: dict | None = None, clock=time.monotonic):
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.clock = clock
+        self.hits = {kind: 0 for kind in self.ttls}
+        self.misses = {kind: 0 for kind in self.ttls}
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, account, kind):
+        """
+        Cached value or None if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get((account, kind))
+            if entry is not None and entry[0] > self.clock():
+                self.hits[kind] += 1
+                return dict(entry[1])
+            self.misses[kind] += 1
+            return None
+
+    def put(self, account, kind, value: dict):
+        ttl = self.ttls[kind]
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[(account, kind)] = (self.clock() + ttl, dict(value))
+
+    def invalidate(self, account, kind=None):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == account and kind in (None, key[1])]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {kind: {'hits': self.hits[kind], 'misses': self.misses[kind]} for kind in self.ttls}
+
+
+_account_cache: AccountCache | None = None
+_account_cache_lock = threading.Lock()
+
+
+def get_account_cache() -> AccountCache:
+    """
+    Process wide cache, TTLs in seconds can be set with POSTCARD_QUOTA_TTL and POSTCARD_USER_INFO_TTL (0 disables)
+    """
+    global _account_cache
+    with _account_cache_lock:
+        if _account_cache is None:
+            _account_cache = AccountCache({
+                QUOTA: float(os.getenv('POSTCARD_QUOTA_TTL', DEFAULT_TTLS[QUOTA])),
+                USER_INFO: float(os.getenv('POSTCARD_USER_INFO_TTL', DEFAULT_TTLS[USER_INFO])),
+            })
+        return _account_cache
+
+
+def set_account_cache(cache: AccountCache | None):
+    global _account_cache
+    with _account_cache_lock:
+        _account_cache = cache
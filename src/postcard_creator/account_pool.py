@@ -0,0 +1,233 @@
+import asyncio
+import os
+import threading
+import time
+from pathlib import Path
+
+from postcard_creator.enc_token_provider import EncTokenProvider
+from postcard_creator.postcard_creator import logger
+from postcard_creator.token_refresh import needs_refresh
+
+
+class Account(object):
+    """
+    Long-lived token and clients of one account. Use it only while holding a lease of AccountPool.
+    """
+
+    def __init__(self, ref, accounts_location: Path):
+        self.ref = ref
+        self.provider = EncTokenProvider(accounts_location)
+        self.name = self.provider.account_name(ref)
+        self.quota: dict | None = None
+
+    @property
+    def client(self):
+        return self.provider.async_postcard_creator
+
+    @property
+    def sync_client(self):
+        return self.provider.postcard_creator
+
+    def _is_current(self, client):
+        # XXX: the vault only decrypts again if the file changed, e.g. refreshed by another process
+        token = self.provider.token.token
+        self.provider.decrypt_token(self.ref)
+        return self._still_valid(client, token)
+
+    async def _is_current_async(self, client):
+        # file or database I/O and decryption, off the event loop
+        token = self.provider.token.token
+        await asyncio.to_thread(self.provider.decrypt_token, self.ref)
+        return self._still_valid(client, token)
+
+    def _still_valid(self, client, token):
+        token_data = self.provider.token_data
+        return client is not None and token_data.get('token') == token and not needs_refresh(token_data)
+
+    async def prepare_async(self):
+        """
+        Client with a valid token, refreshed if needed. The client is kept as long as the token.
+        """
+        if not await self._is_current_async(self.client):
+            await self.provider.maybe_refresh_token_async()
+        return self.client
+
+    def prepare(self):
+        if not self._is_current(self.sync_client):
+            self.provider.maybe_refresh_token()
+        return self.sync_client
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+
+class AccountLease(object):
+    """
+    Exclusive use of an account until released, as (async) context manager or with release()
+    """
+
+    def __init__(self, pool, account: Account):
+        self.pool = pool
+        self.account = account
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.pool._release(self.account)
+
+    def __enter__(self):
+        return self.account
+
+    def __exit__(self, *args):
+        self.release()
+
+    async def __aenter__(self):
+        return self.account
+
+    async def __aexit__(self, *args):
+        self.release()
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AccountPool(object):
+    """
+    One Account per stored token, handed out by leases so no two callers use an account at the same time.
+    Safe to use from threads and event loops.
+    """
+
+    def __init__(self, accounts_location: Path):
+        self.accounts_location = accounts_location
+        self._accounts = {}
+        self._leased = set()
+        self._waiters = {}
+        self._lock = threading.Lock()
+
+    def refs(self):
+        """
+        Accounts as listed by EncTokenProvider.list_tokens
+        """
+        return EncTokenProvider(self.accounts_location).list_tokens()
+
+    def get(self, ref) -> Account:
+        with self._lock:
+            return self._get(ref)
+
+    def _get(self, ref):
+        if ref not in self._accounts:
+            self._accounts[ref] = Account(ref, self.accounts_location)
+        return self._accounts[ref]
+
+    def leased(self):
+        with self._lock:
+            return set(self._leased)
+
+    def _try_lease(self, ref):
+        if ref in self._leased:
+            return None
+        self._leased.add(ref)
+        return AccountLease(self, self._get(ref))
+
+    def try_lease(self, ref) -> AccountLease | None:
+        """
+        Lease ref if it is not in use, None otherwise
+        """
+        with self._lock:
+            return self._try_lease(ref)
+
+    def lease(self, ref, timeout=None) -> AccountLease:
+        """
+        Lease ref, wait up to timeout seconds (None: forever) for the current lease to be released
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                lease = self._try_lease(ref)
+                if lease is not None:
+                    return lease
+                event = threading.Event()
+                self._waiters.setdefault(ref, []).append(event.set)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if (remaining is not None and remaining <= 0) or not event.wait(remaining):
+                raise TimeoutError(f'account {ref} is in use')
+
+    async def lease_async(self, ref, timeout=None) -> AccountLease:
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self._lock:
+                lease = self._try_lease(ref)
+                if lease is not None:
+                    return lease
+                future = loop.create_future()
+                self._waiters.setdefault(ref, []).append(lambda: loop.call_soon_threadsafe(_wake, future))
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                # the lease is taken synchronously above, a timeout or cancel here never leaks one
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f'account {ref} is in use')
+
+    async def lease_any_async(self, refs, timeout=None) -> AccountLease:
+        """
+        Lease whichever of refs is released first
+        """
+        tasks = [asyncio.ensure_future(self.lease_async(ref, timeout)) for ref in refs]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+        # XXX: more than one may have been leased before we cancelled, keep the first and give back the others
+        leases = [task.result() for task in tasks if task.done() and not task.cancelled() and not task.exception()]
+        for lease in leases[1:]:
+            lease.release()
+        if not leases:
+            raise next(task.exception() for task in done if not task.cancelled())
+        return leases[0]
+
+    def _release(self, account: Account):
+        with self._lock:
+            self._leased.discard(account.ref)
+            waiters = self._waiters.pop(account.ref, [])
+        for wake in waiters:
+            try:
+                wake()
+            except RuntimeError:
+                # event loop of the waiter is closed
+                pass
+
+    async def aclose(self):
+        with self._lock:
+            accounts = list(self._accounts.values())
+        for account in accounts:
+            try:
+                await account.aclose()
+            except Exception as e:
+                logger.info(f'closing client of {account.name} failed: {e}')
+
+
+_account_pool: AccountPool | None = None
+_account_pool_lock = threading.Lock()
+
+
+def get_account_pool() -> AccountPool:
+    """
+    Process wide pool of the accounts in ACCOUNTS_DIR (or POSTCARD_ACCOUNT_STORE)
+    """
+    global _account_pool
+    with _account_pool_lock:
+        if _account_pool is None:
+            _account_pool = AccountPool(Path(os.getenv('ACCOUNTS_DIR')))
+        return _account_pool
+
+
+def set_account_pool(pool: AccountPool | None):
+    global _account_pool
+    with _account_pool_lock:
+        _account_pool = pool
@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from postcard_creator.postcard_creator import logger
+
+STATE_FILE_NAME = 'account_state.json'
+# fields of an account which may be shown without authentication, e.g. by /api/status
+STATUS_FIELDS = ('quota', 'next', 'probed_at', 'error')
+
+
+class AccountState(object):
+    """
+    Last known metadata of every account (user info, quota, refresh and probe times, last error), saved to a
+    JSON file so a restart can show and schedule accounts before they have been probed again. No secrets.
+    """
+
+    def __init__(self, path: Path | None = None, clock=time.time):
+        self.path = Path(path) if path else None
+        self.clock = clock
+        self._accounts = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def _read(self):
+        if self.path is None or not self.path.is_file():
+            return {}
+        try:
+            return json.loads(self.path.read_text())
+        except ValueError as e:
+            logger.warning(f'ignoring unreadable account state {self.path}: {e}')
+            return {}
+
+    def _merge(self, accounts: dict):
+        # XXX: the api and the streamlit app share the file, the more recently probed record of an account wins
+        for name, record in accounts.items():
+            mine = self._accounts.get(name)
+            if mine is None or (record.get('probed_at') or 0) > (mine.get('probed_at') or 0):
+                self._accounts[name] = record
+
+    def load(self):
+        """
+        Merge the saved state, e.g. written by another process
+        """
+        accounts = self._read()
+        with self._lock:
+            self._merge(accounts)
+
+    def get(self, name) -> dict:
+        with self._lock:
+            return dict(self._accounts.get(name, {}))
+
+    def all(self) -> dict:
+        with self._lock:
+            return {name: dict(record) for name, record in self._accounts.items()}
+
+    def status(self) -> dict:
+        """
+        Like all, limited to STATUS_FIELDS. No user info (name, address, e-mail).
+        """
+        with self._lock:
+            return {name: {field: record.get(field) for field in STATUS_FIELDS}
+                    for name, record in self._accounts.items()}
+
+    def update(self, name, **fields):
+        with self._lock:
+            self._accounts.setdefault(name, {}).update(fields)
+
+    def record_probe(self, name, quota: dict | None = None, error: BaseException | None = None):
+        fields = {'probed_at': self.clock(), 'error': None if error is None else repr(error)}
+        if quota is not None:
+            fields.update(quota=quota, next=quota.get('next'))
+        self.update(name, **fields)
+
+    def save(self):
+        """
+        Write the state atomically, a crash leaves the previous snapshot
+        """
+        if self.path is None:
+            return
+        accounts = self._read()
+        with self._lock:
+            self._merge(accounts)
+            data = json.dumps(self._accounts, indent=2)
+        tmp = self.path.with_name(f'.{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp.write_text(data)
+        os.replace(tmp, self.path)
+
+
+_account_state: AccountState | None = None
+_account_state_lock = threading.Lock()
+
+
+def get_account_state() -> AccountState:
+    """
+    Process wide state, saved to POSTCARD_STATE_FILE or DATA_DIR/account_state.json (in memory if neither is set)
+    """
+    global _account_state
+    with _account_state_lock:
+        if _account_state is None:
+            path = os.getenv('POSTCARD_STATE_FILE')
+            if not path and os.getenv('DATA_DIR'):
+                path = Path(os.getenv('DATA_DIR')).joinpath(STATE_FILE_NAME)
+            _account_state = AccountState(path)
+        return _account_state
+
+
+def set_account_state(state: AccountState | None):
+    global _account_state
+    with _account_state_lock:
+        _account_state = state
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+from postcard_creator.postcard_creator import PostcardCreator, PostcardCreatorException, logger
+from postcard_creator.token import Token
+from postcard_creator.token_refresh import needs_refresh
+from postcard_creator.token_vault import make_cipher
+
+TOKEN_FILE_SUFFIX = '-token.json.enc'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS accounts (
+    account_id TEXT PRIMARY KEY,
+    name TEXT,
+    token BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+'''
+
+
+def account_id_for(user_info: dict, salt: bytes) -> str:
+    """
+    Stable, opaque id of a logged in account: a salted hash of its e-mail address, so ids can be shown
+    (e.g. /api/status) without giving the address away. Names are not unique, an account without e-mail
+    address is refused rather than risking to overwrite another account of the same name.
+    """
+    email = (user_info.get('email') or '').strip().lower()
+    if not email:
+        raise PostcardCreatorException(f"account {user_info.get('firstName')} {user_info.get('name')} has no "
+                                       f"e-mail address, can't tell it apart from other accounts")
+    return hashlib.sha256(salt + email.encode('utf-8')).hexdigest()[:16]
+
+
+def identify_token(token: dict):
+    """
+    (user_info, token) of a stored token, refreshed first if it has expired
+    """
+    t = Token()
+    t.load_json(token)
+    if needs_refresh(token, 0):
+        t.fetch_token_by_refresh_token(token['refresh_token'], lambda access_token, t: True)
+        token = t.to_json()
+    return PostcardCreator(t).get_user_info(), token
+
+
+class AccountStore(object):
+    """
+    All accounts in one SQLite file, tokens encrypted with ENC_KEY (see token_vault.make_cipher).
+    Every write is a transaction, all accounts are loaded with one query and kept in memory
+    until the database file changes.
+    """
+
+    def __init__(self, path: Path, keys: str | bytes):
+        self.path = Path(path)
+        self._cipher = make_cipher(keys)
+        self._lock = threading.Lock()
+        self._accounts = None
+        self._stat = None
+        self.loads = 0
+        with closing(self._connect()) as connection, connection:
+            connection.executescript(_SCHEMA)
+            # the first process creating the store picks the salt of the account ids
+            connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('salt', ?)", (os.urandom(16),))
+            self._salt = connection.execute("SELECT value FROM meta WHERE key = 'salt'").fetchone()[0]
+            # XXX: stores written before the ids were hashed are keyed by e-mail address
+            rows = connection.execute("SELECT account_id FROM accounts WHERE account_id LIKE '%@%'").fetchall()
+            connection.executemany('UPDATE accounts SET account_id = ? WHERE account_id = ?',
+                                   [(account_id_for({'email': email}, self._salt), email) for email, in rows])
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _file_stat(self):
+        stat = self.path.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def load_all(self) -> dict:
+        """
+        account_id -> {'name': ..., 'token': Token.to_json()} of all accounts
+        """
+        with self._lock:
+            if self._accounts is None or self._stat != self._file_stat():
+                stat = self._file_stat()
+                with closing(self._connect()) as connection:
+                    rows = connection.execute('SELECT account_id, name, token FROM accounts').fetchall()
+                self._accounts = {account_id: {'name': name, 'token': json.loads(self._cipher.decrypt(token))}
+                                  for account_id, name, token in rows}
+                self._stat = stat
+                self.loads += 1
+            return {account_id: {'name': entry['name'], 'token': dict(entry['token'])}
+                    for account_id, entry in self._accounts.items()}
+
+    def account_id(self, user_info: dict) -> str:
+        return account_id_for(user_info, self._salt)
+
+    def account_ids(self):
+        return sorted(self.load_all())
+
+    def get(self, account_id: str) -> dict:
+        """
+        Token of account_id, KeyError if there is no such account
+        """
+        return self.load_all()[account_id]['token']
+
+    def put(self, account_id: str, token: dict, name: str | None = None):
+        cipher_text = self._cipher.encrypt(json.dumps(token).encode())
+        with self._lock, closing(self._connect()) as connection, connection:
+            connection.execute('INSERT INTO accounts (account_id, name, token, updated_at) VALUES (?, ?, ?, ?) '
+                               'ON CONFLICT(account_id) DO UPDATE SET token = excluded.token, '
+                               'name = COALESCE(excluded.name, accounts.name), updated_at = excluded.updated_at',
+                               (account_id, name, cipher_text, time.time()))
+            self._accounts = None
+
+    def delete(self, account_id: str):
+        with self._lock, closing(self._connect()) as connection, connection:
+            connection.execute('DELETE FROM accounts WHERE account_id = ?', (account_id,))
+            self._accounts = None
+
+    def rotate(self):
+        """
+        Re-encrypt all tokens with the first key, afterwards the old keys can be removed from ENC_KEY
+        """
+        with self._lock, closing(self._connect()) as connection, connection:
+            rows = connection.execute('SELECT account_id, token FROM accounts').fetchall()
+            connection.executemany('UPDATE accounts SET token = ? WHERE account_id = ?',
+                                   [(self._cipher.rotate(token), account_id) for account_id, token in rows])
+            self._accounts = None
+        return len(rows)
+
+    def import_files(self, accounts_dir: Path, overwrite=False, identify=identify_token):
+        """
+        Import the per-file tokens (*-token.json.enc) of EncTokenProvider. File names are not unique, every
+        token is identified with identify (default: /user/current) and stored under account_id.
+        Returns the imported account ids, the files are left in place. Files which can't be decrypted (e.g. with
+        another key) or identified are skipped and logged.
+        """
+        existing = self.load_all()
+        imported = {}
+        for file in sorted(Path(accounts_dir).glob('*' + TOKEN_FILE_SUFFIX)):
+            try:
+                token = json.loads(self._cipher.decrypt(file.read_bytes()))
+                user_info, token = identify(token)
+                account_id = self.account_id(user_info)
+            except Exception as e:
+                logger.warning(f'skipping {file.name}: {e}')
+                continue
+            if account_id in existing and not overwrite:
+                continue
+            if account_id in imported:
+                # the same account logged in twice under different file names, keep the newer token
+                logger.warning(f'{file.name} is {account_id} as well, keeping the newer token')
+                if (imported[account_id][1].get('fetched_at') or 0) >= (token.get('fetched_at') or 0):
+                    continue
+            imported[account_id] = (f"{user_info['firstName']} {user_info['name']}", token)
+
+        rows = [(account_id, name, self._cipher.encrypt(json.dumps(token).encode()), time.time())
+                for account_id, (name, token) in imported.items()]
+        with self._lock, closing(self._connect()) as connection, connection:
+            connection.executemany('INSERT OR REPLACE INTO accounts (account_id, name, token, updated_at) '
+                                   'VALUES (?, ?, ?, ?)', rows)
+            self._accounts = None
+        return sorted(imported)
+
+
+_account_store: AccountStore | None = None
+_account_store_lock = threading.Lock()
+
+
+def get_account_store() -> AccountStore | None:
+    """
+    Store at POSTCARD_ACCOUNT_STORE (path of the database), None if unset and per-file tokens are used
+    """
+    global _account_store
+    with _account_store_lock:
+        if _account_store is None and os.getenv('POSTCARD_ACCOUNT_STORE'):
+            _account_store = AccountStore(Path(os.getenv('POSTCARD_ACCOUNT_STORE')), os.getenv('ENC_KEY'))
+        return _account_store
+
+
+def set_account_store(store: AccountStore | None):
+    global _account_store
+    with _account_store_lock:
+        _account_store = store
@@ -1,23 +1,50 @@
-import json
-import os
-from datetime import datetime
+import asyncio
 from pathlib import Path
 
-from cryptography.fernet import Fernet
-
-from postcard_creator.postcard_creator import PostcardCreator
+from postcard_creator.account_store import AccountStore, get_account_store
+from postcard_creator.postcard_creator import PostcardCreator, logger
+from postcard_creator.postcard_creator_swissid_async import AsyncPostcardCreatorSwissId
 from postcard_creator.token import Token
+from postcard_creator.token_refresh import flights, needs_refresh
+from postcard_creator.token_vault import TokenVault, get_token_vault
 
 
 class EncTokenProvider:
-    def __init__(self, accounts_location: Path):
+    def __init__(self, accounts_location: Path, vault: TokenVault | None = None, store: AccountStore | None = None):
         self.ACCOUNTS_DIR = accounts_location
+        self.vault = vault
+        # XXX: with an account store (POSTCARD_ACCOUNT_STORE) accounts are account ids instead of token files
+        self.store = store or get_account_store()
         self.token: Token = Token()
         self.postcard_creator: PostcardCreator = None
+        self.async_postcard_creator: AsyncPostcardCreatorSwissId = None
+        self.token_file: Path | str | None = None
+        self._refresh_target: Path | str | None = None
 
     def list_tokens(self):
+        if self.store is not None:
+            return self.store.account_ids()
         return [f for f in self.ACCOUNTS_DIR.glob('*-token.json.enc')]
 
+    def account_name(self, account) -> str:
+        return account if self.store is not None else Path(account).name
+
+    def display_name(self, account) -> str:
+        """
+        Name of the person for the UI, account_name is an opaque id with an account store
+        """
+        if self.store is not None:
+            return self.store.load_all().get(account, {}).get('name') or account
+        return self.account_name(account)
+
+    def _token_path(self, user_info: dict) -> Path | str:
+        # XXX: a refreshed token replaces the account it was read from, a new login is named after the user
+        if self._refresh_target is not None:
+            return self._refresh_target
+        if self.store is not None:
+            return self.store.account_id(user_info)
+        return self.ACCOUNTS_DIR.joinpath(f"{user_info['firstName']}_{user_info['name']}-token.json.enc")
+
     def on_access_token_received(self, access_token: dict, token: Token):
         self.token = token
         self.postcard_creator = PostcardCreator(self.token)
@@ -25,40 +52,127 @@ class EncTokenProvider:
         user_info: dict = self.postcard_creator.get_user_info()
 
         if user_info:
-            filename = f"{user_info['firstName']}_{user_info['name']}"
-            self.encrypt_and_store_token(token.to_json(), filename)
+            self._store_token(token.to_json(), self._token_path(user_info), self._user_name(user_info))
             return True
         else:
             return False
 
-    def decrypt_token(self, file_path: Path):
-        key = os.getenv("ENC_KEY").encode()
-        cipher_suite = Fernet(key)
+    async def on_access_token_received_async(self, access_token: dict, token: Token):
+        if self.async_postcard_creator is not None:
+            await self.async_postcard_creator.aclose()
+        self.token = token
+        self.async_postcard_creator = AsyncPostcardCreatorSwissId(self.token)
 
-        with open(file_path, 'rb') as token_file:
-            cipher_text = token_file.read()
-            plain_text = cipher_suite.decrypt(cipher_text)
-            self.token_data = json.loads(plain_text)
+        user_info: dict = await self.async_postcard_creator.get_user_info()
 
-    def encrypt_and_store_token(self, token: str, filename: str):
-        key = os.getenv("ENC_KEY")
-        cipher_suite = Fernet(key)
-        cipher_text = cipher_suite.encrypt(json.dumps(token).encode())
+        if user_info:
+            await asyncio.to_thread(self._store_token, token.to_json(), self._token_path(user_info),
+                                    self._user_name(user_info))
+            return True
+        else:
+            return False
 
-        full_file_name = self.ACCOUNTS_DIR.joinpath(f'{filename}-token.json.enc')
+    def decrypt_token(self, file_path: Path | str):
+        """
+        Load the token of an account of list_tokens
+        """
+        self.token_file = file_path if self.store is not None else Path(file_path)
+        self.token_data = self._read_token(self.token_file)
+        self.token.account_id = self.account_name(file_path)
 
-        with open(full_file_name, 'wb') as token_file:
-            token_file.write(cipher_text)
+    def _read_token(self, file_path: Path | str) -> dict:
+        if self.store is not None:
+            return self.store.get(file_path)
+        return (self.vault or get_token_vault()).get(file_path)
 
-    def maybe_refresh_token(self):
-        now = datetime.now().timestamp()
-        fetched_at = self.token_data['fetched_at']
-        expires_in = self.token_data['expires_in']
+    def encrypt_and_store_token(self, token: str, filename: str):
+        if self.store is not None:
+            self._store_token(token, filename)
+        else:
+            self._store_token(token, self.ACCOUNTS_DIR.joinpath(f'{filename}-token.json.enc'))
+
+    def _store_token(self, token: dict, full_file_name: Path | str, name: str | None = None):
+        if self.store is not None:
+            self.store.put(full_file_name, token, name)
+        else:
+            (self.vault or get_token_vault()).put(full_file_name, token)
 
-        # if fetched_at + expires_in < now:
-        if True:
-            refresh_token = self.token_data['refresh_token']
-            self.token.fetch_token_by_refresh_token(refresh_token, self.on_access_token_received)
+    @staticmethod
+    def _user_name(user_info: dict):
+        return f"{user_info['firstName']} {user_info['name']}"
+
+    def _use_token_data(self):
+        self.token.load_json(self.token_data)
+        self.postcard_creator = PostcardCreator(self.token)
+        self.async_postcard_creator = AsyncPostcardCreatorSwissId(self.token)
+
+    def maybe_refresh_token(self, skew=None):
+        """
+        Refresh the decrypted token if it expires within skew seconds (POSTCARD_TOKEN_REFRESH_SKEW),
+        concurrent refreshes of the same account share one round trip
+        """
+        if needs_refresh(self.token_data, skew):
+            self.token_data = flights.run(self._flight_key(), lambda: self._refresh(skew))
+        self._use_token_data()
+
+    async def maybe_refresh_token_async(self, skew=None):
+        if needs_refresh(self.token_data, skew):
+            self.token_data = await flights.run_async(self._flight_key(), lambda: self._refresh_async(skew))
+        if self.async_postcard_creator is not None:
+            await self.async_postcard_creator.aclose()
+        self._use_token_data()
+
+    def _flight_key(self):
+        if self.store is not None and self.token_file:
+            return f'{self.store.path.resolve()}#{self.token_file}'
+        return str(self.token_file.resolve()) if self.token_file else self.token_data['refresh_token']
+
+    def _refresh(self, skew):
+        # another flight may have refreshed and stored the token since we read it
+        token_data = self._read_token(self.token_file) if self.token_file else self.token_data
+        if not needs_refresh(token_data, skew):
+            return token_data
+
+        self._refresh_target = self.token_file
+        try:
+            self.token.fetch_token_by_refresh_token(token_data['refresh_token'], self.on_access_token_received)
+        finally:
+            self._refresh_target = None
+        logger.info(f'refreshed token {self.token.account_id}')
+        return self.token.to_json()
+
+    async def _refresh_async(self, skew):
+        if self.token_file:
+            token_data = await asyncio.to_thread(self._read_token, self.token_file)
+        else:
+            token_data = self.token_data
+        if not needs_refresh(token_data, skew):
+            return token_data
+
+        self._refresh_target = self.token_file
+        try:
+            await self.token.fetch_token_by_refresh_token_async(token_data['refresh_token'],
+                                                                self.on_access_token_received_async)
+        finally:
+            self._refresh_target = None
+        logger.info(f'refreshed token {self.token.account_id}')
+        return self.token.to_json()
+
+    async def refresh_expiring_async(self, window):
+        """
+        Refresh all stored tokens which expire within window seconds, e.g. from a background task so sending
+        never has to wait for a refresh. Returns the number of refreshed tokens.
+        """
+        refreshed = 0
+        for file in self.list_tokens():
+            try:
+                self.decrypt_token(file)
+                if needs_refresh(self.token_data, window):
+                    await self.maybe_refresh_token_async(skew=window)
+                    refreshed += 1
+            except Exception as e:
+                logger.info(f'pre-refresh of {self.account_name(file)} failed: {e}')
+        return refreshed
 
     def authenticate_username_password(self, username, password):
         self.token.authenticate_username_password(username, password)
@@ -7,6 +7,7 @@ SUFFIX_DATA = "_data"
 
 image_stem_suffix = [SUFFIX_COVER, SUFFIX_TEXT, SUFFIX_STAMP]
 IMAGE_EXTENSION = ".jpeg"
+SOURCE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif']
 
 
 def filename_cover(file: Path) -> Path:
@@ -57,6 +58,29 @@ def is_generated_image(file: Path) -> bool:
     return False
 
 
+def list_source_images(image_folder: Path):
+    """List all uploaded source images, generated covers/texts/stamps excluded."""
+    sources = []
+    for file in image_folder.iterdir():
+        if file.suffix.lower() not in SOURCE_EXTENSIONS:
+            continue
+
+        if is_generated_image(file):
+            continue
+
+        sources.append(file)
+
+    return sources
+
+
+def has_fresh_cover(file: Path) -> bool:
+    cover = filename_cover(file)
+    try:
+        return cover.stat().st_mtime >= file.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
 def list_complete_postcards(image_folder: Path):
     """List all image postcards in the postcards directory."""
     # List all image files, primarily focusing on common formats
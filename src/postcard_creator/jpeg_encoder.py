@@ -0,0 +1,139 @@
+import io
+import math
+
+from PIL import Image, ImageChops, ImageStat
+
+from postcard_creator.postcard_creator import logger
+
+DEFAULT_QUALITY = 75
+MIN_QUALITY = 60  # below, blocking becomes visible on print no matter what PSNR says
+MAX_QUALITY = 95
+# quality from which on full resolution chroma (4:4:4) is worth its bytes
+CHROMA_FULL_QUALITY = 90
+
+SUBSAMPLING_444 = 0
+SUBSAMPLING_420 = 2
+_SUBSAMPLING_NAMES = {SUBSAMPLING_444: '4:4:4', SUBSAMPLING_420: '4:2:0'}
+
+SETTINGS_COMMENT_PREFIX = 'postcard_creator '
+
+
+def encode_jpeg(image: Image, max_bytes=None, min_psnr=None, quality=DEFAULT_QUALITY, min_quality=MIN_QUALITY,
+                max_quality=MAX_QUALITY):
+    """
+    Encode image as JPEG with optimized huffman tables.
+
+    Without constraints, image is encoded at given quality. Otherwise the quality is binary searched:
+    - max_bytes: highest quality whose output is not larger than max_bytes
+    - min_psnr: lowest quality up to quality whose output still has a PSNR (dB) of min_psnr against image.
+      Images which don't reach min_psnr at quality (e.g. noisy photos) are encoded at quality, never higher.
+    - both: as min_psnr, but never larger than max_bytes
+
+    The chosen settings are stored in a JPEG comment (see read_encoder_settings) and returned.
+    Returns (bytes, settings)
+    """
+    image = image.convert('RGB')
+
+    if max_bytes is None and min_psnr is None:
+        return _encode(image, quality, SUBSAMPLING_420)
+
+    encoded = {}
+
+    def encode(q, subsampling=SUBSAMPLING_420):
+        if (q, subsampling) not in encoded:
+            encoded[q, subsampling] = _encode(image, q, subsampling)
+        return encoded[q, subsampling]
+
+    def fits_budget(q):
+        return len(encode(q)[0]) <= max_bytes
+
+    def reaches_psnr(q):
+        return _psnr(image, encode(q)[0]) >= min_psnr
+
+    if min_psnr is not None:
+        # XXX: only ever lower than the default, a floor out of reach must not cost bytes and time at max_quality
+        if reaches_psnr(quality):
+            quality = _search_lowest(reaches_psnr, min_quality, quality - 1) or quality
+    else:
+        quality = max_quality
+
+    if max_bytes is not None and not fits_budget(quality):
+        quality = _search_highest(fits_budget, min_quality, quality - 1)
+        if quality is None:
+            logger.warning(f'cannot encode image within {max_bytes} bytes, using quality {min_quality}')
+            quality = min_quality
+
+    data, settings = encode(quality)
+    if quality >= CHROMA_FULL_QUALITY:
+        full_chroma = encode(quality, SUBSAMPLING_444)
+        if max_bytes is None or len(full_chroma[0]) <= max_bytes:
+            data, settings = full_chroma
+
+    if min_psnr is not None:
+        settings['psnr'] = round(_psnr(image, data), 2)
+    logger.debug(f'encoded jpeg with {settings}')
+    return data, settings
+
+
+def read_encoder_settings(data: bytes) -> dict | None:
+    """
+    Settings chosen by encode_jpeg, read from the JPEG comment of data
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            comment = image.info.get('comment', b'')
+    except Exception:
+        return None
+
+    comment = comment.decode('ascii', 'replace') if isinstance(comment, bytes) else comment
+    if not comment.startswith(SETTINGS_COMMENT_PREFIX):
+        return None
+
+    settings = {}
+    for item in comment[len(SETTINGS_COMMENT_PREFIX):].split():
+        name, _, value = item.partition('=')
+        settings[name] = int(value) if value.isdigit() else value
+    return settings
+
+
+def _encode(image, quality, subsampling):
+    settings = {'quality': quality, 'subsampling': _SUBSAMPLING_NAMES[subsampling], 'optimize': 1}
+    comment = SETTINGS_COMMENT_PREFIX + ' '.join(f'{k}={v}' for k, v in settings.items())
+    with io.BytesIO() as f:
+        image.save(f, 'jpeg', quality=quality, subsampling=subsampling, optimize=True, comment=comment)
+        data = f.getvalue()
+    settings['bytes'] = len(data)
+    return data, settings
+
+
+def _psnr(image, data):
+    with Image.open(io.BytesIO(data)) as decoded:
+        stat = ImageStat.Stat(ImageChops.difference(image, decoded.convert('RGB')))
+    mse = sum(rms ** 2 for rms in stat.rms) / len(stat.rms)
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+def _search_highest(predicate, lo, hi):
+    found = None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if predicate(mid):
+            found = mid
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    return found
+
+
+def _search_lowest(predicate, lo, hi):
+    found = None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if predicate(mid):
+            found = mid
+            hi = mid - 1
+        else:
+            lo = mid + 1
+    return found
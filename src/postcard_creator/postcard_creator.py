@@ -2,8 +2,6 @@ import logging
 import os
 from pathlib import Path
 
-from requests_toolbelt.utils import dump
-
 LOGGING_TRACE_LVL = 5
 logger = logging.getLogger('postcard_creator')
 logging.addLevelName(LOGGING_TRACE_LVL, 'TRACE')
@@ -16,15 +14,6 @@ def _get_trace_postcard_sent_dir():
     return path
 
 
-def _dump_request(response):
-    data = dump.dump_all(response)
-    try:
-        logger.debug(data.decode())
-    except Exception:
-        data = str(data).replace('\\r\\n', '\r\n')
-        logger.debug(data)
-
-
 def _encode_text(text):
     return text.encode('ascii', 'xmlcharrefreplace').decode('utf-8')  # escape umlaute
 
@@ -36,6 +25,10 @@ class PostcardCreatorException(Exception):
 class PostcardCreatorTokenInvalidException(PostcardCreatorException):
     pass
 
+
+class PostcardCreatorCircuitOpenException(PostcardCreatorException):
+    pass
+
 class Sender(object):
     def __init__(self, prename, lastname, street, zip_code, place, company='', country=''):
         self.prename = prename
@@ -66,21 +59,28 @@ class Recipient(object):
 
 
 class Postcard(object):
-    def __init__(self, sender, recipient, picture_stream, message_image_stream, message=''):
+    def __init__(self, sender, recipient, picture_stream, message_image_stream, message='', recipients=None):
+        """
+        :param recipients: further recipients of the same card, see PostcardCreatorSwissId.send_card
+        """
         self.recipient = recipient
+        self.recipients = list(recipients or [])
         self.message = message
         self.picture_stream = picture_stream
         self.message_image_stream = message_image_stream
         self.sender = sender
 
+    def all_recipients(self):
+        return ([self.recipient] if self.recipient is not None else []) + self.recipients
+
     def is_valid(self):
         return self.recipient is not None \
-            and self.recipient.is_valid() \
+            and all(r.is_valid() for r in self.all_recipients()) \
             and self.sender is not None \
             and self.sender.is_valid()
 
     def validate(self):
-        if self.recipient is None or not self.recipient.is_valid():
+        if self.recipient is None or not all(r.is_valid() for r in self.all_recipients()):
             raise PostcardCreatorException('Not all required attributes in recipient set')
         if self.recipient is None or not self.recipient.is_valid():
             raise PostcardCreatorException('Not all required attributes in sender set')
@@ -1,11 +1,20 @@
-import base64
+import os
 from pathlib import Path
 
-import requests
-
-from postcard_creator.postcard_img_util import create_text_image, rotate_and_scale_image
+from postcard_creator.postcard_img_util import create_text_image, rotate_and_scale_image, COVER_RENDER_ARGS, \
+    TEXT_IMAGE_RENDER_ARGS
+from postcard_creator import transport
+from postcard_creator.account_cache import QUOTA, USER_INFO, account_key, get_account_cache
+from postcard_creator.request_policy import get_request_policy
+from postcard_creator.tracing import trace_response
+from postcard_creator.upload_body import Base64Field, JsonStreamBody
 from postcard_creator.postcard_creator import PostcardCreatorBase, PostcardCreatorException, Recipient, Sender, \
-    _dump_request, _send_free_card_defaults, logger, Postcard
+    _send_free_card_defaults, logger, Postcard
+
+
+API_PATH = '/secure/api/mobile/v1'
+USER_AGENT = 'Mozilla/5.0 (Linux; Android 6.0.1; wv) AppleWebKit/537.36 (KHTML, like Gecko) ' \
+             'Version/4.0 Chrome/52.0.2743.98 Mobile Safari/537.36'
 
 
 def _format_sender(sender: Sender):
@@ -33,23 +42,116 @@ def _format_recipient(recipient: Recipient):
     }
 
 
+def _render_card_images(postcard: Postcard, image_export=False, **kwargs):
+    """
+    Render cover and text image of postcard, CPU heavy
+    """
+    # XXX: endpoint no longer supports user specified w/h
+    kwargs.update(COVER_RENDER_ARGS)
+    img = rotate_and_scale_image(postcard.picture_stream, image_export=image_export, **kwargs)
+    if postcard.message_image_stream is not None:
+        kwargs.update(TEXT_IMAGE_RENDER_ARGS)
+        img_text = rotate_and_scale_image(postcard.message_image_stream, image_export=image_export, **kwargs)
+    else:
+        img_text = create_text_image(postcard.message, image_export=True)
+
+    stamp = None
+    #if postcard.message_image_stream is not None:
+    #    stamp = self.create_text_cover(postcard.message)
+    return img, img_text, stamp
+
+
+def _card_payload(postcard: Postcard, img, img_text, stamp=None, paid=False):
+    payload = {
+        'lang': 'en',
+        'paid': paid,
+        'recipient': _format_recipient(postcard.recipient),
+        'sender': _format_sender(postcard.sender),
+        'text': '',
+        'textImage': Base64Field(img_text),  # jpeg, JFIF standard 1.01, 720x744
+        'image': Base64Field(img),  # jpeg, JFIF standard 1.01, 1819x1311
+        'stamp': Base64Field(stamp) if stamp else None  # jpeg, JFIF standard 1.01, 343x248
+    }
+    if paid:
+        # XXX: paid cards take a list of recipients, see bin/payload.json
+        del payload['recipient']
+        payload['recipients'] = [_format_recipient(r) for r in postcard.all_recipients()]
+    return payload
+
+
+def _check_paid(postcard: Postcard, paid, quota):
+    """
+    The free card has a single recipient, paid cards (any number of recipients) only if the caller asks for it
+    """
+    if not paid and len(postcard.all_recipients()) > 1:
+        raise PostcardCreatorException('A free postcard has a single recipient, use paid=True')
+    if not paid and not quota['available']:
+        raise PostcardCreatorException('Limit of free postcards exceeded. Try again tomorrow at ' + quota['next'])
+
+
+def _card_price():
+    """
+    CHF per paid postcard and recipient, from POSTCARD_PRICE. The api doesn't tell and there is no default,
+    a wrong price would refuse cards which can be paid or upload cards which can't.
+    """
+    price = os.getenv('POSTCARD_PRICE')
+    if not price:
+        raise PostcardCreatorException('POSTCARD_PRICE (CHF per card) is required to send paid postcards')
+    return float(price)
+
+
+def _check_saldo(postcard: Postcard, saldo: dict, price: float):
+    """
+    The billing saldo has to cover a card for every recipient before anything is uploaded
+    """
+    recipients = len(postcard.all_recipients())
+    cost = recipients * price
+    if float(saldo.get('saldo') or 0) < cost:
+        raise PostcardCreatorException(f"Billing saldo {saldo.get('saldo')} does not cover {recipients} "
+                                       f"postcards ({cost:.2f})")
+
+
+def _order_results(postcard: Postcard, model):
+    """
+    [{'recipient': Recipient, 'order': model}, ...] in order of postcard.all_recipients()
+    """
+    recipients = postcard.all_recipients()
+    if isinstance(model, list) and len(model) == len(recipients):
+        orders = model
+    else:
+        # one order covering all recipients
+        orders = [model] * len(recipients)
+    return [{'recipient': recipient, 'order': order} for recipient, order in zip(recipients, orders)]
+
+
+def _mock_send(endpoint, payload):
+    copy = dict(payload)
+    copy['textImage'] = 'omitted'
+    copy['image'] = 'omitted'
+    Path("textImage.jpg").write_bytes(payload['textImage'].data)
+    Path("image.jpg").write_bytes(payload['image'].data)
+    logger.info(f'mock_send=True, endpoint: {endpoint}, payload: {copy}')
+
+
 class PostcardCreatorSwissId(PostcardCreatorBase):
     def __init__(self, token=None):
         if token.token is None:
             raise PostcardCreatorException('No Token given')
         self.token = token
         self._session = self._create_session()
-        self.host = 'https://pccweb.api.post.ch/secure/api/mobile/v1'
+        self.host = transport.api_base() + API_PATH
+        self.cache = get_account_cache()
+        self.policy = get_request_policy()
 
     def _get_headers(self):
         return {
-            'User-Agent': 'Mozilla/5.0 (Linux; Android 6.0.1; wv) AppleWebKit/537.36 (KHTML, like Gecko) '
-                          'Version/4.0 Chrome/52.0.2743.98 Mobile Safari/537.36',
+            'User-Agent': USER_AGENT,
             'Authorization': 'Bearer {}'.format(self.token.token)
         }
 
     def _create_session(self):
-        return requests.Session()
+        # XXX: connections are pooled process wide, a new client (e.g. after a token refresh) reuses them
+        return transport.new_session()
 
     # XXX: we share some functionality with legacy wrapper here
     # however, it is little and not worth the lack of extensibility if generalized in super class
@@ -58,9 +160,17 @@ class PostcardCreatorSwissId(PostcardCreatorBase):
         if 'headers' not in kwargs or kwargs['headers'] is None:
             kwargs['headers'] = self._get_headers()
 
+        kwargs.setdefault('timeout', self.policy.timeout())
+
+        def send():
+            # XXX: a streamed body is consumed by an attempt, each retry needs its own
+            data = kwargs.get('data')
+            attempt_kwargs = dict(kwargs, data=data.copy()) if isinstance(data, JsonStreamBody) else kwargs
+            return self._session.request(method, url, **attempt_kwargs)
+
         logger.debug('{}: {}'.format(method, url))
-        response = self._session.request(method, url, **kwargs)
-        _dump_request(response)
+        response = self.policy.execute(method, url, send)
+        trace_response(response)
 
         if response.status_code not in [200, 201, 204]:
             e = PostcardCreatorException('error in request {} {}. status_code: {}, text: {}'
@@ -73,24 +183,25 @@ class PostcardCreatorSwissId(PostcardCreatorBase):
         if payload.get('errors'):
             raise PostcardCreatorException(f'cannot fetch {endpoint}: {payload["errors"]}')
 
+    def _get_cached_model(self, kind, endpoint):
+        model = self.cache.get(account_key(self.token), kind)
+        if model is None:
+            payload = self._do_op('get', endpoint).json()
+            self._validate_model_response(endpoint, payload)
+            model = payload['model']
+            self.cache.put(account_key(self.token), kind, model)
+        return model
+
     def get_quota(self):
         logger.debug('fetching quota')
-        endpoint = '/user/quota'
-
-        payload = self._do_op('get', endpoint).json()
-        self._validate_model_response(endpoint, payload)
-        return payload['model']
+        return self._get_cached_model(QUOTA, '/user/quota')
 
     def has_free_postcard(self):
         return self.get_quota()['available']
 
     def get_user_info(self):
         logger.debug('fetching user information')
-        endpoint = '/user/current'
-
-        payload = self._do_op('get', endpoint).json()
-        self._validate_model_response(endpoint, payload)
-        return payload['model']
+        return self._get_cached_model(USER_INFO, '/user/current')
 
     def get_billing_saldo(self):
         logger.debug('fetching billing saldo')
@@ -106,64 +217,64 @@ class PostcardCreatorSwissId(PostcardCreatorBase):
             raise PostcardCreatorException('Postcard must be set')
         postcard.validate()
 
-        # XXX: endpoint no longer supports user specified w/h
-        kwargs['image_target_width'] = 1819
-        kwargs['image_quality_factor'] = 1
-        kwargs['image_target_height'] = 1311
-        img_base64 = base64.b64encode(rotate_and_scale_image(postcard.picture_stream,
-                                                             img_format='jpeg',
-                                                             image_export=image_export,
-                                                             enforce_size=True,
-                                                             **kwargs)).decode('ascii')
-        if postcard.message_image_stream is not None:
-            kwargs['image_target_width'] = 720
-            kwargs['image_quality_factor'] = 1
-            kwargs['image_target_height'] = 744
-            kwargs['image_rotate'] = False
-            img_text_base64 = base64.b64encode(rotate_and_scale_image(postcard.message_image_stream,
-                                                                      img_format='jpeg',
-                                                                      image_export=image_export,
-                                                                      enforce_size=True,
-                                                                      **kwargs)).decode('ascii')
-        else:
-            img_text_base64 = base64.b64encode(self.create_text_cover(postcard.message)).decode('ascii')
-
-        stamp_base64 = None
-        #if postcard.message_image_stream is not None:
-        #    stamp_base64 = base64.b64encode(self.create_text_cover(postcard.message)).decode('ascii')
+        payload = _card_payload(postcard, *_render_card_images(postcard, image_export=image_export, **kwargs))
 
         endpoint = '/card/upload'
-        payload = {
-            'lang': 'en',
-            'paid': False,
-            'recipient': _format_recipient(postcard.recipient),
-            'sender': _format_sender(postcard.sender),
-            'text': '',
-            'textImage': img_text_base64,  # jpeg, JFIF standard 1.01, 720x744
-            'image': img_base64,  # jpeg, JFIF standard 1.01, 1819x1311
-            'stamp': stamp_base64  # jpeg, JFIF standard 1.01, 343x248
-        }
-
         if mock_send:
-            copy = dict(payload)
-            copy['textImage'] = 'omitted'
-            copy['image'] = 'omitted'
-            Path("textImage.jpg").write_bytes(base64.b64decode(img_text_base64))
-            Path("image.jpg").write_bytes(base64.b64decode(img_base64))
-            logger.info(f'mock_send=True, endpoint: {endpoint}, payload: {copy}')
+            _mock_send(endpoint, payload)
             return False
 
         if not self.has_free_postcard():
             raise PostcardCreatorException('Limit of free postcards exceeded. Try again tomorrow at '
                                            + self.get_quota()['next'])
 
-        payload = self._do_op('post', endpoint, json=payload).json()
+        return self._upload(payload)
+
+    @_send_free_card_defaults
+    def send_card(self, postcard, mock_send=False, image_export=False, paid=False, **kwargs):
+        """
+        Send postcard to all its recipients with a single upload, images are rendered once.
+        :param paid: pay from the billing saldo, required for several recipients. Free cards are never paid
+            for silently, without quota they fail.
+        :return: [{'recipient': Recipient, 'order': model}, ...]
+        """
+        if not postcard:
+            raise PostcardCreatorException('Postcard must be set')
+        postcard.validate()
+
+        images = _render_card_images(postcard, image_export=image_export, **kwargs)
+
+        if mock_send:
+            _mock_send('/card/upload', _card_payload(postcard, *images, paid=paid))
+            return _order_results(postcard, None)
+
+        _check_paid(postcard, paid, self.get_quota())
+        if paid:
+            price = _card_price()
+            # raises if the account has no billing online
+            _check_saldo(postcard, self.get_billing_saldo(), price)
+
+        return _order_results(postcard, self._upload(_card_payload(postcard, *images, paid=paid)))
+
+    def _upload(self, payload):
+        endpoint = '/card/upload'
+        # XXX: images are base64 encoded chunk by chunk while the body is sent, never as a whole
+        body = JsonStreamBody(payload)
+        logger.debug(f'{endpoint} with streamed body of {len(body)} bytes')
+        try:
+            payload = self._do_op('post', endpoint, data=body,
+                                  headers=dict(self._get_headers(), **{'Content-Type': 'application/json'})).json()
+        finally:
+            # quota changed, or we can't tell after a failed upload
+            self.cache.invalidate(account_key(self.token), QUOTA)
         logger.debug(f'{endpoint} with response {payload}')
 
         self._validate_model_response(endpoint, payload)
 
-        logger.info(f'postcard submitted, orderid {payload["model"].get("orderId")}')
-        return payload['model']
+        model = payload['model']
+        orders = model if isinstance(model, list) else [model]
+        logger.info(f'postcard submitted, orderid {", ".join(str(o.get("orderId")) for o in orders)}')
+        return model
 
     def create_text_cover(self, msg):
         """
@@ -0,0 +1,176 @@
+import asyncio
+
+from postcard_creator import transport
+from postcard_creator.account_cache import QUOTA, USER_INFO, account_key, get_account_cache
+from postcard_creator.request_policy import get_request_policy
+from postcard_creator.postcard_creator import PostcardCreatorException, _send_free_card_defaults, logger
+from postcard_creator.postcard_creator_swissid import API_PATH, USER_AGENT, _card_payload, _card_price, \
+    _check_paid, _check_saldo, _mock_send, _order_results, _render_card_images
+from postcard_creator.tracing import trace_response
+from postcard_creator.upload_body import JsonStreamBody
+
+
+class AsyncPostcardCreatorSwissId(object):
+    """
+    asyncio counterpart of PostcardCreatorSwissId, same endpoints and return values.
+    Rendering runs in an executor, the event loop is never blocked by a send.
+    """
+
+    def __init__(self, token=None, executor=None):
+        """
+        :param executor: concurrent.futures executor for image rendering, default executor of the loop if None
+        """
+        if token.token is None:
+            raise PostcardCreatorException('No Token given')
+        self.token = token
+        self.executor = executor
+        self.host = transport.api_base() + API_PATH
+        self.cache = get_account_cache()
+        self.policy = get_request_policy()
+        self._client = None
+
+    def _get_headers(self):
+        return {
+            'User-Agent': USER_AGENT,
+            'Authorization': 'Bearer {}'.format(self.token.token)
+        }
+
+    def _get_client(self):
+        # XXX: created lazily, connections are pooled per event loop
+        if self._client is None:
+            self._client = transport.new_async_client()
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def _do_op(self, method, endpoint, **kwargs):
+        url = self.host + endpoint
+        if 'headers' not in kwargs or kwargs['headers'] is None:
+            kwargs['headers'] = self._get_headers()
+
+        kwargs.setdefault('timeout', self.policy.httpx_timeout())
+
+        async def send():
+            content = kwargs.get('content')
+            if isinstance(content, JsonStreamBody):
+                # XXX: httpx only streams async iterables, and each attempt needs an unread body
+                return await self._get_client().request(method, url, **dict(kwargs, content=content.copy().aiter_chunks()))
+            return await self._get_client().request(method, url, **kwargs)
+
+        logger.debug('{}: {}'.format(method, url))
+        response = await self.policy.execute_async(method, url, send)
+        trace_response(response)
+
+        if response.status_code not in [200, 201, 204]:
+            e = PostcardCreatorException('error in request {} {}. status_code: {}, text: {}'
+                                         .format(method, url, response.status_code, response.text or ''))
+            e.server_response = response.text
+            raise e
+        return response
+
+    def _validate_model_response(self, endpoint, payload):
+        if payload.get('errors'):
+            raise PostcardCreatorException(f'cannot fetch {endpoint}: {payload["errors"]}')
+
+    async def _get_model(self, endpoint):
+        payload = (await self._do_op('get', endpoint)).json()
+        self._validate_model_response(endpoint, payload)
+        return payload['model']
+
+    async def _get_cached_model(self, kind, endpoint):
+        model = self.cache.get(account_key(self.token), kind)
+        if model is None:
+            model = await self._get_model(endpoint)
+            self.cache.put(account_key(self.token), kind, model)
+        return model
+
+    async def get_quota(self):
+        logger.debug('fetching quota')
+        return await self._get_cached_model(QUOTA, '/user/quota')
+
+    async def has_free_postcard(self):
+        return (await self.get_quota())['available']
+
+    async def get_user_info(self):
+        logger.debug('fetching user information')
+        return await self._get_cached_model(USER_INFO, '/user/current')
+
+    async def get_billing_saldo(self):
+        logger.debug('fetching billing saldo')
+        return await self._get_model('/billingOnline/accountSaldo')
+
+    @_send_free_card_defaults
+    async def send_free_card(self, postcard, mock_send=False, image_export=False, **kwargs):
+        if not postcard:
+            raise PostcardCreatorException('Postcard must be set')
+        postcard.validate()
+
+        loop = asyncio.get_running_loop()
+        images = await loop.run_in_executor(self.executor,
+                                            lambda: _render_card_images(postcard, image_export=image_export, **kwargs))
+        payload = _card_payload(postcard, *images)
+
+        endpoint = '/card/upload'
+        if mock_send:
+            await loop.run_in_executor(self.executor, _mock_send, endpoint, payload)
+            return False
+
+        quota = await self.get_quota()
+        if not quota['available']:
+            raise PostcardCreatorException('Limit of free postcards exceeded. Try again tomorrow at '
+                                           + quota['next'])
+
+        return await self._upload(payload)
+
+    @_send_free_card_defaults
+    async def send_card(self, postcard, mock_send=False, image_export=False, paid=False, **kwargs):
+        """
+        See PostcardCreatorSwissId.send_card
+        """
+        if not postcard:
+            raise PostcardCreatorException('Postcard must be set')
+        postcard.validate()
+
+        loop = asyncio.get_running_loop()
+        images = await loop.run_in_executor(self.executor,
+                                            lambda: _render_card_images(postcard, image_export=image_export, **kwargs))
+
+        if mock_send:
+            payload = _card_payload(postcard, *images, paid=paid)
+            await loop.run_in_executor(self.executor, _mock_send, '/card/upload', payload)
+            return _order_results(postcard, None)
+
+        _check_paid(postcard, paid, await self.get_quota())
+        if paid:
+            price = _card_price()
+            # raises if the account has no billing online
+            _check_saldo(postcard, await self.get_billing_saldo(), price)
+
+        return _order_results(postcard, await self._upload(_card_payload(postcard, *images, paid=paid)))
+
+    async def _upload(self, payload):
+        endpoint = '/card/upload'
+        body = JsonStreamBody(payload)
+        logger.debug(f'{endpoint} with streamed body of {len(body)} bytes')
+        headers = dict(self._get_headers(), **{'Content-Type': 'application/json', 'Content-Length': str(len(body))})
+        try:
+            payload = (await self._do_op('post', endpoint, content=body, headers=headers)).json()
+        finally:
+            self.cache.invalidate(account_key(self.token), QUOTA)
+        logger.debug(f'{endpoint} with response {payload}')
+
+        self._validate_model_response(endpoint, payload)
+
+        model = payload['model']
+        orders = model if isinstance(model, list) else [model]
+        logger.info(f'postcard submitted, orderid {", ".join(str(o.get("orderId")) for o in orders)}')
+        return model
@@ -1,24 +1,116 @@
 import io
 import os
-import textwrap
-from math import floor
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 from time import strftime, gmtime
 
-import pkg_resources
-from PIL import Image, ImageFilter, ImageOps, ImageDraw, ImageFont
+from PIL import Image, ImageFilter, ImageOps, ImageDraw
 
 from postcard_creator.postcard_creator import logger, _get_trace_postcard_sent_dir
+from postcard_creator import helper
+from postcard_creator.jpeg_encoder import encode_jpeg, read_encoder_settings
+from postcard_creator.render_cache import get_render_cache, make_key
+from postcard_creator.text_layout import layout_text
+
+BACKGROUND_EXACT = 'exact'  # gaussian blur at (almost) target resolution
+BACKGROUND_FAST = 'fast'  # blur a downscaled copy and upscale bilinear
+BACKGROUND_BLUR_RADIUS = 15
+
+# XXX: endpoint no longer supports user specified w/h
+COVER_RENDER_ARGS = {
+    'image_target_width': 1819,
+    'image_target_height': 1311,
+    'image_quality_factor': 1,
+    'img_format': 'jpeg',
+    'enforce_size': True,
+    'background_mode': BACKGROUND_FAST,
+    'jpeg_max_bytes': 1024 * 1024,
+    'jpeg_min_psnr': 34,
+}
+
+TEXT_IMAGE_RENDER_ARGS = {
+    'image_target_width': 720,
+    'image_target_height': 744,
+    'image_quality_factor': 1,
+    'img_format': 'jpeg',
+    'enforce_size': True,
+    'image_rotate': False,
+    'background_mode': BACKGROUND_FAST,
+    'jpeg_max_bytes': 512 * 1024,
+    'jpeg_min_psnr': 35,
+}
 
 
 def make_cover_image(file, **kwargs) -> Image:
-    kwargs['image_target_width'] = 1819
-    kwargs['image_quality_factor'] = 1
-    kwargs['image_target_height'] = 1311
-    kwargs['img_format'] = 'jpeg'
-    kwargs['enforce_size'] = True
+    kwargs.update(COVER_RENDER_ARGS)
     return rotate_and_scale_image(file, **kwargs)
 
 
+def prerender_covers(image_folder: Path, workers=None, max_tasks_per_child=8, memory_limit_bytes=None,
+                     force=False) -> list:
+    """
+    Render the cover of every source image in image_folder which has no fresh cover yet.
+    Covers are rendered across a process pool, workers are recycled after max_tasks_per_child renders and
+    their address space can be capped with memory_limit_bytes.
+    Returns one result per file: {'file', 'cover', 'seconds', 'settings', 'error'}
+    """
+    sources = [f for f in helper.list_source_images(Path(image_folder)) if force or not helper.has_fresh_cover(f)]
+    if not sources:
+        logger.info(f'all covers in {image_folder} are up to date')
+        return []
+
+    logger.info(f'rendering {len(sources)} covers in {image_folder}')
+    results = []
+    with ProcessPoolExecutor(max_workers=workers,
+                             max_tasks_per_child=max_tasks_per_child,
+                             initializer=_prerender_worker_init,
+                             initargs=(memory_limit_bytes,)) as pool:
+        futures = {pool.submit(_prerender_cover, source): source for source in sources}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # worker died, e.g. MemoryError beyond memory_limit_bytes
+                result = {'file': futures[future], 'cover': None, 'seconds': None, 'settings': None,
+                          'error': repr(e)}
+
+            if result['error']:
+                logger.warning(f"failed to render cover of {result['file']}: {result['error']}")
+            else:
+                logger.info(f"rendered {result['cover']} in {result['seconds']:.2f}s")
+            results.append(result)
+
+    return results
+
+
+def _prerender_worker_init(memory_limit_bytes):
+    if memory_limit_bytes:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit_bytes, memory_limit_bytes))
+
+    # every worker has a short life, keep renders on disk only
+    get_render_cache().max_memory_bytes = 0
+
+
+def _prerender_cover(source: Path) -> dict:
+    cover = helper.filename_cover(source)
+    start = time.perf_counter()
+    try:
+        data = make_cover_image(source)
+        tmp = cover.with_name(f'.{cover.name}.{os.getpid()}.tmp')
+        tmp.write_bytes(data)
+        os.replace(tmp, cover)
+        settings = dict(read_encoder_settings(data) or {}, bytes=len(data))
+        error = None
+    except Exception as e:
+        settings = None
+        error = repr(e)
+
+    return {'file': source, 'cover': cover, 'seconds': time.perf_counter() - start, 'settings': settings,
+            'error': error}
+
+
 def rotate_and_scale_image(file, image_target_width=154,
                            image_target_height=111,
                            image_quality_factor=20,
@@ -28,8 +120,51 @@ def rotate_and_scale_image(file, image_target_width=154,
                            # = True, will not make image smaller than given w/h, for high resolution submissions
                            fallback_color_fill=False,  # = False, will force resize cover even if image is too small.
                            img_format='PNG',
+                           draft_decode=True,  # = True, let the decoder downscale large images (JPEG DCT scaling)
+                           background_mode=BACKGROUND_EXACT,  # blurred background if aspect ratio does not fit
+                           jpeg_max_bytes=None,  # byte budget of the encoded jpeg
+                           jpeg_min_psnr=None,  # quality floor of the encoded jpeg in dB PSNR
                            **kwargs):
-    with Image.open(file) as image:
+    source = _read_source(file)
+    params = dict(image_target_width=image_target_width,
+                  image_target_height=image_target_height,
+                  image_quality_factor=image_quality_factor,
+                  image_rotate=image_rotate,
+                  enforce_size=enforce_size,
+                  fallback_color_fill=fallback_color_fill,
+                  img_format=img_format.lower(),
+                  draft_decode=draft_decode,
+                  background_mode=background_mode,
+                  jpeg_max_bytes=jpeg_max_bytes,
+                  jpeg_min_psnr=jpeg_min_psnr)
+
+    cache = get_render_cache()
+    if _is_upload_ready(source, **params):
+        # XXX: e.g. _cover.jpeg in send_free_card, a decode/resample/encode would only cost time and quality
+        logger.debug('image already has target size, format and mode, forwarding it unchanged')
+        scaled = source
+    else:
+        key = make_key(source, **params)
+        scaled = cache.get(key)
+        if scaled is not None:
+            logger.debug(f'render cache hit for {key}')
+        else:
+            scaled = _rotate_and_scale(source, **params)
+            cache.put(key, scaled)
+
+    if image_export:
+        _export_image(scaled, 'cover', img_format)
+
+    return scaled
+
+
+def _rotate_and_scale(source: bytes, image_target_width, image_target_height, image_quality_factor,
+                      image_rotate, enforce_size, fallback_color_fill, img_format, draft_decode,
+                      background_mode=BACKGROUND_EXACT, jpeg_max_bytes=None, jpeg_min_psnr=None):
+    with Image.open(io.BytesIO(source)) as image:
+        if draft_decode:
+            image = _decode_reduced(image, image_target_width, image_target_height, image_rotate)
+
         if image_rotate and image.width < image.height:
             image = image.rotate(90, expand=True)
             logger.debug('rotating image by 90 degrees')
@@ -51,23 +186,84 @@ def rotate_and_scale_image(file, image_target_width=154,
         logger.debug('resizing image from {}x{} to {}x{}'
                      .format(image.width, image.height, width, height))
 
-        cover = process_image(image, image_target_width, image_target_height)
+        cover = process_image(image, image_target_width, image_target_height, background_mode=background_mode)
 
         cover = cover.convert("RGB")
+        if img_format.lower() in ('jpeg', 'jpg'):
+            data, settings = encode_jpeg(cover, max_bytes=jpeg_max_bytes, min_psnr=jpeg_min_psnr)
+            logger.debug(f'encoded {image_target_width}x{image_target_height} jpeg with {settings}')
+            return data
+
         with io.BytesIO() as f:
             cover.save(f, img_format)
-            scaled = f.getvalue()
+            return f.getvalue()
 
-        if image_export:
-            name = strftime("postcard_creator_export_%Y-%m-%d_%H-%M-%S_cover.jpg", gmtime())
-            path = os.path.join(_get_trace_postcard_sent_dir(), name)
-            logger.info('exporting image to {} (image_export=True)'.format(path))
-            cover.save(path)
 
-    return scaled
+def _is_upload_ready(source: bytes, image_target_width, image_target_height, image_rotate, img_format,
+                     jpeg_max_bytes=None, **kwargs) -> bool:
+    """
+    Whether source can be uploaded as is. Only the image header is parsed.
+    """
+    if jpeg_max_bytes is not None and len(source) > jpeg_max_bytes:
+        return False
+
+    expected_format = 'JPEG' if img_format.upper() in ('JPG', 'JPEG') else img_format.upper()
+    try:
+        with Image.open(io.BytesIO(source)) as image:
+            return image.format == expected_format \
+                and image.mode == 'RGB' \
+                and image.size == (image_target_width, image_target_height) \
+                and not (image_rotate and image.width < image.height)
+    except Exception:
+        return False
 
 
-def process_image(img: Image, target_width, target_height, max_crop_percentage=0.11) -> Image:
+def _decode_reduced(image: Image, target_width, target_height, image_rotate) -> Image:
+    """
+    Decode image at the smallest power-of-two reduction which still covers the target size.
+    JPEG is scaled by the decoder itself and never materialized at full resolution,
+    other formats are decoded in full and box-reduced before the expensive resample.
+    """
+    if image_rotate and image.width < image.height:
+        target_width, target_height = target_height, target_width
+
+    original_size = image.size
+    if image.format == 'JPEG':
+        image.draft('RGB', (target_width, target_height))
+    elif image.mode not in ('P', '1', 'I;16'):  # modes without reduce support
+        factor = min(image.width // target_width, image.height // target_height)
+        reduce_by = 1
+        while reduce_by * 2 <= min(factor, 8):
+            reduce_by *= 2
+        if reduce_by > 1:
+            image = image.reduce(reduce_by)
+
+    if image.size != original_size:
+        logger.debug('decoding image {}x{} at reduced size {}x{}'
+                     .format(original_size[0], original_size[1], image.width, image.height))
+    return image
+
+
+def _read_source(file) -> bytes:
+    if isinstance(file, (bytes, bytearray)):
+        return bytes(file)
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            return f.read()
+    return file.read()
+
+
+def _export_image(data: bytes, kind, img_format='jpeg'):
+    extension = 'png' if img_format.lower() == 'png' else 'jpg'
+    name = strftime(f"postcard_creator_export_%Y-%m-%d_%H-%M-%S_{kind}.{extension}", gmtime())
+    path = os.path.join(_get_trace_postcard_sent_dir(), name)
+    logger.info('exporting image to {} (image_export=True)'.format(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def process_image(img: Image, target_width, target_height, max_crop_percentage=0.11,
+                  background_mode=BACKGROUND_EXACT) -> Image:
     original_width, original_height = img.size
     original_aspect_ratio = original_width / original_height
     target_aspect_ratio = target_width / target_height
@@ -83,8 +279,13 @@ def process_image(img: Image, target_width, target_height, max_crop_percentage=0
         resized_width, resized_height = img.size
 
         # Create a background with the target dimensions
-        background = img.copy().filter(ImageFilter.GaussianBlur(15))
-        background = background.resize((target_width, target_height), Image.Resampling.LANCZOS)
+        if background_mode == BACKGROUND_FAST:
+            background = _blurred_background_fast(img, target_width, target_height)
+        elif background_mode == BACKGROUND_EXACT:
+            background = img.copy().filter(ImageFilter.GaussianBlur(BACKGROUND_BLUR_RADIUS))
+            background = background.resize((target_width, target_height), Image.Resampling.LANCZOS)
+        else:
+            raise ValueError(f'unknown background_mode {background_mode}')
 
         # Calculate the position to paste the resized image
         paste_x = (target_width - resized_width) // 2
@@ -95,6 +296,17 @@ def process_image(img: Image, target_width, target_height, max_crop_percentage=0
         return background
 
 
+def _blurred_background_fast(img: Image, target_width, target_height, scale=8) -> Image:
+    """
+    Blur a heavily downscaled copy and stretch it with a cheap filter.
+    The blur radius is scaled down with the image, so the result matches the exact mode at print resolution.
+    """
+    small = img.reduce(scale) if img.mode not in ('P', '1', 'I;16') else \
+        img.resize((max(1, img.width // scale), max(1, img.height // scale)), Image.Resampling.BOX)
+    small = small.filter(ImageFilter.GaussianBlur(BACKGROUND_BLUR_RADIUS / scale))
+    return small.resize((target_width, target_height), Image.Resampling.BILINEAR)
+
+
 def resize_image_no_crop(img, new_height):
     width, height = img.size
     # Calculate the new width to keep the aspect ratio
@@ -115,105 +327,39 @@ def create_text_image(text, image_export=False, **kwargs):
     text_canvas_fg = 'black'
     text_canvas_font_name = 'open_sans_emoji.ttf'
 
-    def load_font(size):
-        return ImageFont.truetype(pkg_resources.resource_stream(__name__, text_canvas_font_name), size)
-
-    def find_optimal_size(msg, min_size=20, max_size=400, min_line_w=1, max_line_w=80, padding=0):
-        """
-        Find optimal font size and line width for a given text
-        """
-
-        if min_line_w >= max_line_w:
-            raise Exception("illegal arguments, min_line_w < max_line_w needed")
-
-        def line_width(font_size, line_padding=70):
-            l = min_line_w
-            r = max_line_w
-            font = load_font(font_size)
-            while l < r:
-                n = floor((l + r) / 2)
-                t = ''.join([char * n for char in '1'])
-                font_w, font_h = font.getbbox(t)[-2:]
-                font_w = font_w + (2 * line_padding)
-                if font_w >= text_canvas_w:
-                    r = n - 1
-                    pass
-                else:
-                    l = n + 1
-                    pass
-            return n
-
-        size_l = min_size
-        size_r = max_size
-        last_line_w = 0
-        last_size = 0
-
-        while size_l < size_r:
-            size = floor((size_l + size_r) / 2.0)
-            last_size = size
-
-            line_w = line_width(size)
-            last_line_w = line_w
-
-            lines = []
-            for line in msg.splitlines():
-                cur_lines = textwrap.wrap(line, width=line_w)
-                for cur_line in cur_lines:
-                    lines.append(cur_line)
-
-            font = load_font(size)
-            total_w, line_h = font.getbbox(msg)[-2:]
-            tot_height = len(lines) * line_h
-
-            if tot_height + (2 * padding) < text_canvas_h:
-                start_y = (text_canvas_h - tot_height) / 2
-            else:
-                start_y = 0
-
-            if start_y == 0:
-                size_r = size - 1
-            else:
-                # does fit
-                size_l = size + 1
-
-        return last_size, last_line_w
+    cache = get_render_cache()
+    key = make_key(text.encode('utf-8'), kind='text', width=text_canvas_w, height=text_canvas_h,
+                   bg=text_canvas_bg, fg=text_canvas_fg, font=text_canvas_font_name, layout='measured',
+                   jpeg_max_bytes=TEXT_IMAGE_RENDER_ARGS['jpeg_max_bytes'],
+                   jpeg_min_psnr=TEXT_IMAGE_RENDER_ARGS['jpeg_min_psnr'])
+    data = cache.get(key)
+    if data is None:
+        data = _render_text_image(text, text_canvas_w, text_canvas_h, text_canvas_bg, text_canvas_fg,
+                                  text_canvas_font_name)
+        cache.put(key, data)
+    else:
+        logger.debug(f'render cache hit for {key}')
 
-    def center_y(lines, font_h):
-        tot_height = len(lines) * font_h
-        if tot_height < text_canvas_h:
-            return (text_canvas_h - tot_height) // 2
-        else:
-            return 0
+    if image_export:
+        _export_image(data, 'text')
 
-    size, line_w = find_optimal_size(text, padding=50)
-    logger.debug(f'using font with size: {size}, width: {line_w}')
+    return data
 
-    font = load_font(size)
-    font_w, font_h = font.getbbox(text)[-2:]
 
-    lines = []
-    for line in text.splitlines():
-        cur_lines = textwrap.wrap(line, width=line_w)
-        for cur_line in cur_lines:
-            lines.append(cur_line)
-    text_y_start = center_y(lines, font_h)
+def _render_text_image(text, text_canvas_w, text_canvas_h, text_canvas_bg, text_canvas_fg, text_canvas_font_name):
+    layout = layout_text(text, text_canvas_font_name, text_canvas_w, text_canvas_h, padding=50)
+    logger.debug(f'using font with size: {layout.size}, lines: {len(layout.lines)}')
 
     canvas = Image.new('RGB', (text_canvas_w, text_canvas_h), text_canvas_bg)
     draw = ImageDraw.Draw(canvas)
-    for line in lines:
-        width, height = font.getbbox(line)[-2:]
-        draw.text(((text_canvas_w - width) // 2, text_y_start), line,
+    font = layout.font
+    for x, y, line in layout.positions():
+        draw.text((x, y), line,
                   font=font,
                   fill=text_canvas_fg,
                   embedded_color=True)
-        text_y_start += (height)
 
-    if image_export:
-        name = strftime("postcard_creator_export_%Y-%m-%d_%H-%M-%S_text.jpg", gmtime())
-        path = os.path.join(_get_trace_postcard_sent_dir(), name)
-        logger.info('exporting image to {} (image_export=True)'.format(path))
-        canvas.save(path)
-
-    img_byte_arr = io.BytesIO()
-    canvas.save(img_byte_arr, format='jpeg')
-    return img_byte_arr.getvalue()
+    data, settings = encode_jpeg(canvas, max_bytes=TEXT_IMAGE_RENDER_ARGS['jpeg_max_bytes'],
+                                 min_psnr=TEXT_IMAGE_RENDER_ARGS['jpeg_min_psnr'])
+    logger.debug(f'encoded text image with {settings}')
+    return data
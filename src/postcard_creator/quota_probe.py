@@ -0,0 +1,99 @@
+import asyncio
+import os
+import time
+
+from postcard_creator.account_pool import Account, AccountPool, get_account_pool
+from postcard_creator.account_state import AccountState, get_account_state
+from postcard_creator.postcard_creator import logger
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TIMEOUT = 20
+
+
+class ProbeResult(object):
+    """
+    Quota of one account, or the error which prevented fetching it
+    """
+
+    def __init__(self, account: Account, quota: dict | None = None, error: BaseException | None = None,
+                 latency: float = 0.0):
+        self.account = account
+        self.quota = quota
+        self.error = error
+        self.latency = latency
+
+    @property
+    def ref(self):
+        return self.account.ref
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def available(self):
+        return self.ok and bool(self.quota.get('available'))
+
+    def to_json(self):
+        return {
+            'available': self.available,
+            'latency_ms': round(self.latency * 1000, 1),
+            'error': None if self.ok else repr(self.error),
+        }
+
+
+async def probe_account(pool: AccountPool, ref, timeout=None, state: AccountState | None = None) -> ProbeResult:
+    """
+    Refresh the token if needed and fetch the quota of account ref, within timeout seconds.
+    If the account is leased, e.g. uploading a card, the probe waits for it, the timeout starts once we have
+    the lease. The outcome is recorded in state (not saved).
+    """
+    account = pool.get(ref)
+    state = state or get_account_state()
+
+    async def probe():
+        client = await account.prepare_async()
+        account.quota = await client.get_quota()
+        state.update(account.name, refreshed_at=account.provider.token_data.get('fetched_at'))
+        if not state.get(account.name).get('user_info'):
+            state.update(account.name, user_info=await client.get_user_info())
+        return account.quota
+
+    # XXX: a busy account is healthy, waiting for its upload (bounded by the request timeouts) must not fail it
+    async with await pool.lease_async(ref):
+        start = time.perf_counter()
+        try:
+            quota = await asyncio.wait_for(probe(), timeout)
+            state.record_probe(account.name, quota=quota)
+            return ProbeResult(account, quota=quota, latency=time.perf_counter() - start)
+        except Exception as e:
+            logger.info(f'probing {account.name} failed: {e!r}')
+            state.record_probe(account.name, error=e)
+            return ProbeResult(account, error=e, latency=time.perf_counter() - start)
+
+
+async def probe_accounts(accounts=None, concurrency=None, timeout=None, pool: AccountPool | None = None,
+                         state: AccountState | None = None) -> list:
+    """
+    Probe all accounts (default: all of the pool) concurrently, at most concurrency at a time.
+    Results are in the order of accounts, failed accounts are reported and don't fail the others.
+    Defaults from POSTCARD_PROBE_CONCURRENCY and POSTCARD_PROBE_TIMEOUT (seconds per account).
+    The account state snapshot is saved once all are done.
+    """
+    pool = pool or get_account_pool()
+    state = state or get_account_state()
+    concurrency = concurrency or int(os.getenv('POSTCARD_PROBE_CONCURRENCY', DEFAULT_CONCURRENCY))
+    timeout = timeout or float(os.getenv('POSTCARD_PROBE_TIMEOUT', DEFAULT_TIMEOUT))
+    if accounts is None:
+        accounts = pool.refs()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(ref):
+        async with semaphore:
+            return await probe_account(pool, ref, timeout, state)
+
+    results = await asyncio.gather(*[run(ref) for ref in accounts])
+    for result in results:
+        logger.debug(f'probed {result.account.name} in {result.latency * 1000:.0f}ms')
+    await asyncio.to_thread(state.save)
+    return list(results)
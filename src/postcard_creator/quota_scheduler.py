@@ -0,0 +1,74 @@
+import asyncio
+import heapq
+import itertools
+from datetime import datetime, timezone
+
+
+class QuotaScheduler(object):
+    """
+    Accounts ordered by the time their next free postcard is available (quota 'next').
+    A min-heap with lazy deletion: an update pushes a new entry and outdated entries are skipped.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or (lambda: datetime.now(timezone.utc))
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._changed = asyncio.Event()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, account):
+        return account in self._entries
+
+    def update(self, account, when: datetime):
+        entry = [when, next(self._counter), account]
+        self._entries[account] = entry
+        heapq.heappush(self._heap, entry)
+        self._changed.set()
+
+    def remove(self, account):
+        if self._entries.pop(account, None) is not None:
+            self._changed.set()
+
+    def peek(self):
+        """
+        (time, account) of the earliest account or None
+        """
+        while self._heap:
+            when, _, account = self._heap[0]
+            if self._entries.get(account) is self._heap[0]:
+                return when, account
+            heapq.heappop(self._heap)
+        return None
+
+    def due(self):
+        """
+        Accounts whose time has come, earliest first
+        """
+        now = self.clock()
+        return [account for when, _, account in sorted(self._entries.values()) if when <= now]
+
+    def as_dict(self):
+        return {account: entry[0] for account, entry in self._entries.items()}
+
+    async def wait(self):
+        """
+        Sleep until the earliest account is due and return it, an update in between wakes us up to re-check.
+        Without accounts this waits for the first update.
+        """
+        while True:
+            earliest = self.peek()
+            timeout = None
+            if earliest is not None:
+                timeout = (earliest[0] - self.clock()).total_seconds()
+                if timeout <= 0:
+                    return earliest[1]
+
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
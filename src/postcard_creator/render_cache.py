@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from postcard_creator.postcard_creator import logger
+
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_BYTES = 512 * 1024 * 1024
+CACHE_DIR_NAME = 'render_cache'
+ENTRY_SUFFIX = '.bin'
+
+
+def make_key(source: bytes, **params) -> str:
+    """
+    Build a content address from the source bytes and all parameters which influence the render
+    """
+    m = hashlib.sha256()
+    m.update(hashlib.sha256(source).digest())
+    m.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+    return m.hexdigest()
+
+
+class RenderCache(object):
+    """
+    Two tier LRU cache for rendered images.
+    The in-process tier holds the most recently used renders, the disk tier survives restarts and is
+    shared between processes. Both tiers are bounded by their total size in bytes.
+    """
+
+    def __init__(self, directory: Path | None = None, max_memory_bytes=DEFAULT_MEMORY_BYTES,
+                 max_disk_bytes=DEFAULT_DISK_BYTES):
+        self.directory = Path(directory) if directory else None
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+
+        data = self._disk_get(key)
+        if data is not None:
+            with self._lock:
+                self._memory_put(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            self._memory_put(key, data)
+        self._disk_put(key, data)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            if self.directory:
+                for entry in self.directory.glob('*' + ENTRY_SUFFIX):
+                    entry.unlink(missing_ok=True)
+                self._disk_bytes = 0
+
+    def _memory_put(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _entry(self, key) -> Path:
+        return self.directory.joinpath(key + ENTRY_SUFFIX)
+
+    def _disk_get(self, key):
+        if not self.directory:
+            return None
+
+        entry = self._entry(key)
+        try:
+            data = entry.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        # XXX: mtime is our LRU clock on disk, touch entry on every hit
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return data
+
+    def _disk_put(self, key, data):
+        if not self.directory or len(data) > self.max_disk_bytes:
+            return
+
+        entry = self._entry(key)
+        tmp = entry.with_name(f'{entry.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            tmp.write_bytes(data)
+            os.replace(tmp, entry)
+        except OSError as e:
+            logger.warning(f'cannot write render cache entry {entry}: {e}')
+            tmp.unlink(missing_ok=True)
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._disk_usage()
+            else:
+                self._disk_bytes += len(data)
+
+            if self._disk_bytes > self.max_disk_bytes:
+                self._disk_evict()
+
+    def _disk_usage(self):
+        total = 0
+        for entry in self.directory.glob('*' + ENTRY_SUFFIX):
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    def _disk_evict(self):
+        entries = []
+        for entry in self.directory.glob('*' + ENTRY_SUFFIX):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+
+        # other processes may share the directory, recount instead of trusting our own bookkeeping
+        total = sum(size for _, size, _ in entries)
+        entries.sort(key=lambda e: e[0])
+        for _, size, entry in entries:
+            if total <= self.max_disk_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            total -= size
+            logger.debug(f'evicted render cache entry {entry.name}')
+
+        self._disk_bytes = total
+
+
+_default_cache: RenderCache | None = None
+_default_cache_lock = threading.Lock()
+
+
+def get_render_cache() -> RenderCache:
+    """
+    Process wide render cache. Renders are persisted below $DATA_DIR/render_cache if DATA_DIR is set,
+    sizes can be tuned with RENDER_CACHE_MEMORY_BYTES and RENDER_CACHE_DISK_BYTES.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            data_dir = os.getenv('DATA_DIR')
+            _default_cache = RenderCache(
+                directory=Path(data_dir).joinpath(CACHE_DIR_NAME) if data_dir else None,
+                max_memory_bytes=int(os.getenv('RENDER_CACHE_MEMORY_BYTES', DEFAULT_MEMORY_BYTES)),
+                max_disk_bytes=int(os.getenv('RENDER_CACHE_DISK_BYTES', DEFAULT_DISK_BYTES)))
+        return _default_cache
+
+
+def set_render_cache(cache: RenderCache | None):
+    global _default_cache
+    with _default_cache_lock:
+        _default_cache = cache
@@ -0,0 +1,288 @@
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import httpx
+import requests
+
+from postcard_creator.postcard_creator import PostcardCreatorCircuitOpenException, logger
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRY_STATUSES = (429, 502, 503, 504)
+# the server explicitly refused to process the request, safe to repeat even a POST
+REJECTED_STATUSES = (429,)
+
+# connection could not be established, nothing was sent
+NOT_SENT_ERRORS = (requests.exceptions.ConnectTimeout, httpx.ConnectError, httpx.ConnectTimeout)
+TRANSPORT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, httpx.TransportError)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast after `threshold` consecutive failures, lets a single trial request through after `reset_timeout`.
+    A trial which neither succeeds nor fails within `trial_timeout` (default: reset_timeout) is given up.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=60, clock=time.monotonic, trial_timeout=None):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.trial_timeout = reset_timeout if trial_timeout is None else trial_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.trial_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CLOSED
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and (not self.trial_running or
+                                       self.clock() - self.trial_started_at >= self.trial_timeout):
+                self.trial_running = True
+                self.trial_started_at = self.clock()
+                return True
+            return False
+
+    def abandon(self):
+        """
+        The request ended without an answer, e.g. cancelled. Counts neither as success nor failure,
+        a running trial is over and the next request may try again.
+        """
+        with self._lock:
+            self.trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = self.clock()
+            self.trial_running = False
+
+    def to_json(self):
+        return {'state': self.state, 'failures': self.failures}
+
+
+class RequestPolicy(object):
+    """
+    Timeouts, retries and per-host circuit breakers for API requests.
+    Idempotent requests are retried on transport errors and RETRY_STATUSES with jittered exponential
+    backoff (or Retry-After). Other requests, e.g. POST /card/upload, are only repeated if they were
+    provably not processed: the connection could not be established or the server answered 429.
+    """
+
+    def __init__(self, connect_timeout=10.0, read_timeout=30.0, max_retries=3, backoff_factor=0.5,
+                 max_backoff=30.0, breaker_threshold=5, breaker_reset_timeout=60.0,
+                 clock=time.monotonic, sleep=time.sleep, rand=random.random):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.rand = rand
+        self.retries = 0
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def timeout(self):
+        """
+        (connect, read) tuple for requests
+        """
+        return self.connect_timeout, self.read_timeout
+
+    def httpx_timeout(self):
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+
+    def breaker(self, url) -> CircuitBreaker:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_reset_timeout, self.clock)
+            return self._breakers[host]
+
+    def state(self):
+        with self._lock:
+            return {
+                'retries': self.retries,
+                'hosts': {host: breaker.to_json() for host, breaker in self._breakers.items()},
+            }
+
+    def execute(self, method, url, send):
+        """
+        Call send() until it returns a final response, retrying according to the policy
+        """
+        breaker = self.breaker(url)
+        attempt = 0
+        while True:
+            self._check_breaker(breaker, url)
+            try:
+                response = send()
+            except TRANSPORT_ERRORS as e:
+                breaker.record_failure()
+                delay = self._retry_delay(method, attempt, error=e)
+                if delay is None:
+                    raise
+                logger.info(f'{method} {url} failed ({type(e).__name__}), retry in {delay:.1f}s')
+            except Exception:
+                breaker.record_failure()
+                raise
+            except BaseException:
+                # XXX: cancelled (e.g. by asyncio.wait_for) or interrupted, must not leave a half-open trial behind
+                breaker.abandon()
+                raise
+            else:
+                self._record(breaker, response)
+                delay = self._retry_delay(method, attempt, response=response)
+                if delay is None:
+                    return response
+                logger.info(f'{method} {url} returned {response.status_code}, retry in {delay:.1f}s')
+            attempt += 1
+            self.sleep(delay)
+
+    async def execute_async(self, method, url, send):
+        """
+        Like execute, send is a coroutine function
+        """
+        breaker = self.breaker(url)
+        attempt = 0
+        while True:
+            self._check_breaker(breaker, url)
+            try:
+                response = await send()
+            except TRANSPORT_ERRORS as e:
+                breaker.record_failure()
+                delay = self._retry_delay(method, attempt, error=e)
+                if delay is None:
+                    raise
+                logger.info(f'{method} {url} failed ({type(e).__name__}), retry in {delay:.1f}s')
+            except Exception:
+                breaker.record_failure()
+                raise
+            except BaseException:
+                # XXX: cancelled (e.g. by asyncio.wait_for) or interrupted, must not leave a half-open trial behind
+                breaker.abandon()
+                raise
+            else:
+                self._record(breaker, response)
+                delay = self._retry_delay(method, attempt, response=response)
+                if delay is None:
+                    return response
+                logger.info(f'{method} {url} returned {response.status_code}, retry in {delay:.1f}s')
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _check_breaker(self, breaker, url):
+        if not breaker.allow():
+            raise PostcardCreatorCircuitOpenException(f'circuit open for {urlparse(url).netloc}, '
+                                                      f'{breaker.failures} consecutive failures')
+
+    def _record(self, breaker, response):
+        if response.status_code in REJECTED_STATUSES:
+            # XXX: rate limits are per account, one throttled account must not open the circuit for all of them
+            breaker.abandon()
+        elif response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    def _retry_delay(self, method, attempt, response=None, error=None):
+        """
+        Seconds to wait before the next attempt, None if the request must not be repeated
+        """
+        if attempt >= self.max_retries:
+            return None
+
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        if error is not None:
+            if not idempotent and not isinstance(error, NOT_SENT_ERRORS):
+                return None
+            delay = self._backoff(attempt)
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                return None
+            if not idempotent and response.status_code not in REJECTED_STATUSES:
+                return None
+            delay = _retry_after(response.headers.get('Retry-After'))
+            if delay is None:
+                delay = self._backoff(attempt)
+            elif delay > self.max_backoff:
+                # XXX: don't block the scheduler for minutes, the caller sees the 429/503
+                return None
+
+        with self._lock:
+            self.retries += 1
+        return delay
+
+    def _backoff(self, attempt):
+        # full jitter
+        return self.rand() * min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+
+
+def _retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+_request_policy: RequestPolicy | None = None
+_request_policy_lock = threading.Lock()
+
+
+def get_request_policy() -> RequestPolicy:
+    """
+    Process wide policy, configured with POSTCARD_CONNECT_TIMEOUT, POSTCARD_READ_TIMEOUT, POSTCARD_MAX_RETRIES,
+    POSTCARD_BREAKER_THRESHOLD and POSTCARD_BREAKER_RESET (seconds)
+    """
+    global _request_policy
+    with _request_policy_lock:
+        if _request_policy is None:
+            _request_policy = RequestPolicy(
+                connect_timeout=float(os.getenv('POSTCARD_CONNECT_TIMEOUT', 10)),
+                read_timeout=float(os.getenv('POSTCARD_READ_TIMEOUT', 30)),
+                max_retries=int(os.getenv('POSTCARD_MAX_RETRIES', 3)),
+                breaker_threshold=int(os.getenv('POSTCARD_BREAKER_THRESHOLD', 5)),
+                breaker_reset_timeout=float(os.getenv('POSTCARD_BREAKER_RESET', 60)))
+        return _request_policy
+
+
+def set_request_policy(policy: RequestPolicy | None):
+    global _request_policy
+    with _request_policy_lock:
+        _request_policy = policy
@@ -0,0 +1,3 @@
+"""
+Helpers for tests and benchmarks, e.g. a local stand-in for the Post API
+"""
@@ -0,0 +1,229 @@
+"""
+Local stand-in for the Post API: /user/quota, /user/current, /billingOnline/accountSaldo, /card/upload and the
+refresh_token grant of /OAuth/token, with injectable latency, errors and quota exhaustion.
+
+    with FakePostApi(latency=0.05) as api:
+        os.environ['POSTCARD_API_BASE'] = api.url
+"""
+import base64
+import binascii
+import itertools
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+API_PATH = '/secure/api/mobile/v1'
+
+
+class FakeAccount(object):
+    def __init__(self, name, free_cards=1):
+        self.name = name
+        self.free_cards = free_cards
+        self.saldo = 0.0
+        self.orders = []
+
+
+class FakePostApi(object):
+    """
+    Accounts are created on first use. The bearer token 'access-<name>' belongs to account <name>, the refresh
+    token 'refresh-<name>' is exchanged for it.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=503, free_cards=1, seed=None):
+        """
+        :param latency: seconds added to every response, or callable(path) returning seconds
+        :param error_rate: share of requests answered with error_status
+        :param free_cards: free cards per account until the quota is exhausted, None for unlimited
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.free_cards = free_cards
+        self.accounts = {}
+        self.requests = Counter()
+        self._errors = []
+        self._random = random.Random(seed)
+        self._order_ids = itertools.count(1000)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def start(self):
+        api = self
+
+        class Handler(_Handler):
+            fake = api
+
+        self._server = _Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def account(self, name) -> FakeAccount:
+        with self._lock:
+            if name not in self.accounts:
+                self.accounts[name] = FakeAccount(name, self.free_cards)
+            return self.accounts[name]
+
+    def fail_next(self, count=1, status=503, path=None, headers=None):
+        """
+        Answer the next `count` requests (to `path` if given) with status
+        """
+        with self._lock:
+            self._errors += [(path, status, headers or {})] * count
+
+    def exhaust_quota(self, name):
+        self.account(name).free_cards = 0
+
+    def _take_error(self, path):
+        with self._lock:
+            for i, (error_path, status, headers) in enumerate(self._errors):
+                if error_path in (None, path):
+                    del self._errors[i]
+                    return status, headers
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self.error_status, {}
+        return None
+
+    def _delay(self, path):
+        latency = self.latency(path) if callable(self.latency) else self.latency
+        if latency:
+            time.sleep(latency)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients closing keep-alive connections are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fake: FakePostApi = None
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately, don't let Nagle + delayed ACK add 40ms to every response
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_HEAD(self):
+        self._reply(200, b'')
+
+    def _handle(self, method):
+        path = urlparse(self.path).path
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        fake = self.fake
+        with fake._lock:
+            fake.requests[f'{method} {path}'] += 1
+
+        fake._delay(path)
+        error = fake._take_error(path)
+        if error:
+            status, headers = error
+            return self._json(status, {'errors': [f'injected {status}']}, headers)
+
+        if method == 'POST' and path == '/OAuth/token':
+            return self._token(body)
+
+        account = self._authenticate()
+        if account is None:
+            return self._json(401, {'error': 'invalid_token'})
+
+        route = (method, path[len(API_PATH):] if path.startswith(API_PATH) else None)
+        if route == ('GET', '/user/quota'):
+            return self._model(self._quota(account))
+        if route == ('GET', '/user/current'):
+            return self._model({'firstName': account.name, 'name': 'Fake', 'street': 'Wankdorfallee 4',
+                                'city': 'Bern', 'zip': '3030', 'email': f'{account.name}@example.com'})
+        if route == ('GET', '/billingOnline/accountSaldo'):
+            return self._model({'saldo': account.saldo})
+        if route == ('POST', '/card/upload'):
+            return self._upload(account, body)
+        return self._json(404, {'errors': [f'no route {method} {path}']})
+
+    def _authenticate(self):
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer access-'):
+            return None
+        return self.fake.account(authorization[len('Bearer access-'):])
+
+    def _quota(self, account):
+        available = account.free_cards is None or account.free_cards > 0
+        next_free = datetime.now(timezone.utc) + (timedelta(0) if available else timedelta(days=1))
+        return {'quota': -1 if account.free_cards is None else account.free_cards, 'retentionDays': 1,
+                'available': available, 'next': next_free.isoformat()}
+
+    def _token(self, body):
+        data = parse_qs(body.decode('ascii'))
+        refresh_token = data.get('refresh_token', [''])[0]
+        if data.get('grant_type') != ['refresh_token'] or not refresh_token.startswith('refresh-'):
+            return self._json(400, {'error': 'invalid_grant'})
+        name = refresh_token[len('refresh-'):]
+        self.fake.account(name)
+        return self._json(200, {'access_token': f'access-{name}', 'token_type': 'Bearer', 'expires_in': 3600,
+                                'refresh_token': refresh_token})
+
+    def _upload(self, account, body):
+        try:
+            payload = json.loads(body)
+            for field in ('image', 'textImage'):
+                base64.b64decode(payload[field], validate=True)
+            recipients = payload['recipients'] if payload.get('paid') else [payload['recipient']]
+        except (ValueError, KeyError, TypeError, binascii.Error) as e:
+            return self._json(400, {'errors': [f'invalid payload: {e}']})
+
+        with self.fake._lock:
+            if not payload.get('paid'):
+                if account.free_cards is not None and account.free_cards <= 0:
+                    return self._json(200, {'errors': ['no free postcard available']})
+                if account.free_cards is not None:
+                    account.free_cards -= 1
+            order_id = next(self.fake._order_ids)
+            account.orders.append({'orderId': order_id, 'recipients': recipients, 'bytes': len(body)})
+        return self._model({'orderId': order_id})
+
+    def _model(self, model):
+        self._json(200, {'model': model, 'errors': []})
+
+    def _json(self, status, payload, headers=None):
+        self._reply(status, json.dumps(payload).encode('utf-8'), dict(headers or {}, **{
+            'Content-Type': 'application/json'}))
+
+    def _reply(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,143 @@
+import io
+from functools import lru_cache
+
+import pkg_resources
+from PIL import ImageFont
+
+
+@lru_cache(maxsize=None)
+def _font_bytes(font_name) -> bytes:
+    return pkg_resources.resource_string(__name__, font_name)
+
+
+@lru_cache(maxsize=32)
+def load_font(font_name, size) -> ImageFont.FreeTypeFont:
+    """
+    Parsed font of given size, the font file itself is read only once per process
+    """
+    return ImageFont.truetype(io.BytesIO(_font_bytes(font_name)), size)
+
+
+# words and line candidates per font size whose width is remembered
+WIDTH_CACHE_SIZE = 4096
+
+
+class _FontMetrics(object):
+    """
+    Memo of advance widths for one font size, recently used words are measured once
+    """
+
+    def __init__(self, font_name, size):
+        self.font = load_font(font_name, size)
+        ascent, descent = self.font.getmetrics()
+        self.line_height = ascent + descent
+        self.space = self.font.getlength(' ')
+        # XXX: bounded, the metrics live as long as the process and every message brings new words
+        self._widths = lru_cache(maxsize=WIDTH_CACHE_SIZE)(self.font.getlength)
+
+    def width(self, text):
+        return self._widths(text)
+
+
+@lru_cache(maxsize=32)
+def _font_metrics(font_name, size) -> _FontMetrics:
+    return _FontMetrics(font_name, size)
+
+
+class TextLayout(object):
+    def __init__(self, font_name, size, lines, line_height, canvas_w, canvas_h):
+        self.font_name = font_name
+        self.size = size
+        self.lines = lines  # [(text, width)]
+        self.line_height = line_height
+        self.canvas_w = canvas_w
+        self.canvas_h = canvas_h
+
+    @property
+    def font(self) -> ImageFont.FreeTypeFont:
+        return load_font(self.font_name, self.size)
+
+    @property
+    def height(self):
+        return len(self.lines) * self.line_height
+
+    def positions(self):
+        """
+        Yields (x, y, text) for every line, horizontally and vertically centered on the canvas
+        """
+        y = max(0, (self.canvas_h - self.height) // 2)
+        for text, width in self.lines:
+            yield int(self.canvas_w - width) // 2, y, text
+            y += self.line_height
+
+
+def wrap_text(text, metrics: _FontMetrics, max_width) -> list:
+    """
+    Greedily wrap text by measured pixel width. Returns [(line, width)].
+    Line breaks in text are kept, words wider than a line are broken between characters.
+    """
+    lines = []
+    for paragraph in text.splitlines():
+        line, line_w = [], 0
+        for word in paragraph.split():
+            word_w = metrics.width(word)
+            if line and line_w + metrics.space + word_w <= max_width:
+                line.append(word)
+                line_w += metrics.space + word_w
+                continue
+
+            if line:
+                lines.append((' '.join(line), line_w))
+            if word_w <= max_width:
+                line, line_w = [word], word_w
+            else:
+                *pieces, (word, word_w) = _break_word(word, metrics, max_width)
+                lines.extend(pieces)
+                line, line_w = [word], word_w
+
+        lines.append((' '.join(line), line_w))
+    return lines
+
+
+def _break_word(word, metrics: _FontMetrics, max_width):
+    pieces = []
+    start = 0
+    for end in range(1, len(word) + 1):
+        if end - start > 1 and metrics.width(word[start:end]) > max_width:
+            pieces.append((word[start:end - 1], metrics.width(word[start:end - 1])))
+            start = end - 1
+    pieces.append((word[start:], metrics.width(word[start:])))
+    return pieces
+
+
+def layout_text(text, font_name, canvas_w, canvas_h, padding=50, line_padding=70, min_size=20,
+                max_size=400) -> TextLayout:
+    """
+    Find the largest font size for which text, wrapped by measured width, fits the canvas.
+    Larger sizes never need fewer lines, so a single binary search over the size is sufficient.
+    """
+    max_width = canvas_w - 2 * line_padding
+    max_height = canvas_h - 2 * padding
+
+    def fit(size):
+        metrics = _font_metrics(font_name, size)
+        lines = wrap_text(text, metrics, max_width)
+        fits = len(lines) * metrics.line_height <= max_height and all(w <= max_width for _, w in lines)
+        return fits, TextLayout(font_name, size, lines, metrics.line_height, canvas_w, canvas_h)
+
+    fits, best = fit(min_size)
+    if not fits:
+        # does not fit at all, use the smallest size and let it overflow
+        return best
+
+    lo, hi = min_size + 1, max_size
+    while lo <= hi:
+        size = (lo + hi) // 2
+        fits, layout = fit(size)
+        if fits:
+            best = layout
+            lo = size + 1
+        else:
+            hi = size - 1
+
+    return best
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from PIL import Image, ImageOps, features
+
+from postcard_creator.postcard_creator import logger
+
+SIZE_SMALL = 256
+SIZE_MEDIUM = 768
+DEFAULT_SIZES = (SIZE_SMALL, SIZE_MEDIUM)
+STORE_DIR_NAME = 'thumbnails'
+
+
+class ThumbnailStore(object):
+    """
+    Downscaled previews of source images, one file per source and size.
+    Thumbnails are named after the source path and its mtime/size, a changed source therefore never
+    hits an outdated thumbnail. Outdated thumbnails of a source are removed when it is regenerated.
+    """
+
+    def __init__(self, directory: Path, sizes=DEFAULT_SIZES):
+        self.directory = Path(directory)
+        self.sizes = tuple(sizes)
+        self.img_format = 'webp' if features.check('webp') else 'jpeg'
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def thumbnail(self, source: Path, size=SIZE_SMALL) -> Path:
+        """
+        Path to the thumbnail of source with given max edge length, generated on demand
+        """
+        if size not in self.sizes:
+            raise ValueError(f'unsupported thumbnail size {size}, available: {self.sizes}')
+
+        path = self._path(source, size)
+        if not path.is_file():
+            self.generate(source)
+        return path
+
+    def generate(self, source: Path):
+        """
+        Generate all thumbnail sizes of source, e.g. right after upload
+        """
+        source = Path(source)
+        paths = {size: self._path(source, size) for size in self.sizes}
+        if all(p.is_file() for p in paths.values()):
+            return paths
+
+        with Image.open(source) as image:
+            # decode at reduced resolution, we only need the largest thumbnail size
+            image.draft('RGB', (max(self.sizes), max(self.sizes)))
+            image = ImageOps.exif_transpose(image)
+            image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') and self.img_format == 'webp'
+                                  else 'RGB')
+
+            for size in sorted(self.sizes, reverse=True):
+                image.thumbnail((size, size), Image.Resampling.LANCZOS)
+                path = paths[size]
+                tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+                image.save(tmp, self.img_format, quality=80)
+                os.replace(tmp, path)
+
+        self._prune(source, set(paths.values()))
+        logger.debug(f'generated thumbnails for {source}')
+        return paths
+
+    def _source_id(self, source: Path):
+        return hashlib.sha256(str(Path(source).resolve()).encode('utf-8')).hexdigest()[:24]
+
+    def _path(self, source: Path, size) -> Path:
+        stat = Path(source).stat()
+        version = hashlib.sha256(f'{stat.st_mtime_ns}:{stat.st_size}'.encode('ascii')).hexdigest()[:12]
+        extension = 'webp' if self.img_format == 'webp' else 'jpeg'
+        return self.directory.joinpath(f'{self._source_id(source)}_{version}_{size}.{extension}')
+
+    def _prune(self, source: Path, keep: set):
+        for path in self.directory.glob(f'{self._source_id(source)}_*'):
+            if path not in keep:
+                path.unlink(missing_ok=True)
+
+
+_default_store: ThumbnailStore | None = None
+_default_store_lock = threading.Lock()
+
+
+def get_thumbnail_store() -> ThumbnailStore:
+    """
+    Process wide thumbnail store below $DATA_DIR/thumbnails (system temp dir if DATA_DIR is not set)
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            data_dir = os.getenv('DATA_DIR') or tempfile.gettempdir()
+            _default_store = ThumbnailStore(Path(data_dir).joinpath(STORE_DIR_NAME))
+        return _default_store
@@ -10,9 +10,10 @@ from urllib.parse import parse_qs, urlparse
 import requests
 from bs4 import BeautifulSoup
 from requests.adapters import HTTPAdapter
-from requests_toolbelt.utils import dump
 from urllib3 import Retry
 
+from postcard_creator import request_policy, transport
+from postcard_creator.tracing import trace_response
 from postcard_creator.postcard_creator import PostcardCreatorException, PostcardCreatorTokenInvalidException
 
 LOGGING_TRACE_LVL = 5
@@ -32,35 +33,11 @@ def base64_decode(string):
     return base64.urlsafe_b64decode(string)
 
 
-def _log_response(h):
-    for h in h.history:
-        logger.debug(h.request.method + ': ' + str(h) + ' ' + h.url)
-    logger.debug(h.request.method + ': ' + str(h) + ' ' + h.url)
-
-
-def _print_request(response):
-    logger.debug(' {} {} [{}]'.format(response.request.method, response.request.url, response.status_code))
-
-
-def _dump_request(response):
-    _print_request(response)
-    data = dump.dump_all(response)
-    try:
-        logger.debug(data.decode())
-    except Exception:
-        data = str(data).replace('\\r\\n', '\r\n')
-        logger.debug(data)
-
-
-def _log_and_dump(r):
-    _log_response(r)
-    _dump_request(r)
-
-
 class NoopToken:
     def __init__(self, token):
         self.token = token
         self.token_implementation = 'swissid'
+        self.account_id = None
 
 
 class Token(object):
@@ -92,6 +69,7 @@ class Token(object):
         self.cache_token = False
         self.refresh_token = None
         self.token_implementation = None
+        self.account_id = None  # stable per account, e.g. the token file, see account_cache
 
     def has_valid_credentials(self, username, password):
         try:
@@ -111,6 +89,20 @@ class Token(object):
 
         self.set_auth_info(access_token, token_handler)
 
+    async def fetch_token_by_refresh_token_async(self, refresh_token: str, token_handler):
+        """
+        Like fetch_token_by_refresh_token, token_handler is awaited
+        """
+        try:
+            access_token = await self.post_refresh_token_async(refresh_token)
+            logger.debug('swissid refresh_token authentication was successful')
+        except Exception as e:
+            logger.info("swissid refresh_token authentication failed")
+            logger.info(e)
+            raise e
+
+        await self.set_auth_info_async(access_token, token_handler)
+
     def authenticate_username_password(self, username, password) -> None:
         logger.debug('fetching postcard account token')
 
@@ -129,13 +121,7 @@ class Token(object):
 
     def set_auth_info(self, access_token: dict, token_handler):
         try:
-            logger.debug(access_token)
-            self.token = access_token['access_token']
-            self.token_type = access_token['token_type']
-            self.token_expires_in = access_token['expires_in']
-            self.refresh_token = access_token['refresh_token']
-            self.token_fetched_at = datetime.datetime.now()
-            self.token_implementation = 'swissid'
+            self._apply_auth_info(access_token)
             token_handler(access_token, self)
             logger.info("access_token successfully fetched")
 
@@ -143,6 +129,25 @@ class Token(object):
             logger.info("access_token does not contain required values. someting broke")
             raise e
 
+    async def set_auth_info_async(self, access_token: dict, token_handler):
+        try:
+            self._apply_auth_info(access_token)
+            await token_handler(access_token, self)
+            logger.info("access_token successfully fetched")
+
+        except Exception as e:
+            logger.info("access_token does not contain required values. someting broke")
+            raise e
+
+    def _apply_auth_info(self, access_token: dict):
+        logger.debug(access_token)
+        self.token = access_token['access_token']
+        self.token_type = access_token['token_type']
+        self.token_expires_in = access_token['expires_in']
+        self.refresh_token = access_token['refresh_token']
+        self.token_fetched_at = datetime.datetime.now()
+        self.token_implementation = 'swissid'
+
     @staticmethod
     def _create_session(retries=5, backoff_factor=0.5, status_forcelist=(500, 502, 504)):
         # XXX: Backend will terminate connection if we request too frequently
@@ -189,7 +194,7 @@ class Token(object):
         resp = session.get(url + urllib.parse.urlencode(init_data),
                            allow_redirects=True,
                            headers=self.swissid_headers)
-        _log_and_dump(resp)
+        trace_response(resp)
 
         saml_payload = {
             'externalIDP': 'externalIDP'
@@ -203,7 +208,7 @@ class Token(object):
                             data=saml_payload,
                             allow_redirects=True,
                             headers=self.swissid_headers)
-        _log_and_dump(resp)
+        trace_response(resp)
         if len(resp.history) == 0:
             raise PostcardCreatorException('fail to fetch ' + url)
 
@@ -221,18 +226,18 @@ class Token(object):
         url = "https://login.swissid.ch/api-login/authenticate/token/status?locale=en&goto=" + goto_param + \
               "&acr_values=loa-1&realm=%2Fsesam&service=qoa1"
         resp = session.get(url, allow_redirects=True)
-        _log_and_dump(resp)
+        trace_response(resp)
 
         url = "https://login.swissid.ch/api-login/welcome-pack?locale=en" + goto_param + \
               "&acr_values=loa-1&realm=%2Fsesam&service=qoa1"
         resp = session.get(url, allow_redirects=True)
-        _log_and_dump(resp)
+        trace_response(resp)
 
         # login with username and password
         url = 'https://login.swissid.ch/api-login/authenticate/init?locale=en&goto=' + goto_param + \
               "&acr_values=loa-1&realm=%2Fsesam&service=qoa1"
         resp = session.post(url, allow_redirects=True)
-        _log_and_dump(resp)
+        trace_response(resp)
 
         # submit username and password
         self.url_query_string = "locale=en&goto=" + goto_param + \
@@ -247,7 +252,7 @@ class Token(object):
             'password': password
         }
         resp = session.post(url, json=step_data, headers=headers, allow_redirects=True)
-        _log_and_dump(resp)
+        trace_response(resp)
 
         resp_json: dict = resp.json()
         if "errorCode" in resp_json and resp_json["errorCode"] == "INVALID_USERNAME_PASSWORD":
@@ -268,12 +273,12 @@ class Token(object):
             raise PostcardCreatorException("failed to login, username/password wrong?")
 
         resp = session.get(url, headers=self.swissid_headers, allow_redirects=True)
-        _log_and_dump(resp)
+        trace_response(resp)
 
         step7_soup = BeautifulSoup(resp.text, 'html.parser')
         url = step7_soup.find('form', {'name': 'LoginForm'})['action']
         resp = session.post(url, headers=self.swissid_headers)
-        _log_and_dump(resp)
+        trace_response(resp)
 
         # find saml response
         step7_soup = BeautifulSoup(resp.text, 'html.parser')
@@ -313,29 +318,44 @@ class Token(object):
             'redirect_uri': self.redirect_uri,
         }
         url = 'https://pccweb.api.post.ch/OAuth/token'
-        resp = requests.post(url,  # we do not use session here!
-                             data=data,
-                             headers=self.swissid_headers,
-                             allow_redirects=False)
-        _log_and_dump(resp)
+        resp = transport.new_session().post(url,  # we do not use login session here!
+                                            data=data,
+                                            headers=self.swissid_headers,
+                                            allow_redirects=False)
+        trace_response(resp)
 
         if 'access_token' not in resp.json() or resp.status_code != 200:
             raise PostcardCreatorException("not able to fetch access token: " + resp.text)
 
         self.set_auth_info(resp.json(), token_handler)
 
-    def post_refresh_token(self, refresh_token: str):
-        url = 'https://pccweb.api.post.ch/OAuth/token'
-        data = {
+    def _refresh_token_data(self, refresh_token: str):
+        return {
             'grant_type': 'refresh_token',
             'refresh_token': refresh_token,
             'client_id': self.client_id,
             'client_secret': self.client_secret,
         }
 
-        resp = requests.post(url, headers=self.swissid_headers, data=data)
-        _log_and_dump(resp)
+    def post_refresh_token(self, refresh_token: str):
+        url = transport.api_base() + '/OAuth/token'
+        # XXX: never retried, the refresh token may already be rotated when the response got lost
+        resp = transport.new_session().post(url, headers=self.swissid_headers,
+                                            data=self._refresh_token_data(refresh_token),
+                                            timeout=request_policy.get_request_policy().timeout())
+        trace_response(resp)
+        return self._parse_token_response(resp)
+
+    async def post_refresh_token_async(self, refresh_token: str):
+        url = transport.api_base() + '/OAuth/token'
+        async with transport.new_async_client() as client:
+            resp = await client.post(url, headers=self.swissid_headers, data=self._refresh_token_data(refresh_token),
+                                     timeout=request_policy.get_request_policy().httpx_timeout())
+        trace_response(resp)
+        return self._parse_token_response(resp)
 
+    @staticmethod
+    def _parse_token_response(resp):
         json_resp = resp.json()
 
         if 'error' in json_resp:
@@ -364,7 +384,7 @@ class Token(object):
             headers = self.swissid_headers
             headers['authId'] = auth_id_device_print
             resp = session.post(url, json=device_print, headers=headers)
-            _log_and_dump(resp)
+            trace_response(resp)
         except Exception as e:
             msg = "Anomaly detection step failed. \n" \
                   + f"pending request: {url} \n"
@@ -415,6 +435,17 @@ class Token(object):
             'implementation': self.token_implementation
         }
 
+    def load_json(self, data: dict):
+        """
+        Counterpart of to_json, use a stored token without refreshing it
+        """
+        self.token = data['token']
+        self.token_type = data.get('type')
+        self.token_expires_in = data.get('expires_in')
+        self.refresh_token = data['refresh_token']
+        self.token_fetched_at = datetime.datetime.fromtimestamp(data['fetched_at']) if data.get('fetched_at') else None
+        self.token_implementation = data.get('implementation') or 'swissid'
+
     def authenticate_mtan(self, code):
         url = "https://login.swissid.ch/api-login/authenticate/mtan?" + self.url_query_string
         data = {
@@ -423,7 +454,7 @@ class Token(object):
         headers = self.swissid_headers
         headers["authId"] = self.auth_id
 
-        response = requests.post(url, headers=headers, json=data, verify=False)
+        response = transport.new_session().post(url, headers=headers, json=data, verify=False)
 
         if response.status_code == 200:
             resp_json = response.json()
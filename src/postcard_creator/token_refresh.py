@@ -0,0 +1,74 @@
+import asyncio
+import os
+import threading
+import time
+
+DEFAULT_SKEW = 5 * 60  # refresh this long before the access token expires
+DEFAULT_PREREFRESH_WINDOW = 15 * 60  # background refresh of tokens expiring within this window
+DEFAULT_PREREFRESH_INTERVAL = 60
+
+
+def refresh_skew():
+    return float(os.getenv('POSTCARD_TOKEN_REFRESH_SKEW', DEFAULT_SKEW))
+
+
+def expires_at(token_data: dict):
+    """
+    Unix time the access token of a stored token (Token.to_json) expires
+    """
+    if not token_data.get('token') or not token_data.get('fetched_at') or not token_data.get('expires_in'):
+        return 0
+    return token_data['fetched_at'] + token_data['expires_in']
+
+
+def needs_refresh(token_data: dict, skew=None, now=None):
+    skew = refresh_skew() if skew is None else skew
+    now = time.time() if now is None else now
+    return expires_at(token_data) - skew <= now
+
+
+class SingleFlight(object):
+    """
+    Concurrent calls with the same key share the result of one execution.
+    Threads and asyncio tasks are deduplicated separately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+
+    def run(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not leader:
+            call['done'].wait()
+        else:
+            try:
+                call['result'] = fn()
+            except BaseException as e:
+                call['error'] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call['done'].set()
+
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+    async def run_async(self, key, coro_fn):
+        key = (asyncio.get_running_loop(), key)
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(coro_fn())
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        # XXX: a cancelled waiter must not cancel the refresh of the others
+        return await asyncio.shield(task)
+
+
+flights = SingleFlight()
@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+from cryptography.fernet import Fernet, MultiFernet
+
+
+def make_cipher(keys: str | bytes) -> MultiFernet:
+    """
+    Cipher for a comma separated list of keys, e.g. ENC_KEY=new,old.
+    The first key encrypts, all keys decrypt.
+    """
+    if isinstance(keys, bytes):
+        keys = keys.decode()
+    return MultiFernet([Fernet(key.strip()) for key in keys.split(',') if key.strip()])
+
+
+class _Record(object):
+    def __init__(self, stat, plain_text: bytearray):
+        self.stat = stat
+        self.plain_text = plain_text
+
+    def wipe(self):
+        self.plain_text[:] = b'\0' * len(self.plain_text)
+
+
+def _stat_key(path: Path):
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+class TokenVault(object):
+    """
+    Decrypted token files kept in memory, a file is read and decrypted again only if its mtime or size changed.
+    Plain texts are kept as bytearray and overwritten with zeros when evicted.
+    """
+
+    def __init__(self, key: str | bytes):
+        self._fernet = make_cipher(key)
+        self._records = {}
+        self._lock = threading.Lock()
+        self.reads = 0
+
+    def get(self, file_path: Path) -> dict:
+        """
+        Token of file_path (Token.to_json), a new dict on every call
+        """
+        path = Path(file_path).resolve()
+        stat = _stat_key(path)
+        with self._lock:
+            record = self._records.get(path)
+            if record is not None and record.stat == stat:
+                return json.loads(record.plain_text)
+
+        with open(path, 'rb') as token_file:
+            plain_text = bytearray(self._fernet.decrypt(token_file.read()))
+        self.reads += 1
+        token = json.loads(plain_text)
+        self._replace(path, _Record(stat, plain_text))
+        return token
+
+    def put(self, file_path: Path, token: dict):
+        """
+        Encrypt and store token, atomic so a concurrent get never sees a partially written file
+        """
+        path = Path(file_path).resolve()
+        plain_text = bytearray(json.dumps(token).encode())
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp, 'wb') as token_file:
+            token_file.write(self._fernet.encrypt(bytes(plain_text)))
+        os.replace(tmp, path)
+        self._replace(path, _Record(_stat_key(path), plain_text))
+
+    def evict(self, file_path: Path):
+        self._replace(Path(file_path).resolve(), None)
+
+    def clear(self):
+        with self._lock:
+            records, self._records = self._records, {}
+        for record in records.values():
+            record.wipe()
+
+    def _replace(self, path, record):
+        with self._lock:
+            old = self._records.pop(path, None)
+            if record is not None:
+                self._records[path] = record
+        if old is not None:
+            old.wipe()
+
+
+_token_vault: TokenVault | None = None
+_token_vault_key = None
+_token_vault_lock = threading.Lock()
+
+
+def get_token_vault() -> TokenVault:
+    """
+    Process wide vault for the keys in ENC_KEY, changed keys start an empty vault
+    """
+    global _token_vault, _token_vault_key
+    key = os.getenv('ENC_KEY')
+    with _token_vault_lock:
+        if _token_vault is None or _token_vault_key != key:
+            if _token_vault is not None:
+                _token_vault.clear()
+            _token_vault, _token_vault_key = TokenVault(key), key
+        return _token_vault
+
+
+def set_token_vault(vault: TokenVault | None):
+    global _token_vault, _token_vault_key
+    with _token_vault_lock:
+        if _token_vault is not None and _token_vault is not vault:
+            _token_vault.clear()
+        _token_vault = vault
+        _token_vault_key = os.getenv('ENC_KEY') if vault is not None else None
@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+from logging.handlers import RotatingFileHandler
+
+import httpx
+import requests
+from requests_toolbelt.utils import dump
+
+logger = logging.getLogger('postcard_creator')
+
+DEFAULT_MAX_BODY = 2048
+DEFAULT_DUMP_FILE_BYTES = 10 * 1024 * 1024
+DEFAULT_DUMP_FILE_BACKUPS = 3
+REDACTED_HEADERS = ('authorization', 'cookie', 'set-cookie')
+
+dump_logger = logging.getLogger('postcard_creator.http_dump')
+dump_logger.propagate = False
+
+_dump_file_lock = threading.Lock()
+_dump_file_configured = False
+_dump_file_handler = None
+
+
+def configure_dump_file(path, max_bytes=DEFAULT_DUMP_FILE_BYTES, backup_count=DEFAULT_DUMP_FILE_BACKUPS):
+    """
+    Write complete, untruncated request/response dumps to a rotating file. Bodies and credentials included!
+    """
+    global _dump_file_configured, _dump_file_handler
+    with _dump_file_lock:
+        if _dump_file_handler:
+            dump_logger.removeHandler(_dump_file_handler)
+            _dump_file_handler.close()
+            _dump_file_handler = None
+        if path:
+            _dump_file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+            dump_logger.addHandler(_dump_file_handler)
+            dump_logger.setLevel(logging.DEBUG)
+        _dump_file_configured = True
+
+
+def _dump_file_enabled():
+    if not _dump_file_configured:
+        configure_dump_file(os.getenv('POSTCARD_TRACE_FILE'),
+                            max_bytes=int(os.getenv('POSTCARD_TRACE_FILE_BYTES', DEFAULT_DUMP_FILE_BYTES)))
+    return _dump_file_handler is not None
+
+
+def trace_response(response, max_body=None):
+    """
+    Trace a request/response exchange (including redirects), of requests or httpx.
+    Nothing is formatted unless the postcard_creator logger is enabled for DEBUG or a dump file is set.
+    On DEBUG, credentials are redacted and bodies are truncated to max_body bytes (POSTCARD_TRACE_MAX_BODY).
+    """
+    debug = logger.isEnabledFor(logging.DEBUG)
+    dump_file = _dump_file_enabled()
+    if not debug and not dump_file:
+        return
+
+    if max_body is None:
+        max_body = int(os.getenv('POSTCARD_TRACE_MAX_BODY', DEFAULT_MAX_BODY))
+
+    for r in list(response.history) + [response]:
+        if debug:
+            logger.debug(' {} {} [{}] {}'.format(r.request.method, r.request.url, r.status_code, _elapsed(r)))
+            logger.debug(_format_exchange(r, max_body))
+        if dump_file:
+            if isinstance(r, requests.Response):
+                dump_logger.debug(dump.dump_response(r).decode('utf-8', 'replace'))
+            else:
+                dump_logger.debug(_format_exchange(r, max_body=None, redact=False))
+
+
+def _format_exchange(response, max_body, redact=True):
+    request = response.request
+    lines = [f'< {request.method} {request.url}']
+    lines += [f'< {name}: {_header_value(name, value, redact)}' for name, value in request.headers.items()]
+    lines.append('<')
+    lines.append('< ' + _format_body(_request_body(request), max_body))
+    reason = response.reason if isinstance(response, requests.Response) else response.reason_phrase
+    lines.append(f'> {response.status_code} {reason}')
+    lines += [f'> {name}: {_header_value(name, value, redact)}' for name, value in response.headers.items()]
+    lines.append('>')
+    lines.append('> ' + _format_body(response.content, max_body))
+    return '\n'.join(lines)
+
+
+def _elapsed(response):
+    try:
+        return '{:.0f}ms'.format(response.elapsed.total_seconds() * 1000)
+    except RuntimeError:
+        # httpx, response of a mock transport is never closed
+        return '-'
+
+
+def _request_body(request):
+    if hasattr(request, 'body'):
+        return request.body
+    # httpx, content of a streamed request is not kept
+    try:
+        return request.content
+    except httpx.RequestNotRead:
+        return request.stream
+
+
+def _header_value(name, value, redact=True):
+    if redact and name.lower() in REDACTED_HEADERS:
+        return '<redacted>'
+    return value
+
+
+def _format_body(body, max_body):
+    if not body:
+        return ''
+    if not isinstance(body, (bytes, str)):
+        # e.g. a streamed upload, reading it here would consume it
+        try:
+            size = f'{len(body)} bytes'
+        except TypeError:
+            size = 'unknown size'
+        return f'<streamed body, {size}>'
+
+    if max_body is None:
+        max_body = len(body)
+    if isinstance(body, bytes):
+        text = body[:max_body].decode('utf-8', 'replace')
+    else:
+        text = body[:max_body]
+    if len(body) > max_body:
+        text += f'... <{len(body) - max_body} more bytes elided>'
+    return text
@@ -0,0 +1,188 @@
+import asyncio
+import os
+import socket
+import threading
+import weakref
+from urllib.parse import urlparse
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from postcard_creator.postcard_creator import logger
+
+DEFAULT_POOL_CONNECTIONS = 4  # number of hosts with their own connection pool
+DEFAULT_POOL_MAXSIZE = 10  # connections kept alive per host
+DEFAULT_API_BASE = 'https://pccweb.api.post.ch'
+DEFAULT_WARM_UP_URLS = (DEFAULT_API_BASE + '/',)
+# XXX: httpx defaults to 5s, too short for a card upload on a slow uplink
+DEFAULT_ASYNC_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+
+def _socket_options():
+    options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 20),
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)]
+    return options
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter with TCP keep-alive, pooled connections which idle between two quota checks are
+    probed by the OS instead of failing on first use
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = _socket_options()
+        super().init_poolmanager(*args, **kwargs)
+
+
+class _SharedPoolSession(requests.Session):
+    """
+    Session with its own cookies and headers but connections from the process wide pool
+    """
+
+    def close(self):
+        # adapters are shared with every other session, closing them would drop all pooled connections
+        pass
+
+
+class _SharedPoolAsyncTransport(httpx.AsyncHTTPTransport):
+    """
+    Async counterpart of _SharedPoolSession, closing a client keeps the pooled connections
+    """
+
+    async def aclose(self):
+        pass
+
+    async def __aexit__(self, *args):
+        # XXX: `async with AsyncClient()` exits its transport instead of closing it
+        pass
+
+    async def aclose_pool(self):
+        await super().aclose()
+
+
+class Transport(object):
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_block=False, host_pool_sizes: dict | None = None):
+        """
+        :param host_pool_sizes: {'pccweb.api.post.ch': 20}, pool size for individual https hosts
+        """
+        self.adapter = _KeepAliveAdapter(pool_connections=pool_connections,
+                                         pool_maxsize=pool_maxsize,
+                                         pool_block=pool_block)
+        self.host_adapters = {
+            host: _KeepAliveAdapter(pool_connections=1, pool_maxsize=size, pool_block=pool_block)
+            for host, size in (host_pool_sizes or {}).items()
+        }
+        # httpx connections are bound to the event loop they were opened in, one pool per loop
+        self.async_limits = httpx.Limits(max_connections=pool_maxsize if pool_block else None,
+                                         max_keepalive_connections=pool_maxsize + sum((host_pool_sizes or {}).values()))
+        self._async_transports = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
+
+    def new_session(self) -> requests.Session:
+        session = _SharedPoolSession()
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        for host, adapter in self.host_adapters.items():
+            session.mount(f'https://{host}', adapter)
+        return session
+
+    def new_async_client(self) -> httpx.AsyncClient:
+        """
+        AsyncClient with its own cookies but connections from the pool of the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            pool = self._async_transports.get(loop)
+            if pool is None:
+                pool = _SharedPoolAsyncTransport(limits=self.async_limits, socket_options=_socket_options())
+                self._async_transports[loop] = pool
+        return httpx.AsyncClient(transport=pool, timeout=DEFAULT_ASYNC_TIMEOUT)
+
+    async def aclose(self):
+        """
+        Close the async pool of the running event loop
+        """
+        with self._async_lock:
+            pool = self._async_transports.pop(asyncio.get_running_loop(), None)
+        if pool:
+            await pool.aclose_pool()
+
+    def warm_up(self, urls=DEFAULT_WARM_UP_URLS, timeout=5):
+        """
+        Open a pooled connection (TCP + TLS) to every url ahead of the first real request
+        """
+        session = self.new_session()
+        warmed = 0
+        for url in urls:
+            try:
+                session.head(url, timeout=timeout, allow_redirects=False)
+                warmed += 1
+            except requests.RequestException as e:
+                logger.info(f'warm-up of {urlparse(url).netloc} failed: {e}')
+        return warmed
+
+    def close(self):
+        self.adapter.close()
+        for adapter in self.host_adapters.values():
+            adapter.close()
+
+
+_transport: Transport | None = None
+_transport_lock = threading.Lock()
+
+
+def configure_transport(**kwargs) -> Transport:
+    """
+    Replace the process wide transport, see Transport for arguments
+    """
+    global _transport
+    with _transport_lock:
+        old, _transport = _transport, Transport(**kwargs)
+    if old:
+        old.close()
+    return _transport
+
+
+def get_transport() -> Transport:
+    """
+    Process wide transport, pool sizes can be set with POSTCARD_HTTP_POOL_CONNECTIONS, POSTCARD_HTTP_POOL_MAXSIZE
+    and POSTCARD_HTTP_HOST_POOL_SIZES (host=size,host=size)
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            host_pool_sizes = {}
+            for item in filter(None, os.getenv('POSTCARD_HTTP_HOST_POOL_SIZES', '').split(',')):
+                host, _, size = item.partition('=')
+                host_pool_sizes[host.strip()] = int(size)
+
+            _transport = Transport(
+                pool_connections=int(os.getenv('POSTCARD_HTTP_POOL_CONNECTIONS', DEFAULT_POOL_CONNECTIONS)),
+                pool_maxsize=int(os.getenv('POSTCARD_HTTP_POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE)),
+                host_pool_sizes=host_pool_sizes)
+        return _transport
+
+
+def api_base():
+    """
+    Scheme and host of the Post API and its OAuth endpoints, POSTCARD_API_BASE points clients to e.g. a fake server
+    """
+    return os.getenv('POSTCARD_API_BASE', DEFAULT_API_BASE).rstrip('/')
+
+
+def new_session() -> requests.Session:
+    return get_transport().new_session()
+
+
+def new_async_client() -> httpx.AsyncClient:
+    return get_transport().new_async_client()
+
+
+def warm_up(urls=DEFAULT_WARM_UP_URLS, timeout=5):
+    return get_transport().warm_up(urls, timeout=timeout)
@@ -0,0 +1,89 @@
+import base64
+import json
+
+# multiple of 3, base64 of every chunk but the last has no padding and can be concatenated
+CHUNK_SIZE = 3 * 16 * 1024
+
+
+class Base64Field(object):
+    """
+    Binary payload value, serialized as base64 string when the body is streamed
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+
+    def __len__(self):
+        return 4 * ((len(self.data) + 2) // 3)
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        for i in range(0, len(self.data), chunk_size):
+            yield base64.b64encode(self.data[i:i + chunk_size])
+
+
+class JsonStreamBody(object):
+    """
+    File-like JSON request body which base64 encodes Base64Field values chunk by chunk while it is read.
+    Output equals json.dumps(payload) with binary fields as base64 strings, but peak memory is bounded
+    by the chunk size instead of the payload size. The length is known upfront, so requests sends a
+    Content-Length header instead of chunked transfer encoding.
+    """
+
+    def __init__(self, payload: dict, chunk_size=CHUNK_SIZE):
+        self.payload = payload
+        self.chunk_size = chunk_size
+        self._length = sum(len(part) for part in self._parts())
+        self._iter = None
+        self._buffer = b''
+
+    def __len__(self):
+        return self._length
+
+    def copy(self):
+        """
+        Unread body with the same payload
+        """
+        return JsonStreamBody(self.payload, self.chunk_size)
+
+    def __iter__(self):
+        for part in self._parts():
+            if isinstance(part, Base64Field):
+                yield from part.chunks(self.chunk_size)
+            else:
+                yield part
+
+    async def aiter_chunks(self):
+        # XXX: for httpx.AsyncClient, which only streams async iterables and would treat self as sync iterable
+        for chunk in self:
+            yield chunk
+
+    def read(self, size=-1):
+        if self._iter is None:
+            self._iter = iter(self)
+
+        if size is None or size < 0:
+            data = self._buffer + b''.join(self._iter)
+            self._buffer = b''
+            return data
+
+        while len(self._buffer) < size:
+            try:
+                self._buffer += next(self._iter)
+            except StopIteration:
+                break
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _parts(self):
+        yield b'{'
+        for i, (key, value) in enumerate(self.payload.items()):
+            prefix = ', ' if i else ''
+            yield f'{prefix}{json.dumps(key)}: '.encode('utf-8')
+            if isinstance(value, Base64Field):
+                yield b'"'
+                yield value
+                yield b'"'
+            else:
+                yield json.dumps(value).encode('utf-8')
+        yield b'}'
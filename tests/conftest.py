@@ -0,0 +1,37 @@
+import pytest
+
+from postcard_creator import account_cache, account_pool, account_state, account_store, request_policy, token_vault
+
+
+@pytest.fixture(autouse=True)
+def fresh_account_cache():
+    # quota/user info are cached process wide, don't leak responses between tests
+    account_cache.set_account_cache(None)
+    yield
+    account_cache.set_account_cache(None)
+
+
+@pytest.fixture(autouse=True)
+def fresh_request_policy():
+    # circuit breakers are per host and process wide
+    request_policy.set_request_policy(None)
+    yield
+    request_policy.set_request_policy(None)
+
+
+@pytest.fixture(autouse=True)
+def fresh_token_vault():
+    token_vault.set_token_vault(None)
+    account_store.set_account_store(None)
+    yield
+    token_vault.set_token_vault(None)
+    account_store.set_account_store(None)
+
+
+@pytest.fixture(autouse=True)
+def fresh_account_pool():
+    account_pool.set_account_pool(None)
+    account_state.set_account_state(None)
+    yield
+    account_pool.set_account_pool(None)
+    account_state.set_account_state(None)
@@ -0,0 +1,75 @@
+import requests_mock
+
+from postcard_creator.account_cache import QUOTA, USER_INFO, AccountCache, get_account_cache
+from postcard_creator.postcard_creator import Postcard, Recipient, Sender
+from postcard_creator.postcard_creator_swissid import PostcardCreatorSwissId
+from postcard_creator import postcard_creator_swissid
+from postcard_creator.token import NoopToken
+
+URL_API = 'https://pccweb.api.post.ch/secure/api/mobile/v1'
+
+
+class Clock(object):
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_ttl():
+    clock = Clock()
+    cache = AccountCache({QUOTA: 10}, clock=clock)
+    cache.put('a', QUOTA, {'available': True})
+
+    assert cache.get('a', QUOTA) == {'available': True}
+    assert cache.get('b', QUOTA) is None
+    clock.now = 10
+    assert cache.get('a', QUOTA) is None
+    assert cache.stats()[QUOTA] == {'hits': 1, 'misses': 2}
+
+
+def test_invalidate_single_kind_of_account():
+    cache = AccountCache()
+    for account in ('a', 'b'):
+        cache.put(account, QUOTA, {})
+        cache.put(account, USER_INFO, {})
+
+    cache.invalidate('a', QUOTA)
+    assert cache.get('a', QUOTA) is None
+    assert cache.get('a', USER_INFO) == {}
+    assert cache.get('b', QUOTA) == {}
+
+
+def test_zero_ttl_disables_cache():
+    cache = AccountCache({USER_INFO: 0})
+    cache.put('a', USER_INFO, {})
+    assert cache.get('a', USER_INFO) is None
+
+
+def test_send_makes_one_quota_call(monkeypatch):
+    monkeypatch.setattr(postcard_creator_swissid, '_render_card_images', lambda *a, **kw: (b'1', b'2', None))
+    person = dict(prename='prename', lastname='lastname', street='street 1', zip_code=8000, place='Zürich')
+    postcard = Postcard(sender=Sender(**person), recipient=Recipient(**person),
+                        picture_stream=None, message_image_stream=None)
+    token = NoopToken('token')
+    token.account_id = 'max_muster-token.json.enc'
+
+    with requests_mock.Mocker() as m:
+        quota = m.get(URL_API + '/user/quota', json={'model': {'available': True, 'next': None}})
+        user = m.get(URL_API + '/user/current', json={'model': {'firstName': 'Max'}})
+        m.post(URL_API + '/card/upload', json={'model': {'orderId': 42}})
+
+        client = PostcardCreatorSwissId(token)
+        assert client.get_quota()['available']  # check_credits
+        client.get_user_info()  # after token refresh
+        client.get_user_info()  # build_sender
+        client.send_free_card(postcard)
+
+        assert quota.call_count == 1
+        assert user.call_count == 1
+
+        # the upload used the free card, next lookup goes to the api
+        client.get_quota()
+        assert quota.call_count == 2
+
+    assert get_account_cache().stats()[USER_INFO] == {'hits': 1, 'misses': 1}
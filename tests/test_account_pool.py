@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from postcard_creator.account_pool import AccountPool
+
+
+def test_lease_is_exclusive_across_threads(tmp_path):
+    pool = AccountPool(tmp_path)
+    active, overlaps = [], []
+
+    def work():
+        with pool.lease('anna', timeout=5) as account:
+            if active:
+                overlaps.append(1)
+            active.append(account)
+            time.sleep(0.01)
+            active.remove(account)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not overlaps
+    assert pool.leased() == set()
+    assert pool.get('anna') is pool.get('anna')
+
+
+def test_try_lease_and_timeout(tmp_path):
+    pool = AccountPool(tmp_path)
+    lease = pool.try_lease('anna')
+    assert pool.try_lease('anna') is None
+    assert pool.try_lease('ben') is not None
+    with pytest.raises(TimeoutError):
+        pool.lease('anna', timeout=0.05)
+
+    lease.release()
+    lease.release()
+    assert pool.try_lease('anna') is not None
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_async_waiter_is_woken_by_thread(tmp_path, anyio_backend):
+    pool = AccountPool(tmp_path)
+    lease = pool.lease('anna')
+    threading.Timer(0.05, lease.release).start()
+
+    async with await pool.lease_async('anna', timeout=2) as account:
+        assert account.ref == 'anna'
+        with pytest.raises(TimeoutError):
+            await pool.lease_async('anna', timeout=0.05)
+    assert pool.leased() == set()
+
+    # a cancelled waiter doesn't hold a lease
+    holder = pool.try_lease('anna')
+    waiter = asyncio.ensure_future(pool.lease_async('anna'))
+    await asyncio.sleep(0.01)
+    waiter.cancel()
+    holder.release()
+    await asyncio.sleep(0.01)
+    assert pool.leased() == set()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_token_is_decrypted_off_the_event_loop(tmp_path, monkeypatch, anyio_backend):
+    account = AccountPool(tmp_path).get('anna')
+    threads = []
+
+    def decrypt_token(ref):
+        threads.append(threading.current_thread())
+        account.provider.token_data = {}
+
+    monkeypatch.setattr(account.provider, 'decrypt_token', decrypt_token)
+    assert not await account._is_current_async(None)
+    assert threads and threads[0] is not threading.current_thread()
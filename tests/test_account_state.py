@@ -0,0 +1,87 @@
+import json
+import time
+
+import pytest
+from cryptography.fernet import Fernet
+
+from postcard_creator import request_policy
+from postcard_creator.account_pool import AccountPool
+from postcard_creator.account_state import AccountState
+from postcard_creator.quota_probe import probe_accounts
+from postcard_creator.request_policy import RequestPolicy
+from postcard_creator.testing.fake_post_api import FakePostApi
+from postcard_creator.token_vault import TokenVault
+
+
+class Clock(object):
+    now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_save_and_load(tmp_path):
+    path = tmp_path.joinpath('state.json')
+    state = AccountState(path)
+    state.update('anna', user_info={'firstName': 'Anna'})
+    state.record_probe('anna', quota={'available': False, 'next': '2024-01-02T00:00:00+00:00'})
+    state.record_probe('ben', error=ValueError('boom'))
+    state.save()
+
+    loaded = AccountState(path).get('anna')
+    assert loaded['user_info'] == {'firstName': 'Anna'}
+    assert loaded['next'] == '2024-01-02T00:00:00+00:00'
+    assert AccountState(path).get('ben')['error'] == "ValueError('boom')"
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_status_has_no_user_info():
+    state = AccountState(clock=Clock())
+    state.update('anna', user_info={'firstName': 'Anna', 'street': 'Gasse 1'}, refreshed_at=50)
+    state.record_probe('anna', quota={'available': True, 'next': '2024-01-02T00:00:00+00:00'})
+
+    assert state.status() == {'anna': {'quota': {'available': True, 'next': '2024-01-02T00:00:00+00:00'},
+                                       'next': '2024-01-02T00:00:00+00:00', 'probed_at': 100.0, 'error': None}}
+
+
+def test_newer_probe_wins_across_processes(tmp_path):
+    path = tmp_path.joinpath('state.json')
+    clock = Clock()
+    api, app = AccountState(path, clock=clock), AccountState(path, clock=clock)
+
+    api.record_probe('anna', quota={'available': True})
+    clock.now = 200
+    app.record_probe('anna', quota={'available': False})
+    app.record_probe('ben', quota={'available': True})
+    app.save()
+    api.save()
+
+    saved = json.loads(path.read_text())
+    assert saved['anna']['quota'] == {'available': False}
+    assert saved['ben']['quota'] == {'available': True}
+    assert AccountState(tmp_path.joinpath('missing.json')).all() == {}
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_probe_records_state(tmp_path, monkeypatch, anyio_backend):
+    key = Fernet.generate_key().decode()
+    monkeypatch.setenv('ENC_KEY', key)
+    TokenVault(key).put(tmp_path.joinpath('anna_Fake-token.json.enc'),
+                        {'fetched_at': int(time.time()), 'expires_in': 3600, 'type': 'Bearer',
+                         'token': 'access-anna', 'refresh_token': 'refresh-anna', 'implementation': 'swissid'})
+    state = AccountState(tmp_path.joinpath('state.json'))
+
+    with FakePostApi() as fake:
+        monkeypatch.setenv('POSTCARD_API_BASE', fake.url)
+        request_policy.set_request_policy(RequestPolicy(backoff_factor=0))
+        pool = AccountPool(tmp_path)
+        await probe_accounts(pool=pool, state=state)
+        await probe_accounts(pool=pool, state=state)
+        await pool.aclose()
+
+    record = AccountState(tmp_path.joinpath('state.json')).get('anna_Fake-token.json.enc')
+    assert record['quota']['available'] and record['next'] == record['quota']['next']
+    assert record['user_info']['firstName'] == 'anna'
+    assert record['error'] is None and record['refreshed_at'] and record['probed_at']
+    assert fake.requests['GET /secure/api/mobile/v1/user/current'] == 1
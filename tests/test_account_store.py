@@ -0,0 +1,129 @@
+import time
+
+import pytest
+from cryptography.fernet import Fernet, InvalidToken
+
+from postcard_creator.account_store import AccountStore, account_id_for
+from postcard_creator.enc_token_provider import EncTokenProvider
+from postcard_creator.postcard_creator import PostcardCreatorException
+from postcard_creator.testing.fake_post_api import FakePostApi
+from postcard_creator.token_vault import TokenVault
+
+TOKEN = {'fetched_at': 1000, 'expires_in': 3600, 'type': 'Bearer', 'token': 'access-anna',
+         'refresh_token': 'refresh-anna', 'implementation': 'swissid'}
+
+
+@pytest.fixture
+def key():
+    return Fernet.generate_key().decode()
+
+
+def test_put_and_load_all(tmp_path, key):
+    store = AccountStore(tmp_path.joinpath('accounts.db'), key)
+    store.put('anna', TOKEN, 'Anna Muster')
+    store.put('anna2', dict(TOKEN, token='access-anna2'), 'Anna Muster')
+    store.put('anna', dict(TOKEN, token='access-new'))
+
+    other = AccountStore(tmp_path.joinpath('accounts.db'), key)
+    accounts = other.load_all()
+    assert accounts['anna'] == {'name': 'Anna Muster', 'token': dict(TOKEN, token='access-new')}
+    assert other.get('anna2')['token'] == 'access-anna2'
+    assert other.account_ids() == ['anna', 'anna2']
+    assert other.loads == 1
+
+    store.delete('anna2')
+    assert other.account_ids() == ['anna']
+
+
+def test_key_rotation(tmp_path, key):
+    path = tmp_path.joinpath('accounts.db')
+    AccountStore(path, key).put('anna', TOKEN)
+
+    new_key = Fernet.generate_key().decode()
+    store = AccountStore(path, f'{new_key},{key}')
+    assert store.get('anna') == TOKEN
+    assert store.rotate() == 1
+
+    assert AccountStore(path, new_key).get('anna') == TOKEN
+    with pytest.raises(InvalidToken):
+        AccountStore(path, key).load_all()
+
+
+def test_import_files(tmp_path, key, monkeypatch):
+    accounts_dir = tmp_path.joinpath('accounts')
+    accounts_dir.mkdir()
+    now = int(time.time())
+    vault = TokenVault(key)
+    vault.put(accounts_dir.joinpath('Anna_Muster-token.json.enc'), dict(TOKEN, fetched_at=now))
+    vault.put(accounts_dir.joinpath('Anna_Old-token.json.enc'), dict(TOKEN, fetched_at=now - 60))
+    vault.put(accounts_dir.joinpath('Max_Muster-token.json.enc'),
+              dict(TOKEN, fetched_at=now - 7200, token='access-max', refresh_token='refresh-max'))
+    vault.put(accounts_dir.joinpath('Revoked-token.json.enc'), dict(TOKEN, fetched_at=now - 7200, refresh_token='x'))
+    TokenVault(Fernet.generate_key().decode()).put(accounts_dir.joinpath('Other_Key-token.json.enc'), TOKEN)
+
+    store = AccountStore(tmp_path.joinpath('accounts.db'), key)
+    with FakePostApi() as api:
+        monkeypatch.setenv('POSTCARD_API_BASE', api.url)
+        anna, max_ = store.account_id({'email': 'anna@example.com'}), store.account_id({'email': 'max@example.com'})
+        assert store.import_files(accounts_dir) == sorted([anna, max_])
+        assert store.import_files(accounts_dir) == []
+
+    assert store.get(anna)['fetched_at'] == now
+    # expired tokens are refreshed to identify them
+    assert store.get(max_)['fetched_at'] >= now
+    assert store.load_all()[max_]['name'] == 'max Fake'
+
+
+def test_account_without_email_is_refused():
+    with pytest.raises(PostcardCreatorException):
+        account_id_for({'firstName': 'Anna', 'name': 'Muster'}, b'salt')
+
+
+def test_provider_refreshes_into_store(tmp_path, key, monkeypatch):
+    monkeypatch.setenv('ENC_KEY', key)
+    store = AccountStore(tmp_path.joinpath('accounts.db'), key)
+    store.put('anna', dict(TOKEN, fetched_at=int(time.time()) - 3600))
+
+    with FakePostApi() as api:
+        monkeypatch.setenv('POSTCARD_API_BASE', api.url)
+        provider = EncTokenProvider(tmp_path, store=store)
+        for account in provider.list_tokens():
+            provider.decrypt_token(account)
+            provider.maybe_refresh_token()
+
+    assert provider.token.account_id == 'anna'
+    assert store.account_ids() == ['anna']
+    assert store.get('anna')['fetched_at'] > TOKEN['fetched_at']
+
+
+def test_account_ids_are_opaque(tmp_path, key):
+    path = tmp_path.joinpath('accounts.db')
+    store = AccountStore(path, key)
+    account_id = store.account_id({'email': 'Anna@Example.com'})
+    assert 'anna' not in account_id and account_id == store.account_id({'email': 'anna@example.com'})
+    # the salt is kept in the store
+    assert AccountStore(path, key).account_id({'email': 'anna@example.com'}) == account_id
+    assert AccountStore(tmp_path.joinpath('other.db'), key).account_id({'email': 'anna@example.com'}) != account_id
+
+    # stores keyed by e-mail address are migrated
+    store.put('ben@example.com', TOKEN)
+    assert AccountStore(path, key).account_ids() == [store.account_id({'email': 'ben@example.com'})]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_failed_pre_refresh_does_not_stop_the_others(tmp_path, key, monkeypatch, anyio_backend):
+    monkeypatch.setenv('ENC_KEY', key)
+    store = AccountStore(tmp_path.joinpath('accounts.db'), key)
+    expired = int(time.time()) - 3600
+    store.put('anna@example.com', dict(TOKEN, fetched_at=expired, refresh_token='revoked'))
+    store.put('ben@example.com', dict(TOKEN, fetched_at=expired, refresh_token='refresh-ben'))
+
+    with FakePostApi() as api:
+        monkeypatch.setenv('POSTCARD_API_BASE', api.url)
+        provider = EncTokenProvider(tmp_path, store=store)
+        assert await provider.refresh_expiring_async(window=900) == 1
+        await provider.async_postcard_creator.aclose()
+
+    assert store.get('anna@example.com')['fetched_at'] == expired
+    assert store.get('ben@example.com')['fetched_at'] > expired
@@ -0,0 +1,157 @@
+import asyncio
+import importlib
+import io
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from cryptography.fernet import Fernet
+from PIL import Image
+
+from postcard_creator import request_policy
+from postcard_creator.request_policy import RequestPolicy
+from postcard_creator.testing.fake_post_api import FakePostApi
+from postcard_creator.token_vault import TokenVault
+
+ACCOUNTS = ('anna', 'ben', 'carl', 'dora')
+
+
+def _jpeg(width, height):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), 'white').save(buffer, 'jpeg')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def flow(tmp_path, monkeypatch):
+    key = Fernet.generate_key().decode()
+    for name in ('data', 'postcards', 'accounts'):
+        tmp_path.joinpath(name).mkdir()
+    vault = TokenVault(key)
+    for name in ACCOUNTS:
+        vault.put(tmp_path.joinpath('accounts', f'{name}_Fake-token.json.enc'),
+                  {'fetched_at': int(time.time()), 'expires_in': 3600, 'type': 'Bearer', 'token': f'access-{name}',
+                   'refresh_token': f'refresh-{name}', 'implementation': 'swissid'})
+    # upload-ready sizes, forwarded without rendering
+    cover, text = _jpeg(1819, 1311), _jpeg(720, 744)
+    for i in range(6):
+        tmp_path.joinpath('postcards', f'card{i}_cover.jpeg').write_bytes(cover)
+        tmp_path.joinpath('postcards', f'card{i}_text.jpeg').write_bytes(text)
+
+    # send_postcard exports the images (image_export=True) to .postcard_creator_wrapper_sent in the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('ENC_KEY', key)
+    for name, value in (('DATA_DIR', 'data'), ('POSTCARD_DIR', 'postcards'), ('ACCOUNTS_DIR', 'accounts')):
+        monkeypatch.setenv(name, str(tmp_path.joinpath(value)))
+    for name, value in (('PRENAME', 'Erika'), ('LASTNAME', 'Muster'), ('STREET', 'Gasse 2'), ('PLACE', 'Bern'),
+                        ('ZIP_CODE', '3000')):
+        monkeypatch.setenv(f'RECIPIENT_{name}', value)
+
+    with FakePostApi(latency=0.02) as fake:
+        monkeypatch.setenv('POSTCARD_API_BASE', fake.url)
+        request_policy.set_request_policy(RequestPolicy(backoff_factor=0))
+        api = importlib.import_module('api')
+        yield api, fake, tmp_path
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_dispatch_sends_with_every_available_account(flow, anyio_backend):
+    api, fake, tmp_path = flow
+    fake.exhaust_quota('dora')
+
+    sent = await api.PostcardFlow().dispatch(concurrency=2)
+
+    assert sorted(account.name for account in sent) == [f'{name}_Fake-token.json.enc' for name in ACCOUNTS[:3]]
+    assert all('orderId' in status for status in sent.values())
+    done = json.loads(tmp_path.joinpath('data', 'done.json').read_text())
+    assert len(done) == len(set(done)) == 3
+    assert len(list(tmp_path.joinpath('postcards', 'archive').glob('*_cover.jpeg'))) == 3
+    assert len(api.claims) == 0
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_concurrent_flows_never_claim_an_item_twice(flow, anyio_backend):
+    api, fake, tmp_path = flow
+    fake.free_cards = None
+
+    flows = [api.PostcardFlow() for _ in range(3)]
+    results = await asyncio.gather(*[f.dispatch(concurrency=4) for f in flows], return_exceptions=True)
+
+    statuses = [status for sent in results for status in sent.values()]
+    assert not [status for status in statuses if isinstance(status, Exception)]
+    # the flows share the account pool, an account is used by one flow at a time
+    assert len(ACCOUNTS) <= len(statuses) <= 6
+
+    while await flows[0].dispatch():
+        pass
+    done = json.loads(tmp_path.joinpath('data', 'done.json').read_text())
+    assert len(done) == len(set(done)) == 6
+    assert sum(len(account.orders) for account in fake.accounts.values()) == 6
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_concurrent_run_flows_use_distinct_accounts(flow, anyio_backend):
+    api, fake, tmp_path = flow
+    fake.free_cards = None
+
+    flow = api.PostcardFlow()
+    in_use, overlaps = set(), []
+    try_lease, release = flow.pool._try_lease, flow.pool._release
+
+    def leased(ref):
+        lease = try_lease(ref)
+        if lease is not None:
+            overlaps.extend([ref] if ref in in_use else [])
+            in_use.add(ref)
+        return lease
+
+    def released(account):
+        in_use.discard(account.ref)
+        release(account)
+
+    flow.pool._try_lease, flow.pool._release = leased, released
+    sent = await asyncio.gather(*[flow.run_flow() for _ in range(3)])
+
+    assert [len(s) for s in sent] == [1, 1, 1]
+    assert not overlaps
+    assert sum(len(account.orders) for account in fake.accounts.values()) == 3
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_failed_reschedule_retries_later(flow, monkeypatch, anyio_backend):
+    api, fake, tmp_path = flow
+
+    async def make_cache(accounts=None, not_before=None):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(api, 'make_cache', make_cache)
+    before = datetime.now(timezone.utc)
+    await api.reschedule(['anna'])
+
+    assert api.scheduler.as_dict()['anna'] >= before + timedelta(seconds=api.RETRY_DELAY)
+    api.scheduler.remove('anna')
+
+
+def test_corrupt_snapshot_does_not_stop_startup(flow, monkeypatch):
+    api, fake, tmp_path = flow
+    monkeypatch.setattr(api, 'pc', api.PostcardFlow())
+    quota = {'available': False}
+    tmp_path.joinpath('data', 'account_state.json').write_text(json.dumps({
+        'anna_Fake-token.json.enc': {'quota': quota, 'next': 'tomorrow-ish', 'probed_at': 1},
+        'ben_Fake-token.json.enc': {'quota': quota, 'next': '99999-01-01T00:00:00', 'probed_at': 1},
+        'carl_Fake-token.json.enc': {'quota': quota, 'next': '2024-01-02T00:00:00+00:00', 'probed_at': 1},
+    }))
+
+    before = datetime.now(timezone.utc)
+    scheduled = {ref.name: when for ref, when in api.load_snapshot().items()}
+    for name in ('anna', 'ben', 'carl'):
+        api.scheduler.remove(tmp_path.joinpath('accounts', f'{name}_Fake-token.json.enc'))
+
+    assert scheduled['anna_Fake-token.json.enc'] >= before
+    assert scheduled['ben_Fake-token.json.enc'] >= before
+    assert scheduled['carl_Fake-token.json.enc'] == datetime(2024, 1, 2, tzinfo=timezone.utc)
@@ -0,0 +1,70 @@
+import io
+
+import pytest
+from PIL import Image
+
+from postcard_creator import request_policy
+from postcard_creator.postcard_creator import Postcard, PostcardCreatorException, Recipient, Sender
+from postcard_creator.postcard_creator_swissid import PostcardCreatorSwissId
+from postcard_creator.postcard_creator_swissid_async import AsyncPostcardCreatorSwissId
+from postcard_creator.request_policy import RequestPolicy
+from postcard_creator.testing.fake_post_api import FakePostApi
+from postcard_creator.token import NoopToken, Token
+
+
+@pytest.fixture
+def api(monkeypatch):
+    with FakePostApi() as api:
+        monkeypatch.setenv('POSTCARD_API_BASE', api.url)
+        request_policy.set_request_policy(RequestPolicy(backoff_factor=0))
+        yield api
+
+
+def _jpeg(width, height):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), 'white').save(buffer, 'jpeg')
+    return buffer.getvalue()
+
+
+def _postcard():
+    person = dict(prename='Erika', lastname='Muster', street='Gasse 2', zip_code=3000, place='Bern')
+    # upload-ready sizes, forwarded without rendering
+    return Postcard(sender=Sender(**person), recipient=Recipient(**person),
+                    picture_stream=io.BytesIO(_jpeg(1819, 1311)), message_image_stream=io.BytesIO(_jpeg(720, 744)))
+
+
+def test_free_card_exhausts_quota(api):
+    client = PostcardCreatorSwissId(NoopToken('access-max'))
+    assert client.has_free_postcard()
+
+    assert client.send_free_card(_postcard())['orderId'] == 1000
+    assert not client.has_free_postcard()
+    with pytest.raises(PostcardCreatorException, match='Limit of free postcards'):
+        client.send_free_card(_postcard())
+    assert api.requests['POST /secure/api/mobile/v1/card/upload'] == 1
+
+
+def test_injected_errors_and_refresh(api):
+    api.fail_next(2, status=503, path='/secure/api/mobile/v1/user/current')
+    token = Token()
+    token.fetch_token_by_refresh_token('refresh-anna', lambda access_token, t: None)
+
+    client = PostcardCreatorSwissId(token)
+    assert client.get_user_info()['firstName'] == 'anna'
+    assert api.requests['GET /secure/api/mobile/v1/user/current'] == 3
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_async_client(api, monkeypatch, anyio_backend):
+    monkeypatch.setenv('POSTCARD_PRICE', '2.5')
+    api.exhaust_quota('max')
+    async with AsyncPostcardCreatorSwissId(NoopToken('access-max')) as client:
+        assert not await client.has_free_postcard()
+        with pytest.raises(PostcardCreatorException, match='Limit of free postcards'):
+            await client.send_card(_postcard())
+        api.account('max').saldo = 10.0
+        results = await client.send_card(_postcard(), paid=True)
+
+    assert results[0]['order'] == {'orderId': 1000}
+    assert api.requests['GET /secure/api/mobile/v1/billingOnline/accountSaldo'] == 1
@@ -0,0 +1,61 @@
+import io
+
+from PIL import Image, ImageFilter
+
+from postcard_creator.jpeg_encoder import encode_jpeg, read_encoder_settings, _psnr
+
+
+def _photo():
+    noise = Image.effect_noise((455, 328), 64).filter(ImageFilter.GaussianBlur(1))
+    image = Image.merge('RGB', [noise, noise.rotate(180), noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)])
+    return image.resize((1819, 1311), Image.Resampling.BICUBIC)
+
+
+def test_encode_without_constraints_uses_given_quality():
+    data, settings = encode_jpeg(_photo(), quality=80)
+    assert settings == {'quality': 80, 'subsampling': '4:2:0', 'optimize': 1, 'bytes': len(data)}
+    assert Image.open(io.BytesIO(data)).format == 'JPEG'
+
+
+def test_encode_within_byte_budget():
+    image = _photo()
+    data, settings = encode_jpeg(image, max_bytes=250_000)
+    assert len(data) <= 250_000
+
+    # next quality step would exceed the budget
+    bigger, _ = encode_jpeg(image, quality=settings['quality'] + 1)
+    assert len(bigger) > 250_000
+
+
+def test_encode_reaches_psnr_floor():
+    image = _photo()
+    data, settings = encode_jpeg(image, min_psnr=38)
+    assert _psnr(image, data) >= 38
+    assert settings['psnr'] >= 38
+
+
+def test_byte_budget_wins_over_psnr_floor():
+    data, settings = encode_jpeg(_photo(), min_psnr=60, max_bytes=200_000)
+    assert len(data) <= 200_000
+
+
+def test_settings_are_stored_in_jpeg():
+    data, settings = encode_jpeg(_photo(), max_bytes=300_000)
+    assert read_encoder_settings(data) == {k: settings[k] for k in ('quality', 'subsampling', 'optimize')}
+
+    with io.BytesIO() as f:
+        _photo().save(f, 'jpeg')
+        assert read_encoder_settings(f.getvalue()) is None
+
+
+def test_noisy_photo_is_not_bigger_than_baseline():
+    # film grain like noise, no quality reaches the floor
+    noise = Image.effect_noise((1819, 1311), 40)
+    image = Image.merge('RGB', [noise, noise.rotate(180), noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)])
+    with io.BytesIO() as f:
+        image.save(f, 'jpeg', quality=75)
+        baseline = f.getvalue()
+
+    data, settings = encode_jpeg(image, max_bytes=1024 * 1024, min_psnr=34)
+    assert settings['quality'] <= 75
+    assert len(data) <= len(baseline)
@@ -0,0 +1,120 @@
+import json
+import threading
+
+import httpx
+import pytest
+
+from postcard_creator import postcard_creator_swissid_async, transport
+from postcard_creator.postcard_creator import Postcard, Recipient, Sender
+from postcard_creator.postcard_creator_swissid_async import AsyncPostcardCreatorSwissId
+from postcard_creator.token import NoopToken, Token
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+def _client(handler):
+    client = AsyncPostcardCreatorSwissId(NoopToken('secret'))
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+
+def _postcard():
+    sender = Sender('Max', 'Muster', 'Strasse 1', 8000, 'Zürich')
+    recipient = Recipient('Erika', 'Muster', 'Gasse 2', 3000, 'Bern')
+    return Postcard(sender, recipient, picture_stream=None, message_image_stream=None, message='hi')
+
+
+async def test_get_quota():
+    def handler(request):
+        assert request.url.path.endswith('/user/quota')
+        assert request.headers['Authorization'] == 'Bearer secret'
+        return httpx.Response(200, json={'model': {'available': True, 'next': None}})
+
+    async with _client(handler) as client:
+        assert await client.has_free_postcard()
+
+
+async def test_send_free_card_streams_body_and_renders_off_loop(monkeypatch):
+    loop_thread = threading.get_ident()
+    render_threads = []
+    uploads = []
+
+    def render(postcard, image_export=False, **kwargs):
+        render_threads.append(threading.get_ident())
+        return b'cover', b'text', None
+
+    monkeypatch.setattr(postcard_creator_swissid_async, '_render_card_images', render)
+
+    async def handler(request):
+        if request.url.path.endswith('/user/quota'):
+            return httpx.Response(200, json={'model': {'available': True}})
+        uploads.append((request.headers, await request.aread()))
+        return httpx.Response(200, json={'model': {'orderId': 42}})
+
+    async with _client(handler) as client:
+        result = await client.send_free_card(_postcard())
+
+    assert result == {'orderId': 42}
+    assert render_threads and render_threads[0] != loop_thread
+    headers, body = uploads[0]
+    assert int(headers['Content-Length']) == len(body)
+    payload = json.loads(body)
+    assert payload['image'] == 'Y292ZXI=' and payload['textImage'] == 'dGV4dA=='
+    assert payload['recipient']['city'] == 'Bern'
+
+
+async def test_send_free_card_without_quota(monkeypatch):
+    monkeypatch.setattr(postcard_creator_swissid_async, '_render_card_images', lambda *a, **kw: (b'', b'', None))
+
+    def handler(request):
+        assert request.method == 'GET'
+        return httpx.Response(200, json={'model': {'available': False, 'next': 'tomorrow'}})
+
+    async with _client(handler) as client:
+        with pytest.raises(Exception, match='tomorrow'):
+            await client.send_free_card(_postcard())
+
+
+async def test_refresh_token_async(monkeypatch):
+    def handler(request):
+        assert b'grant_type=refresh_token' in request.content
+        return httpx.Response(200, json={'access_token': 'new', 'token_type': 'Bearer',
+                                         'expires_in': 3600, 'refresh_token': 'next'})
+
+    monkeypatch.setattr(transport, 'new_async_client',
+                        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    received = []
+
+    async def on_token(access_token, token):
+        received.append(token.token)
+
+    token = Token()
+    await token.fetch_token_by_refresh_token_async('old', on_token)
+    assert received == ['new']
+    assert token.refresh_token == 'next'
+
+
+async def test_async_clients_share_pool_per_loop():
+    t = transport.Transport()
+    a, b = t.new_async_client(), t.new_async_client()
+    try:
+        assert a._transport is b._transport
+        closed = []
+
+        async def close_pool():
+            closed.append(True)
+
+        b._transport._pool.aclose = close_pool
+        await a.aclose()
+        async with t.new_async_client():
+            pass
+        assert closed == []
+        assert b._transport is t.new_async_client()._transport
+    finally:
+        await b.aclose()
+        await t.aclose()
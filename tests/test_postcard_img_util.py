@@ -0,0 +1,99 @@
+import io
+import os
+
+import pytest
+from PIL import Image, ImageChops, ImageFilter, ImageStat
+
+from postcard_creator import helper, postcard_img_util
+
+
+def _jpeg(width, height, color=(200, 30, 30)):
+    with io.BytesIO() as f:
+        Image.new('RGB', (width, height), color).save(f, 'jpeg')
+        return f.getvalue()
+
+
+def test_decode_reduced_covers_target():
+    with Image.open(io.BytesIO(_jpeg(8000, 6000))) as image:
+        reduced = postcard_img_util._decode_reduced(image, 1819, 1311, image_rotate=True)
+        assert reduced.size == (2000, 1500)
+
+
+def test_decode_reduced_respects_rotation():
+    with Image.open(io.BytesIO(_jpeg(3000, 8000))) as image:
+        reduced = postcard_img_util._decode_reduced(image, 1819, 1311, image_rotate=True)
+        assert reduced.width >= 1311 and reduced.height >= 1819
+        assert reduced.size == (1500, 4000)
+
+
+def test_decode_reduced_non_jpeg():
+    image = Image.new('RGB', (4000, 3000))
+    assert postcard_img_util._decode_reduced(image, 1819, 1311, image_rotate=True).size == (2000, 1500)
+
+
+def test_draft_decode_keeps_target_geometry():
+    cover = postcard_img_util._rotate_and_scale(_jpeg(8000, 6000), 1819, 1311, 1, True, True, False, 'jpeg',
+                                                draft_decode=True)
+    with Image.open(io.BytesIO(cover)) as image:
+        assert image.size == (1819, 1311)
+
+
+def test_fast_background_matches_exact():
+    noise = Image.effect_noise((250, 500), 64).filter(ImageFilter.GaussianBlur(2))
+    portrait = Image.merge('RGB', [noise, noise.rotate(180), noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)])
+    portrait = portrait.resize((1000, 2000))
+
+    exact = postcard_img_util.process_image(portrait, 1819, 1311, background_mode=postcard_img_util.BACKGROUND_EXACT)
+    fast = postcard_img_util.process_image(portrait, 1819, 1311, background_mode=postcard_img_util.BACKGROUND_FAST)
+
+    assert fast.size == exact.size == (1819, 1311)
+    diff = ImageStat.Stat(ImageChops.difference(exact, fast))
+    assert max(diff.mean) < 1
+    assert max(hi for _, hi in diff.extrema) < 16
+
+
+def test_unknown_background_mode():
+    with pytest.raises(ValueError):
+        postcard_img_util.process_image(Image.new('RGB', (100, 300)), 1819, 1311, background_mode='blurry')
+
+
+def test_prerender_covers_renders_missing_covers(tmp_path):
+    tmp_path.joinpath('a.jpg').write_bytes(_jpeg(400, 300))
+    tmp_path.joinpath('b.jpg').write_bytes(_jpeg(300, 400))
+    tmp_path.joinpath('b_cover.jpeg').write_bytes(_jpeg(1819, 1311))
+    os.utime(tmp_path.joinpath('b.jpg'), (1, 1))
+
+    results = postcard_img_util.prerender_covers(tmp_path, workers=1)
+
+    assert [r['file'].name for r in results] == ['a.jpg']
+    assert results[0]['error'] is None
+    assert helper.has_fresh_cover(tmp_path.joinpath('a.jpg'))
+    assert postcard_img_util.prerender_covers(tmp_path, workers=1) == []
+
+
+def test_upload_ready_image_is_forwarded_unchanged(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('image was decoded')
+
+    monkeypatch.setattr(postcard_img_util, '_rotate_and_scale', fail)
+    cover = _jpeg(1819, 1311)
+    assert postcard_img_util.make_cover_image(cover) is cover
+
+    text = _jpeg(720, 744)
+    assert postcard_img_util.rotate_and_scale_image(text, **postcard_img_util.TEXT_IMAGE_RENDER_ARGS) is text
+
+
+def test_upload_ready_requires_matching_header():
+    args = postcard_img_util.COVER_RENDER_ARGS
+    assert postcard_img_util._is_upload_ready(_jpeg(1819, 1311), image_rotate=True, **args)
+    assert not postcard_img_util._is_upload_ready(_jpeg(1820, 1311), image_rotate=True, **args)
+
+    with io.BytesIO() as f:
+        Image.new('RGB', (1819, 1311)).save(f, 'png')
+        assert not postcard_img_util._is_upload_ready(f.getvalue(), image_rotate=True, **args)
+    with io.BytesIO() as f:
+        Image.new('L', (1819, 1311)).save(f, 'jpeg')
+        assert not postcard_img_util._is_upload_ready(f.getvalue(), image_rotate=True, **args)
+
+    portrait = dict(args, image_target_width=1311, image_target_height=1819)
+    assert not postcard_img_util._is_upload_ready(_jpeg(1311, 1819), image_rotate=True, **portrait)
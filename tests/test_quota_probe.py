@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+import pytest
+from cryptography.fernet import Fernet
+
+from postcard_creator import request_policy
+from postcard_creator.account_pool import AccountPool
+from postcard_creator.quota_probe import probe_accounts
+from postcard_creator.request_policy import RequestPolicy
+from postcard_creator.testing.fake_post_api import FakePostApi
+from postcard_creator.token_vault import TokenVault
+
+
+@pytest.fixture
+def accounts(tmp_path, monkeypatch):
+    key = Fernet.generate_key().decode()
+    monkeypatch.setenv('ENC_KEY', key)
+    vault = TokenVault(key)
+    for name in ('anna', 'ben', 'carl', 'dora'):
+        # expired, every probe refreshes: token, user info and quota
+        vault.put(tmp_path.joinpath(f'{name}_Fake-token.json.enc'),
+                  {'fetched_at': 1000, 'expires_in': 3600, 'type': 'Bearer', 'token': None,
+                   'refresh_token': f'refresh-{name}', 'implementation': 'swissid'})
+    tmp_path.joinpath('broken_Fake-token.json.enc').write_bytes(b'not encrypted')
+    return tmp_path
+
+
+@pytest.fixture
+def api(monkeypatch):
+    with FakePostApi(latency=0.1) as api:
+        monkeypatch.setenv('POSTCARD_API_BASE', api.url)
+        request_policy.set_request_policy(RequestPolicy(backoff_factor=0))
+        yield api
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_accounts_are_probed_concurrently(api, accounts, anyio_backend):
+    api.exhaust_quota('ben')
+    start = time.perf_counter()
+    pool = AccountPool(accounts)
+    results = await probe_accounts(sorted(accounts.iterdir()), concurrency=8, timeout=5, pool=pool)
+    elapsed = time.perf_counter() - start
+    await pool.aclose()
+
+    assert [r.account.name for r in results] == sorted(p.name for p in accounts.iterdir())
+    assert [r.available for r in results] == [True, False, False, True, True]
+    assert [r.ok for r in results] == [True, True, False, True, True]
+    # 3 round trips of 100ms per account, 4 accounts in sequence would take 1.2s
+    assert elapsed < 0.8
+    assert all(r.latency >= 0.3 for r in results if r.ok)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_probe_timeout(api, accounts, anyio_backend):
+    pool = AccountPool(accounts)
+    results = await probe_accounts(timeout=0.15, pool=pool)
+    await pool.aclose()
+    assert not any(r.ok for r in results)
+    assert all(r.latency < 0.5 for r in results)
+    assert sum(isinstance(r.error, TimeoutError) for r in results) == 4
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_probe_waits_for_leased_account_outside_the_timeout(api, accounts, anyio_backend):
+    pool = AccountPool(accounts)
+    ref = accounts.joinpath('anna_Fake-token.json.enc')
+    lease = pool.try_lease(ref)
+    asyncio.get_running_loop().call_later(0.4, lease.release)
+
+    results = await probe_accounts([ref], timeout=0.5, pool=pool)
+    await pool.aclose()
+    assert results[0].ok and results[0].latency < 0.5
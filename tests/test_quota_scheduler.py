@@ -0,0 +1,46 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from postcard_creator.quota_scheduler import QuotaScheduler
+
+NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def test_earliest_account_first():
+    scheduler = QuotaScheduler(clock=lambda: NOW)
+    scheduler.update('anna', NOW + timedelta(hours=2))
+    scheduler.update('ben', NOW + timedelta(hours=1))
+    scheduler.update('carl', NOW - timedelta(minutes=1))
+    assert scheduler.peek() == (NOW - timedelta(minutes=1), 'carl')
+    assert scheduler.due() == ['carl']
+
+    # only the used account is rescheduled, outdated heap entries are skipped
+    scheduler.update('carl', NOW + timedelta(days=1))
+    assert scheduler.peek() == (NOW + timedelta(hours=1), 'ben')
+    scheduler.remove('ben')
+    assert scheduler.peek() == (NOW + timedelta(hours=2), 'anna')
+    assert scheduler.as_dict() == {'anna': NOW + timedelta(hours=2), 'carl': NOW + timedelta(days=1)}
+    assert len(scheduler) == 2
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_wait_sleeps_until_due_or_update(anyio_backend):
+    scheduler = QuotaScheduler()
+    now = scheduler.clock()
+    scheduler.update('anna', now + timedelta(seconds=0.2))
+    scheduler.update('ben', now + timedelta(hours=1))
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    assert await scheduler.wait() == 'anna'
+    assert 0.15 < loop.time() - start < 1
+
+    scheduler.update('anna', now + timedelta(hours=2))
+    waiter = asyncio.ensure_future(scheduler.wait())
+    await asyncio.sleep(0.05)
+    assert not waiter.done()
+    scheduler.update('ben', scheduler.clock())
+    assert await asyncio.wait_for(waiter, 1) == 'ben'
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from postcard_creator import postcard_img_util
+from postcard_creator.render_cache import RenderCache, make_key, set_render_cache
+
+ASSET = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'asset.jpg')
+
+
+@pytest.fixture
+def render_cache(tmp_path):
+    cache = RenderCache(directory=tmp_path.joinpath('render_cache'))
+    set_render_cache(cache)
+    yield cache
+    set_render_cache(None)
+
+
+def test_make_key_depends_on_params():
+    assert make_key(b'abc', w=1) == make_key(b'abc', w=1)
+    assert make_key(b'abc', w=1) != make_key(b'abc', w=2)
+    assert make_key(b'abc', w=1) != make_key(b'abd', w=1)
+
+
+def test_disk_tier_survives_new_instance(tmp_path):
+    RenderCache(directory=tmp_path).put('k', b'data')
+    assert RenderCache(directory=tmp_path).get('k') == b'data'
+
+
+def test_memory_tier_is_size_bounded():
+    cache = RenderCache(max_memory_bytes=10)
+    cache.put('a', b'12345')
+    cache.put('b', b'12345')
+    cache.get('a')
+    cache.put('c', b'12345')
+
+    assert cache.get('a') == b'12345'
+    assert cache.get('b') is None
+    assert cache.get('c') == b'12345'
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path):
+    cache = RenderCache(directory=tmp_path, max_memory_bytes=0, max_disk_bytes=10)
+    cache.put('a', b'12345')
+    os.utime(tmp_path.joinpath('a.bin'), (1, 1))
+    cache.put('b', b'12345')
+    cache.put('c', b'12345')
+
+    assert cache.get('a') is None
+    assert cache.get('b') == b'12345'
+    assert cache.get('c') == b'12345'
+
+
+def test_cover_render_is_cached(render_cache, monkeypatch):
+    cover = postcard_img_util.make_cover_image(ASSET)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('render cache miss')
+
+    monkeypatch.setattr(postcard_img_util, '_rotate_and_scale', fail)
+    assert postcard_img_util.make_cover_image(ASSET) == cover
+    # rendering our own output again, as send_free_card does with _cover.jpeg, costs nothing either
+    assert postcard_img_util.make_cover_image(cover) == cover
+
+
+def test_text_render_is_cached(render_cache, monkeypatch):
+    image = postcard_img_util.create_text_image('Coding rocks!')
+
+    def fail(*args, **kwargs):
+        raise AssertionError('render cache miss')
+
+    monkeypatch.setattr(postcard_img_util, '_render_text_image', fail)
+    assert postcard_img_util.create_text_image('Coding rocks!') == image
@@ -0,0 +1,202 @@
+import asyncio
+
+import httpx
+import pytest
+import requests
+import requests_mock
+
+from postcard_creator import request_policy
+from postcard_creator.postcard_creator import PostcardCreatorCircuitOpenException, PostcardCreatorException
+from postcard_creator.postcard_creator_swissid import PostcardCreatorSwissId
+from postcard_creator.postcard_creator_swissid_async import AsyncPostcardCreatorSwissId
+from postcard_creator.request_policy import CircuitBreaker, RequestPolicy
+from postcard_creator.token import NoopToken
+from postcard_creator.upload_body import Base64Field, JsonStreamBody
+
+URL_API = 'https://pccweb.api.post.ch/secure/api/mobile/v1'
+
+
+class Clock(object):
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Response(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def _policy(**kwargs):
+    sleeps = []
+    policy = RequestPolicy(sleep=sleeps.append, rand=lambda: 1.0, **kwargs)
+    return policy, sleeps
+
+
+def _send(*results):
+    results = list(results)
+    calls = []
+
+    def send():
+        calls.append(1)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return send, calls
+
+
+def test_breaker_opens_and_recovers():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=2, reset_timeout=10, clock=clock)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+    clock.now = 10
+    assert breaker.allow()  # single trial
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    clock.now = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.failures == 0
+
+
+def test_stuck_trial_is_given_up():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=1, reset_timeout=10, clock=clock, trial_timeout=5)
+    breaker.record_failure()
+    clock.now = 10
+    assert breaker.allow()
+    clock.now = 14
+    assert not breaker.allow()
+    clock.now = 15
+    assert breaker.allow()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_cancelled_trial_ends_the_trial(anyio_backend):
+    clock = Clock()
+    policy = RequestPolicy(max_retries=0, breaker_threshold=1, breaker_reset_timeout=10, clock=clock)
+
+    async def fail():
+        return Response(500)
+
+    async def hang():
+        await asyncio.sleep(60)
+
+    async def ok():
+        return Response(200)
+
+    await policy.execute_async('GET', URL_API + '/user/quota', fail)
+    clock.now = 10
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(policy.execute_async('GET', URL_API + '/user/quota', hang), 0.01)
+    assert policy.breaker(URL_API).state == 'half_open'
+
+    assert (await policy.execute_async('GET', URL_API + '/user/quota', ok)).status_code == 200
+    assert policy.breaker(URL_API).state == 'closed'
+
+
+def test_get_is_retried_with_retry_after():
+    policy, sleeps = _policy()
+    send, calls = _send(Response(503, {'Retry-After': '2'}), requests.exceptions.ReadTimeout(), Response(200))
+
+    assert policy.execute('GET', URL_API + '/user/quota', send).status_code == 200
+    assert len(calls) == 3
+    assert sleeps == [2.0, 1.0]
+    assert policy.state()['retries'] == 2
+
+
+def test_long_retry_after_is_not_waited_for():
+    policy, sleeps = _policy(max_backoff=30)
+    send, calls = _send(Response(503, {'Retry-After': '600'}))
+    assert policy.execute('GET', URL_API + '/user/quota', send).status_code == 503
+    assert sleeps == []
+
+
+@pytest.mark.parametrize('result', [requests.exceptions.ReadTimeout(), requests.exceptions.ConnectionError(),
+                                    Response(503), Response(502)])
+def test_upload_is_not_retried_if_it_may_have_been_processed(result):
+    policy, sleeps = _policy()
+    send, calls = _send(result, Response(200))
+    try:
+        policy.execute('POST', URL_API + '/card/upload', send)
+    except requests.RequestException:
+        pass
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('result', [requests.exceptions.ConnectTimeout(), Response(429)])
+def test_upload_is_retried_if_not_processed(result):
+    policy, sleeps = _policy()
+    send, calls = _send(result, Response(200))
+    assert policy.execute('POST', URL_API + '/card/upload', send).status_code == 200
+    assert len(calls) == 2
+
+
+def test_open_circuit_fails_fast():
+    policy, sleeps = _policy(max_retries=0, breaker_threshold=2)
+    send, calls = _send(Response(500), Response(500), Response(200))
+    for i in range(2):
+        policy.execute('GET', URL_API + '/user/quota', send)
+
+    with pytest.raises(PostcardCreatorCircuitOpenException):
+        policy.execute('GET', URL_API + '/user/current', send)
+    assert len(calls) == 2
+    assert policy.state()['hosts']['pccweb.api.post.ch'] == {'state': 'open', 'failures': 2}
+
+
+def test_rate_limit_does_not_open_circuit():
+    policy, sleeps = _policy(max_retries=0, breaker_threshold=2)
+    send, calls = _send(Response(500), Response(429), Response(429), Response(429), Response(200))
+    for i in range(5):
+        policy.execute('GET', URL_API + '/user/quota', send)
+
+    assert len(calls) == 5
+    assert policy.state()['hosts']['pccweb.api.post.ch'] == {'state': 'closed', 'failures': 0}
+
+
+def test_client_applies_timeouts_and_retries():
+    policy, sleeps = _policy()
+    request_policy.set_request_policy(policy)
+
+    with requests_mock.Mocker() as m:
+        m.get(URL_API + '/user/quota', [{'status_code': 503}, {'json': {'model': {'available': True}}}])
+        upload = m.post(URL_API + '/card/upload', status_code=503)
+
+        client = PostcardCreatorSwissId(NoopToken('token'))
+        assert client.get_quota() == {'available': True}
+        assert m.request_history[0].timeout == (10.0, 30.0)
+
+        with pytest.raises(PostcardCreatorException):
+            client._do_op('post', '/card/upload', data=JsonStreamBody({'image': Base64Field(b'1')}))
+        assert upload.call_count == 1
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_async_upload_retry_sends_complete_body(anyio_backend):
+    request_policy.set_request_policy(RequestPolicy(rand=lambda: 0.0))
+    bodies = []
+
+    async def handler(request):
+        bodies.append(await request.aread())
+        if len(bodies) == 1:
+            raise httpx.ConnectError('refused')
+        return httpx.Response(200, json={'model': {}})
+
+    client = AsyncPostcardCreatorSwissId(NoopToken('token'))
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    async with client:
+        await client._do_op('post', '/card/upload', content=JsonStreamBody({'image': Base64Field(b'123')}))
+
+    assert bodies == [b'{"image": "MTIz"}'] * 2
@@ -0,0 +1,118 @@
+import json
+
+import pytest
+import requests_mock
+
+from postcard_creator import postcard_creator_swissid
+from postcard_creator.postcard_creator import Postcard, PostcardCreatorException, Recipient, Sender
+from postcard_creator.postcard_creator_swissid import PostcardCreatorSwissId
+from postcard_creator.token import NoopToken
+
+URL_API = 'https://pccweb.api.post.ch/secure/api/mobile/v1'
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    calls = []
+
+    def render(postcard, image_export=False, **kwargs):
+        calls.append(postcard)
+        return b'cover', b'text', None
+
+    monkeypatch.setattr(postcard_creator_swissid, '_render_card_images', render)
+    return calls
+
+
+def _person(name):
+    return dict(prename=name, lastname='Muster', street='Gasse 1', zip_code=3000, place='Bern')
+
+
+def _postcard(*names):
+    recipients = [Recipient(**_person(name)) for name in names]
+    return Postcard(sender=Sender(**_person('Max')), recipient=recipients[0], recipients=recipients[1:],
+                    picture_stream=None, message_image_stream=None)
+
+
+def test_several_recipients_are_paid_with_one_upload(renders, monkeypatch):
+    monkeypatch.setenv('POSTCARD_PRICE', '2.5')
+    postcard = _postcard('Anna', 'Berta', 'Carla')
+
+    with requests_mock.Mocker() as m:
+        m.get(URL_API + '/user/quota', json={'model': {'available': True}})
+        saldo = m.get(URL_API + '/billingOnline/accountSaldo', json={'model': {'saldo': 10}})
+        upload = m.post(URL_API + '/card/upload', json={'model': {'orderId': 42}})
+
+        results = PostcardCreatorSwissId(NoopToken('token')).send_card(postcard, paid=True)
+        sent = json.loads(b''.join(upload.last_request.body))
+
+    assert len(renders) == 1 and upload.call_count == 1 and saldo.call_count == 1
+    assert sent['paid'] is True and 'recipient' not in sent
+    assert [r['firstname'] for r in sent['recipients']] == ['Anna', 'Berta', 'Carla']
+    assert [r['recipient'].prename for r in results] == ['Anna', 'Berta', 'Carla']
+    assert all(r['order'] == {'orderId': 42} for r in results)
+
+
+def test_per_recipient_orders_are_matched():
+    postcard = _postcard('Anna', 'Berta')
+    results = postcard_creator_swissid._order_results(postcard, [{'orderId': 1}, {'orderId': 2}])
+    assert [(r['recipient'].prename, r['order']['orderId']) for r in results] == [('Anna', 1), ('Berta', 2)]
+
+
+def test_single_recipient_uses_free_card(renders):
+    with requests_mock.Mocker() as m:
+        m.get(URL_API + '/user/quota', json={'model': {'available': True}})
+        upload = m.post(URL_API + '/card/upload', json={'model': {'orderId': 1}})
+
+        results = PostcardCreatorSwissId(NoopToken('token')).send_card(_postcard('Anna'))
+        sent = json.loads(b''.join(upload.last_request.body))
+
+    assert sent['paid'] is False and sent['recipient']['firstname'] == 'Anna'
+    assert results[0]['order'] == {'orderId': 1}
+
+
+def test_free_card_without_quota_is_not_paid(renders):
+    with requests_mock.Mocker() as m:
+        m.get(URL_API + '/user/quota', json={'model': {'available': False, 'next': 'tomorrow'}})
+        saldo = m.get(URL_API + '/billingOnline/accountSaldo', json={'model': {'saldo': 10}})
+        upload = m.post(URL_API + '/card/upload', json={'model': {}})
+
+        with pytest.raises(PostcardCreatorException, match='Limit of free postcards exceeded'):
+            PostcardCreatorSwissId(NoopToken('token')).send_card(_postcard('Anna'))
+
+    assert saldo.call_count == 0 and upload.call_count == 0
+
+
+def test_paid_card_needs_saldo_for_all_recipients(renders, monkeypatch):
+    monkeypatch.setenv('POSTCARD_PRICE', '2.5')
+    with requests_mock.Mocker() as m:
+        m.get(URL_API + '/user/quota', json={'model': {'available': False, 'next': 'tomorrow'}})
+        m.get(URL_API + '/billingOnline/accountSaldo', json={'model': {'saldo': 5}})
+        upload = m.post(URL_API + '/card/upload', json={'model': {}})
+
+        client = PostcardCreatorSwissId(NoopToken('token'))
+        with pytest.raises(PostcardCreatorException, match='does not cover 3 postcards'):
+            client.send_card(_postcard('Anna', 'Berta', 'Carla'), paid=True)
+        assert upload.call_count == 0
+
+        client.send_card(_postcard('Anna', 'Berta'), paid=True)
+        assert upload.call_count == 1
+
+
+def test_paid_card_needs_a_price(renders, monkeypatch):
+    monkeypatch.delenv('POSTCARD_PRICE', raising=False)
+    with requests_mock.Mocker() as m:
+        m.get(URL_API + '/user/quota', json={'model': {'available': True}})
+        saldo = m.get(URL_API + '/billingOnline/accountSaldo', json={'model': {'saldo': 100}})
+        upload = m.post(URL_API + '/card/upload', json={'model': {}})
+
+        with pytest.raises(PostcardCreatorException, match='POSTCARD_PRICE'):
+            PostcardCreatorSwissId(NoopToken('token')).send_card(_postcard('Anna', 'Berta'), paid=True)
+
+    assert saldo.call_count == 0 and upload.call_count == 0
+
+
+def test_free_card_has_a_single_recipient(renders):
+    with requests_mock.Mocker() as m:
+        m.get(URL_API + '/user/quota', json={'model': {'available': True}})
+        with pytest.raises(PostcardCreatorException, match='single recipient'):
+            PostcardCreatorSwissId(NoopToken('token')).send_card(_postcard('Anna', 'Berta'), paid=False)
@@ -0,0 +1,62 @@
+from postcard_creator import text_layout
+from postcard_creator.text_layout import layout_text, wrap_text
+
+FONT = 'open_sans_emoji.ttf'
+
+
+def test_wrap_text_by_measured_width():
+    metrics = text_layout._font_metrics(FONT, 40)
+    max_width = metrics.width('Coding rocks') + 1
+
+    lines = wrap_text('Coding rocks and emoji 😘 too', metrics, max_width)
+
+    assert [line for line, _ in lines] == ['Coding rocks', 'and emoji 😘', 'too']
+    assert all(width <= max_width for _, width in lines)
+    assert lines[0][1] == metrics.font.getlength('Coding rocks')
+
+
+def test_wrap_text_keeps_paragraphs_and_breaks_long_words():
+    metrics = text_layout._font_metrics(FONT, 40)
+    lines = wrap_text('a\n\n' + 'x' * 100, metrics, 200)
+
+    assert lines[0][0] == 'a'
+    assert lines[1][0] == ''
+    assert ''.join(line for line, _ in lines[2:]) == 'x' * 100
+    assert all(width <= 200 for _, width in lines)
+
+
+def test_layout_text_finds_largest_fitting_size():
+    layout = layout_text('Liebe Grüsse aus den Bergen! 🏔️ ' * 10, FONT, 720, 744)
+    assert layout.height <= 744 - 2 * 50
+    assert all(width <= 720 - 2 * 70 for _, width in layout.lines)
+
+    bigger = layout_text('Liebe Grüsse aus den Bergen! 🏔️ ' * 10, FONT, 720, 744, min_size=layout.size + 1)
+    assert bigger.height > 744 - 2 * 50 or any(width > 720 - 2 * 70 for _, width in bigger.lines)
+
+
+def test_layout_text_reads_font_once(monkeypatch):
+    text_layout._font_bytes.cache_clear()
+    text_layout.load_font.cache_clear()
+    text_layout._font_metrics.cache_clear()
+    reads = []
+    resource_string = text_layout.pkg_resources.resource_string
+
+    def counting_resource_string(*args):
+        reads.append(args)
+        return resource_string(*args)
+
+    monkeypatch.setattr(text_layout.pkg_resources, 'resource_string', counting_resource_string)
+    layout_text('Coding rocks!', FONT, 720, 744)
+
+    assert len(reads) == 1
+    assert text_layout.load_font(FONT, 40) is text_layout.load_font(FONT, 40)
+
+
+def test_width_memo_is_bounded(monkeypatch):
+    monkeypatch.setattr(text_layout, 'WIDTH_CACHE_SIZE', 8)
+    metrics = text_layout._FontMetrics(FONT, 40)
+    for i in range(100):
+        metrics.width(f'word{i}')
+
+    assert metrics._widths.cache_info().currsize == 8
+    assert metrics.width('word99') == metrics.font.getlength('word99')
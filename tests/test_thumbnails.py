@@ -0,0 +1,32 @@
+import os
+
+from PIL import Image
+
+from postcard_creator.thumbnails import ThumbnailStore, SIZE_MEDIUM, SIZE_SMALL
+
+
+def test_thumbnails_are_generated_for_all_sizes(tmp_path):
+    source = tmp_path.joinpath('photo.jpg')
+    Image.new('RGB', (4000, 3000), 'red').save(source)
+    store = ThumbnailStore(tmp_path.joinpath('thumbs'))
+
+    small = store.thumbnail(source, SIZE_SMALL)
+    medium = store.thumbnail(source, SIZE_MEDIUM)
+
+    assert Image.open(small).size == (256, 192)
+    assert Image.open(medium).size == (768, 576)
+
+
+def test_changed_source_invalidates_thumbnails(tmp_path):
+    source = tmp_path.joinpath('photo.jpg')
+    Image.new('RGB', (400, 300), 'red').save(source)
+    store = ThumbnailStore(tmp_path.joinpath('thumbs'))
+    old = store.thumbnail(source)
+
+    Image.new('RGB', (300, 400), 'blue').save(source)
+    os.utime(source, ns=(os.stat(source).st_atime_ns, os.stat(source).st_mtime_ns + 10 ** 9))
+    new = store.thumbnail(source)
+
+    assert new != old
+    assert not old.exists()
+    assert Image.open(new).size == (192, 256)
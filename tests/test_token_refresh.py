@@ -0,0 +1,117 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from cryptography.fernet import Fernet
+
+from postcard_creator import request_policy
+from postcard_creator.enc_token_provider import EncTokenProvider
+from postcard_creator.request_policy import RequestPolicy
+from postcard_creator.testing.fake_post_api import FakePostApi
+from postcard_creator.token_refresh import SingleFlight, needs_refresh
+
+TOKEN_PATH = 'POST /OAuth/token'
+
+
+@pytest.fixture
+def api(monkeypatch):
+    with FakePostApi(latency=0.05) as api:
+        monkeypatch.setenv('POSTCARD_API_BASE', api.url)
+        request_policy.set_request_policy(RequestPolicy(backoff_factor=0))
+        yield api
+
+
+@pytest.fixture
+def accounts(tmp_path, monkeypatch):
+    monkeypatch.setenv('ENC_KEY', Fernet.generate_key().decode())
+    return tmp_path
+
+
+def _store(accounts, name, fetched_at, expires_in=3600):
+    token = {'fetched_at': fetched_at, 'expires_in': expires_in, 'type': 'Bearer', 'token': f'access-{name}',
+             'refresh_token': f'refresh-{name}', 'implementation': 'swissid'}
+    path = accounts.joinpath(f'{name}_Fake-token.json.enc')
+    EncTokenProvider(accounts)._store_token(token, path)
+    return path
+
+
+def test_needs_refresh(monkeypatch):
+    token = {'token': 'a', 'fetched_at': 1000, 'expires_in': 3600}
+    assert not needs_refresh(token, skew=300, now=1000)
+    assert needs_refresh(token, skew=300, now=4300)
+    assert needs_refresh(dict(token, token=None), skew=0, now=0)
+
+    monkeypatch.setenv('POSTCARD_TOKEN_REFRESH_SKEW', '3600')
+    assert needs_refresh(token, now=1000)
+
+
+def test_fresh_token_is_used_without_refresh(api, accounts):
+    provider = EncTokenProvider(accounts)
+    provider.decrypt_token(_store(accounts, 'anna', int(time.time())))
+    provider.maybe_refresh_token()
+
+    assert provider.postcard_creator.get_user_info()['firstName'] == 'anna'
+    assert api.requests[TOKEN_PATH] == 0
+
+
+def test_threads_share_one_refresh(api, accounts):
+    path = _store(accounts, 'anna', int(time.time()) - 3600)
+    providers = [EncTokenProvider(accounts) for _ in range(4)]
+    for provider in providers:
+        provider.decrypt_token(path)
+
+    threads = [threading.Thread(target=provider.maybe_refresh_token) for provider in providers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert api.requests[TOKEN_PATH] == 1
+    assert all(provider.token.token == 'access-anna' for provider in providers)
+    # written back to the file it was read from
+    assert [p.name for p in accounts.iterdir()] == [path.name]
+    provider = EncTokenProvider(accounts)
+    provider.decrypt_token(path)
+    assert not needs_refresh(provider.token_data)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_tasks_share_one_refresh(api, accounts, anyio_backend):
+    path = _store(accounts, 'anna', int(time.time()) - 3600)
+    providers = [EncTokenProvider(accounts) for _ in range(4)]
+    for provider in providers:
+        provider.decrypt_token(path)
+
+    await asyncio.gather(*[provider.maybe_refresh_token_async() for provider in providers])
+
+    assert api.requests[TOKEN_PATH] == 1
+    for provider in providers:
+        assert (await provider.async_postcard_creator.get_quota())['available']
+        await provider.async_postcard_creator.aclose()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_refresh_expiring(api, accounts, anyio_backend):
+    now = int(time.time())
+    _store(accounts, 'anna', now - 3000)  # expires in 10 minutes
+    _store(accounts, 'max', now)
+
+    provider = EncTokenProvider(accounts)
+    assert await provider.refresh_expiring_async(window=900) == 1
+    await provider.async_postcard_creator.aclose()
+    assert api.requests[TOKEN_PATH] == 1
+
+
+def test_single_flight_propagates_errors():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        flight.run('key', fail)
+    assert flight.run('key', lambda: 1) == 1
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+from cryptography.fernet import Fernet
+
+from postcard_creator import token_vault
+from postcard_creator.enc_token_provider import EncTokenProvider
+from postcard_creator.token_vault import TokenVault
+
+TOKEN = {'fetched_at': 1000, 'expires_in': 3600, 'type': 'Bearer', 'token': 'access-anna',
+         'refresh_token': 'refresh-anna', 'implementation': 'swissid'}
+
+
+@pytest.fixture
+def key():
+    return Fernet.generate_key()
+
+
+@pytest.fixture
+def vault(key):
+    return TokenVault(key)
+
+
+def test_file_is_decrypted_once(vault, tmp_path):
+    path = tmp_path.joinpath('anna-token.json.enc')
+    vault.put(path, TOKEN)
+    vault.evict(path)
+
+    assert vault.get(path) == TOKEN
+    token = vault.get(path)
+    token['token'] = 'changed'
+    assert vault.get(path) == TOKEN
+    assert vault.reads == 1
+
+
+def test_changed_file_is_reloaded(vault, key, tmp_path):
+    path = tmp_path.joinpath('anna-token.json.enc')
+    vault.put(path, TOKEN)
+
+    # written by another process
+    TokenVault(key).put(path, dict(TOKEN, token='access-new'))
+    os.utime(path, ns=(1, 1))
+    assert vault.get(path)['token'] == 'access-new'
+    assert vault.reads == 1
+
+
+def test_eviction_zeroes_plain_text(vault, tmp_path):
+    path = tmp_path.joinpath('anna-token.json.enc')
+    vault.put(path, TOKEN)
+    plain_text = vault._records[path.resolve()].plain_text
+
+    vault.evict(path)
+    assert plain_text == bytearray(len(plain_text))
+    vault.put(path, TOKEN)
+    plain_text = vault._records[path.resolve()].plain_text
+    vault.clear()
+    assert not any(plain_text)
+
+
+def test_provider_uses_process_vault(tmp_path, monkeypatch):
+    monkeypatch.setenv('ENC_KEY', Fernet.generate_key().decode())
+    EncTokenProvider(tmp_path).encrypt_and_store_token(TOKEN, 'anna')
+
+    for _ in range(3):
+        provider = EncTokenProvider(tmp_path)
+        provider.decrypt_token(provider.list_tokens()[0])
+        assert provider.token_data == TOKEN
+    assert token_vault.get_token_vault().reads == 0
+
+    monkeypatch.setenv('ENC_KEY', Fernet.generate_key().decode())
+    assert token_vault.get_token_vault().reads == 0
+    with pytest.raises(Exception):
+        provider.decrypt_token(provider.list_tokens()[0])
@@ -0,0 +1,62 @@
+import logging
+
+import pytest
+import requests
+import requests_mock
+
+from postcard_creator import tracing
+from postcard_creator.upload_body import Base64Field, JsonStreamBody
+
+
+@pytest.fixture
+def response():
+    with requests_mock.Mocker() as m:
+        m.post('https://pccweb.api.post.ch/card/upload', text='x' * 5000)
+        yield requests.post('https://pccweb.api.post.ch/card/upload', data=b'y' * 5000,
+                            headers={'Authorization': 'Bearer secret'})
+
+
+@pytest.fixture
+def log_level():
+    logger = logging.getLogger('postcard_creator')
+    level = logger.level
+    yield logger.setLevel
+    logger.setLevel(level)
+
+
+def test_nothing_is_formatted_without_debug(response, log_level, monkeypatch):
+    log_level(logging.INFO)
+
+    def fail(*args):
+        raise AssertionError('exchange formatted')
+
+    monkeypatch.setattr(tracing, '_format_exchange', fail)
+    tracing.trace_response(response)
+
+
+def test_bodies_are_truncated_and_credentials_redacted(response, log_level, caplog):
+    log_level(logging.DEBUG)
+    with caplog.at_level(logging.DEBUG, logger='postcard_creator'):
+        tracing.trace_response(response, max_body=100)
+
+    assert 'secret' not in caplog.text
+    assert 'y' * 100 + '... <4900 more bytes elided>' in caplog.text
+    assert 'x' * 101 not in caplog.text
+
+
+def test_streamed_body_is_not_read():
+    body = JsonStreamBody({'image': Base64Field(b'123')})
+    assert tracing._format_body(body, 100) == f'<streamed body, {len(body)} bytes>'
+    assert body.read() == b'{"image": "MTIz"}'
+
+
+def test_full_dump_to_file(response, log_level, tmp_path):
+    log_level(logging.INFO)
+    path = tmp_path.joinpath('trace.log')
+    tracing.configure_dump_file(path)
+    try:
+        tracing.trace_response(response)
+    finally:
+        tracing.configure_dump_file(None)
+
+    assert 'x' * 5000 in path.read_text()
@@ -0,0 +1,64 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from postcard_creator import transport
+from postcard_creator.postcard_creator_swissid import PostcardCreatorSwissId
+from postcard_creator.token import NoopToken
+
+
+def test_sessions_share_connection_pool():
+    t = transport.Transport(host_pool_sizes={'pccweb.api.post.ch': 20})
+    a, b = t.new_session(), t.new_session()
+
+    assert a.get_adapter('https://example.com/') is b.get_adapter('https://example.com/') is t.adapter
+    assert a.get_adapter('https://pccweb.api.post.ch/x') is t.host_adapters['pccweb.api.post.ch']
+    assert a.cookies is not b.cookies
+
+
+def test_closing_a_session_keeps_the_pool():
+    t = transport.Transport()
+    session = t.new_session()
+    session.close()
+    assert t.adapter.poolmanager.pools is not None
+    assert t.new_session().get_adapter('https://example.com/') is t.adapter
+
+
+def test_clients_use_process_wide_pool():
+    t = transport.configure_transport()
+    try:
+        a = PostcardCreatorSwissId(NoopToken('a'))
+        b = PostcardCreatorSwissId(NoopToken('b'))
+        assert a._session.get_adapter(a.host) is b._session.get_adapter(b.host) is t.adapter
+    finally:
+        transport.configure_transport()
+
+
+def test_requests_reuse_connections():
+    connections = set()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            connections.add(self.client_address)
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/'
+    try:
+        t = transport.Transport()
+        assert t.warm_up([url]) == 1
+        for _ in range(5):
+            t.new_session().get(url)
+        assert len(connections) == 1
+    finally:
+        server.shutdown()
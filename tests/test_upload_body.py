@@ -0,0 +1,66 @@
+import base64
+import io
+import json
+
+import requests_mock
+from PIL import Image
+
+from postcard_creator.postcard_creator import Postcard, Recipient, Sender
+from postcard_creator.postcard_creator_swissid import PostcardCreatorSwissId
+from postcard_creator.token import NoopToken
+from postcard_creator.upload_body import Base64Field, JsonStreamBody
+
+URL_API = 'https://pccweb.api.post.ch/secure/api/mobile/v1'
+
+
+def _jpeg(width, height):
+    with io.BytesIO() as f:
+        Image.new('RGB', (width, height), 'red').save(f, 'jpeg')
+        return f.getvalue()
+
+
+def test_stream_body_equals_json_dumps():
+    image = bytes(range(256)) * 1000 + b'x'
+    payload = {'lang': 'en', 'paid': False, 'recipient': {'city': 'Zürich'}, 'image': Base64Field(image),
+               'stamp': None}
+    expected = json.dumps(dict(payload, image=base64.b64encode(image).decode('ascii'))).encode('utf-8')
+
+    body = JsonStreamBody(payload, chunk_size=3 * 100)
+
+    assert len(body) == len(expected)
+    assert b''.join(body) == expected
+
+
+def test_stream_body_read_in_blocks():
+    image = b'\x00\xff' * 10000
+    expected = json.dumps({'image': base64.b64encode(image).decode('ascii')}).encode('utf-8')
+    body = JsonStreamBody({'image': Base64Field(image)}, chunk_size=3 * 64)
+
+    blocks = []
+    while block := body.read(1000):
+        assert len(block) <= 1000
+        blocks.append(block)
+
+    assert b''.join(blocks) == expected
+
+
+def test_send_free_card_streams_upload():
+    cover, text = _jpeg(1819, 1311), _jpeg(720, 744)
+    person = dict(prename='prename à', lastname='lastname', street='street 1', zip_code=8000, place='Zürich')
+    postcard = Postcard(sender=Sender(**person), recipient=Recipient(**person),
+                        picture_stream=io.BytesIO(cover), message_image_stream=io.BytesIO(text))
+
+    with requests_mock.Mocker() as m:
+        m.get(URL_API + '/user/quota', json={'model': {'available': True, 'next': None}})
+        m.post(URL_API + '/card/upload', json={'model': {'orderId': 42}})
+
+        result = PostcardCreatorSwissId(NoopToken('token')).send_free_card(postcard)
+
+        upload = m.request_history[-1]
+        sent = json.loads(b''.join(upload.body))
+
+    assert result == {'orderId': 42}
+    assert upload.headers['Content-Type'] == 'application/json'
+    assert base64.b64decode(sent['image']) == cover
+    assert base64.b64decode(sent['textImage']) == text
+    assert sent['recipient']['city'] == 'Zürich'